@@ -0,0 +1 @@
+from .buffer import log, span  # noqa: F401
@@ -1,11 +1,398 @@
+from datetime import datetime
+
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.db.models import Count, Max, Min, Q
+from django.utils.functional import cached_property
+from django.utils.html import format_html, format_html_join
+
+from .conf import get_setting
+from .models import O11yException, O11yLog, O11yLogDetail, O11yRollup
+from .profiler import flame_tree
+
+
+CURSOR_VAR = 'cursor'
+
+# not needed to render the changelist, and by far the largest columns
+HEAVY_FIELDS = [
+    'request_payload', 'response_payload', 'logs', 'spans', 'exception', 'queries', 'memory_top',
+    'profile',
+]
+
+# flame graph nodes narrower than this fraction of the samples aren't drawn
+FLAME_MIN_WIDTH = 0.005
+FLAME_MAX_DEPTH = 50
+
+
+class EstimatedCountPaginator(Paginator):
+    '''Paginator which never runs a full COUNT(*)
+
+    Unfiltered lists use the row count from the database's statistics, and filtered lists count
+    at most O11Y_ADMIN_COUNT_LIMIT rows.
+    '''
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.has_filters():
+            estimate = estimate_count(self.object_list.model, self.object_list.db)
+            if estimate is not None:
+                return estimate
+        return self.object_list.order_by()[:get_setting('O11Y_ADMIN_COUNT_LIMIT')].count()
+
+
+def estimate_count(model, using='default'):
+    '''Cheap estimate of the number of rows in the model's table
+
+    Comes from the database's statistics where it has them. Otherwise, tables of up to
+    O11Y_ADMIN_COUNT_LIMIT rows are counted, and larger ones are estimated from the range of
+    their ids - which overestimates when old rows are kept among deleted ones, as with
+    O11Y_RETENTION_DAYS_BY_STATUS, but is never less than the limit.
+    '''
+    connection = connections[using]
+    table = model._meta.db_table
+    queries = {
+        'postgresql': ('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table]),
+        'mysql': (
+            'SELECT table_rows FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = %s',
+            [table],
+        ),
+        # only populated once ANALYZE has been run. Tables with indexes only have a row per index,
+        # whose first number is the row count
+        'sqlite': (
+            'SELECT stat FROM sqlite_stat1 WHERE tbl = %s ORDER BY idx IS NOT NULL LIMIT 1',
+            [table],
+        ),
+    }
+
+    estimate = None
+    if connection.vendor in queries:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(*queries[connection.vendor])
+                row = cursor.fetchone()
+            if row is not None and row[0] is not None:
+                estimate = int(str(row[0]).split()[0])
+        except (DatabaseError, ValueError):
+            estimate = None
+
+    # postgres reports -1 for tables which have never been analysed
+    if estimate is None or estimate < 0:
+        queryset = model._default_manager.using(using).order_by()
+        limit = get_setting('O11Y_ADMIN_COUNT_LIMIT')
+        counted = queryset[:limit].count()
+        if limit is None or counted < limit:
+            return counted
+        # both ends come straight from the primary key index
+        bounds = queryset.aggregate(lo=Min('pk'), hi=Max('pk'))
+        estimate = max(bounds['hi'] - bounds['lo'] + 1, counted)
+    return estimate
+
+
+def cached_choices_filter(field_name, title=None):
+    '''Build a list filter for field_name whose choices are cached
+
+    The default filter runs SELECT DISTINCT over the whole table on every page load. Instead, the
+    choices are the O11Y_ADMIN_FILTER_MAX_CHOICES most common values among the latest
+    O11Y_ADMIN_FILTER_SAMPLE_SIZE logs, recomputed every O11Y_ADMIN_FILTER_CACHE_TIMEOUT seconds.
+    '''
+
+    class CachedChoicesFilter(admin.SimpleListFilter):
+        parameter_name = field_name
+
+        def lookups(self, request, model_admin):
+            return cache.get_or_set(
+                f'db_o11y:admin_filter:{field_name}',
+                lambda: _common_values(field_name),
+                get_setting('O11Y_ADMIN_FILTER_CACHE_TIMEOUT'),
+            )
+
+        def queryset(self, request, queryset):
+            if self.value() is None:
+                return queryset
+            return queryset.filter(**{field_name: self.value()})
+
+    CachedChoicesFilter.title = title or field_name.replace('_', ' ')
+    CachedChoicesFilter.__name__ = f'Cached{field_name.title().replace("_", "")}Filter'
+    return CachedChoicesFilter
+
+
+def _common_values(field_name):
+    latest = O11yLog.objects.aggregate(hi=Max('id'))['hi']
+    if latest is None:
+        return []
+    recent = O11yLog.objects.filter(
+        id__gt=latest - get_setting('O11Y_ADMIN_FILTER_SAMPLE_SIZE'),
+        **{f'{field_name}__isnull': False},
+    )
+    values = (
+        recent.values_list(field_name).annotate(n=Count('id')).order_by('-n')
+        [:get_setting('O11Y_ADMIN_FILTER_MAX_CHOICES')]
+    )
+    return [(str(value), str(value)) for value, _ in values]
+
+
+class QueryTimeFilter(admin.SimpleListFilter):
+    title = 'DB time'
+    parameter_name = 'query_time'
+    ranges = {
+        'lt10ms': (None, 0.01),
+        '10-100ms': (0.01, 0.1),
+        '100ms-1s': (0.1, 1),
+        'gt1s': (1, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [
+            ('lt10ms', '< 10ms'),
+            ('10-100ms', '10ms - 100ms'),
+            ('100ms-1s', '100ms - 1s'),
+            ('gt1s', '> 1s'),
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        lo, hi = self.ranges[self.value()]
+        if lo is not None:
+            queryset = queryset.filter(query_time__gte=lo)
+        if hi is not None:
+            queryset = queryset.filter(query_time__lt=hi)
+        return queryset
+
+
+class KeysetChangeList(ChangeList):
+    '''ChangeList which pages through logs newest first by (created_at, id)
+
+    Rather than an OFFSET, each page is fetched as the rows older than the last row of the
+    previous page, which is an index range scan however deep into the table the page is.
+    '''
 
-from .models import O11yLog
+    # exclude_parameters was only added in Django 5.0, so is passed on as it comes
+    def get_queryset(self, request, *args, **kwargs):
+        return super().get_queryset(request, *args, **kwargs).defer(*HEAVY_FIELDS)
+
+    def get_results(self, request):
+        cursor = getattr(request, '_o11y_cursor', None)
+        self.cursor = _parse_cursor(cursor) if cursor is not None else None
+        queryset = self.queryset.order_by('-created_at', '-id')
+        if self.cursor is not None:
+            created_at, pk = self.cursor
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
+        rows = list(queryset[:self.list_per_page + 1])
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = rows[:self.list_per_page]
+        # the page number links don't apply, so don't let the admin render them
+        self.can_show_all = False
+        self.multi_page = False
+        self.keyset = True
+
+        self.first_page_url = self.get_query_string() if self.cursor is not None else None
+        self.next_page_url = None
+        if len(rows) > self.list_per_page:
+            last = self.result_list[-1]
+            self.next_page_url = self.get_query_string(
+                {CURSOR_VAR: f'{last.created_at.isoformat()}_{last.id}'}
+            )
+
+
+class O11yLogDetailInline(admin.StackedInline):
+    '''The heavy fields of logs written with O11Y_DETAIL_TABLE enabled, on the change page only'''
+    model = O11yLogDetail
+    fields = ['request_payload', 'response_payload', 'exception', 'logs']
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+    max_num = 1
 
 
 class O11yLogAdmin(admin.ModelAdmin):
-    list_display = ['id', 'created_at', 'url', 'method', 'response_code']
-    list_filter = ['created_at', 'url', 'method', 'response_code']
+    '''Admin for O11yLog
+
+    With O11Y_ADMIN_HIGH_VOLUME enabled, the changelist is built to stay fast on tables with
+    millions of rows: counts are estimated, pages are fetched by keyset rather than OFFSET, the
+    heavy columns are not loaded and the filter choices are cached.
+    '''
+    list_display = [
+        'id', 'created_at', 'url', 'route', 'method', 'response_code', 'duration', 'query_count',
+        'query_time', 'memory_peak',
+    ]
+    # filter on route rather than url - url includes object ids so has unbounded cardinality
+    list_filter = ['created_at', 'route', 'method', 'response_code', 'anomalous', QueryTimeFilter]
+    high_volume_list_filter = [
+        'created_at',
+        cached_choices_filter('route'),
+        cached_choices_filter('url'),
+        cached_choices_filter('method'),
+        cached_choices_filter('response_code', 'response code'),
+        'anomalous',
+        QueryTimeFilter,
+    ]
+    readonly_fields = ['span_waterfall', 'flame_graph']
+    raw_id_fields = ['exception_group']
+    inlines = [O11yLogDetailInline]
+
+    @admin.display(description='Span waterfall')
+    def span_waterfall(self, obj):
+        return render_waterfall(obj.spans, obj.duration)
+
+    @admin.display(description='Flame graph')
+    def flame_graph(self, obj):
+        return render_flame_graph(obj.profile)
+
+    def high_volume(self):
+        return get_setting('O11Y_ADMIN_HIGH_VOLUME')
+
+    def changelist_view(self, request, extra_context=None):
+        if self.high_volume() and CURSOR_VAR in request.GET:
+            # taken out of the query string so the admin doesn't treat it as a field lookup
+            request._o11y_cursor = request.GET[CURSOR_VAR]
+            request.GET = request.GET.copy()
+            del request.GET[CURSOR_VAR]
+        return super().changelist_view(request, extra_context)
+
+    def get_changelist(self, request, **kwargs):
+        if self.high_volume():
+            return KeysetChangeList
+        return super().get_changelist(request, **kwargs)
+
+    def get_list_filter(self, request):
+        if self.high_volume():
+            return self.high_volume_list_filter
+        return super().get_list_filter(request)
+
+    def get_sortable_by(self, request):
+        # keyset pagination only works in (created_at, id) order
+        if self.high_volume():
+            return ()
+        return super().get_sortable_by(request)
+
+    def get_paginator(self, request, queryset, per_page, *args, **kwargs):
+        if self.high_volume():
+            return EstimatedCountPaginator(queryset, per_page, *args, **kwargs)
+        return super().get_paginator(request, queryset, per_page, *args, **kwargs)
+
+
+def render_waterfall(spans, duration=None):
+    '''HTML for a list of request.span spans as a waterfall: one row per span, indented under its
+    parent, with a bar showing when it started and how long it took within the request
+    '''
+    if not spans:
+        return '-'
+
+    total = max([duration or 0] + [span['start'] + span['duration'] for span in spans]) or 1
+    depths = []
+    rows = []
+    for span in spans:
+        parent = span.get('parent')
+        depth = depths[parent] + 1 if parent is not None and parent < len(depths) else 0
+        depths.append(depth)
+        rows.append((
+            depth * 16,
+            span['name'],
+            span['name'],
+            f"{span['start'] / total * 100:.2f}",
+            f"{max(span['duration'] / total * 100, 0.2):.2f}",
+            '#ba2121' if span.get('error') else '#79aec8',
+            f"{span['duration'] * 1000:.1f}",
+        ))
+
+    return format_html(
+        '<div style="min-width: 600px; font-family: monospace; font-size: 12px;">{}</div>',
+        format_html_join(
+            '',
+            '<div style="display: flex; align-items: center; margin-bottom: 2px;">'
+            '<div style="width: 30%; padding-left: {}px; overflow: hidden; '
+            'text-overflow: ellipsis; white-space: nowrap;" title="{}">{}</div>'
+            '<div style="position: relative; flex: 1; height: 14px; background: #f2f2f2;">'
+            '<div style="position: absolute; left: {}%; width: {}%; height: 100%; '
+            'background: {};"></div></div>'
+            '<div style="width: 80px; text-align: right;">{} ms</div></div>',
+            rows,
+        ),
+    )
+
+
+def render_flame_graph(profile):
+    '''HTML for the samples of a profiled request as a flame graph, callers above callees
+
+    Each box is a function, as wide as the share of samples it was on the stack for.
+    '''
+    if not profile or not profile.get('stacks'):
+        return '-'
+
+    tree = flame_tree(profile['stacks'])
+    total = tree['count']
+    rows = []
+
+    def walk(node, depth, start):
+        if depth >= FLAME_MAX_DEPTH:
+            return
+        for child in sorted(node['children'].values(), key=lambda child: child['name']):
+            width = child['count'] / total
+            if width >= FLAME_MIN_WIDTH:
+                rows.append((
+                    depth * 16,
+                    f'{start * 100:.2f}',
+                    f'{width * 100:.2f}',
+                    f"{child['name']} - {child['count']} samples ({width * 100:.1f}%)",
+                    child['name'],
+                ))
+                walk(child, depth + 1, start)
+            start += width
+
+    walk(tree, 0, 0)
+    interval_ms = profile.get('interval', 0) * 1000
+    return format_html(
+        '<div style="min-width: 600px; font-family: monospace; font-size: 11px;">'
+        '<div>{} samples every {} ms</div>'
+        '<div style="position: relative; height: {}px;">{}</div></div>',
+        profile.get('samples', total),
+        f'{interval_ms:g}',
+        (max(row[0] for row in rows) + 16) if rows else 0,
+        format_html_join(
+            '',
+            '<div style="position: absolute; top: {}px; left: {}%; width: {}%; height: 15px; '
+            'background: #f0b36b; border: 1px solid #fff; box-sizing: border-box; '
+            'overflow: hidden; text-overflow: ellipsis; white-space: nowrap;" title="{}">{}</div>',
+            rows,
+        ),
+    )
+
+
+def _parse_cursor(value):
+    created_at, _, pk = value.rpartition('_')
+    try:
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError:
+        raise IncorrectLookupParameters(f'Invalid cursor: {value}')
+
+
+class O11yRollupAdmin(admin.ModelAdmin):
+    list_display = ['bucket', 'route', 'method', 'status_class', 'count', 'duration_max']
+    list_filter = ['bucket', 'method', 'status_class']
+    search_fields = ['route']
+
+
+class O11yExceptionAdmin(admin.ModelAdmin):
+    list_display = ['exception_type', 'count', 'first_seen', 'last_seen', 'fingerprint']
+    list_filter = ['last_seen']
+    search_fields = ['exception_type']
+    ordering = ['-last_seen']
+    readonly_fields = ['fingerprint', 'count', 'first_seen', 'last_seen']
 
 
+admin.site.register(O11yException, O11yExceptionAdmin)
 admin.site.register(O11yLog, O11yLogAdmin)
+admin.site.register(O11yRollup, O11yRollupAdmin)
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+import hashlib
+import hmac
+
+from django.core.cache import cache
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+
+from .conf import get_setting
+from .models import O11yLog
+from .rollup import histogram_aggregates, histogram_from, percentile, status_code
+
+
+SORT_KEYS = ('p50', 'p95', 'p99', 'mean', 'error_rate', 'count')
+
+
+class BadRequest(Exception):
+    pass
+
+
+def route_stats(since, until, route=None, method=None):
+    '''Throughput, error rate and latency percentiles of each route and method between since
+    and until
+
+    Aggregated by the database - one row per route and method comes back, holding the counts of
+    a latency histogram which the percentiles are estimated from.
+    '''
+    logs = O11yLog.objects.filter(created_at__gte=since, created_at__lt=until)
+    if route is not None:
+        logs = logs.filter(route=route)
+    if method is not None:
+        logs = logs.filter(method=method)
+
+    groups = (
+        logs
+        .alias(status=Coalesce('response_code', status_code(None)))
+        .values('route', 'method')
+        .annotate(
+            n=Count('id'),
+            errors=Count('id', filter=Q(status__gte=500)),
+            timed=Count('duration'),
+            duration_sum=Sum('duration'),
+            duration_max=Max('duration'),
+            **histogram_aggregates(),
+        )
+        .order_by()
+    )
+
+    seconds = (until - since).total_seconds()
+    stats = []
+    for group in groups:
+        histogram = histogram_from(group, group['timed'])
+        stats.append({
+            'route': group['route'],
+            'method': group['method'],
+            'count': group['n'],
+            'requests_per_second': group['n'] / seconds if seconds else None,
+            'error_rate': group['errors'] / group['n'],
+            'mean': group['duration_sum'] / group['timed'] if group['timed'] else None,
+            'max': group['duration_max'],
+            'p50': percentile(histogram, 0.5, group['duration_max']),
+            'p95': percentile(histogram, 0.95, group['duration_max']),
+            'p99': percentile(histogram, 0.99, group['duration_max']),
+        })
+    return sorted(stats, key=lambda item: (-item['count'], item['route'] or '', item['method']))
+
+
+def api_view(func):
+    '''Common handling for the API views: access control, the time window, caching and errors
+
+    The view is called with the request and the (since, until) window, and returns a dict. The
+    window ends at the start of the current O11Y_API_CACHE_BUCKET second bucket, so every poll in
+    the same bucket gets the same answer, which is cached until the next bucket starts.
+    '''
+    @require_GET
+    def inner(request):
+        if not _allowed(request):
+            return JsonResponse({'error': 'Forbidden'}, status=403)
+        try:
+            since, until = _window(request)
+            key = _cache_key(func.__name__, request, until)
+            data = cache.get(key)
+            if data is None:
+                data = {
+                    'since': since.isoformat(),
+                    'until': until.isoformat(),
+                    **func(request, since, until),
+                }
+                cache.set(key, data, get_setting('O11Y_API_CACHE_BUCKET') * 2)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse(data)
+
+    inner.__name__ = func.__name__
+    inner.__doc__ = func.__doc__
+    return inner
+
+
+@api_view
+def routes(request, since, until):
+    '''Stats for every route (or ?route= / ?method= only)'''
+    return {'routes': route_stats(
+        since, until, request.GET.get('route'), request.GET.get('method'),
+    )}
+
+
+@api_view
+def slow_routes(request, since, until):
+    '''The ?limit= (default 10) routes with the highest ?by= (default p95) latency'''
+    by = request.GET.get('by', 'p95')
+    if by not in SORT_KEYS:
+        raise BadRequest(f'by must be one of {", ".join(SORT_KEYS)}')
+    stats = [item for item in route_stats(since, until) if item[by] is not None]
+    stats.sort(key=lambda item: item[by], reverse=True)
+    return {'by': by, 'routes': stats[:_int_param(request, 'limit', 10)]}
+
+
+def _window(request):
+    bucket = get_setting('O11Y_API_CACHE_BUCKET')
+    now = timezone.now().timestamp()
+    until = datetime.fromtimestamp(now - now % bucket, tz=dt_timezone.utc)
+    window = _int_param(request, 'window', get_setting('O11Y_API_DEFAULT_WINDOW'))
+    if window > get_setting('O11Y_API_MAX_WINDOW'):
+        raise BadRequest(f'window must be at most {get_setting("O11Y_API_MAX_WINDOW")} seconds')
+    return until - timedelta(seconds=window), until
+
+
+def _int_param(request, name, default):
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise BadRequest(f'{name} must be a positive integer')
+    return value
+
+
+def _cache_key(name, request, until):
+    # hashed, as routes contain characters which not every cache backend allows in keys
+    params = '&'.join(f'{key}={value}' for key, value in sorted(request.GET.items()))
+    digest = hashlib.md5(params.encode()).hexdigest()
+    return f'db_o11y:api:{name}:{int(until.timestamp())}:{digest}'
+
+
+def _allowed(request):
+    token = get_setting('O11Y_API_TOKEN')
+    if token:
+        header = request.headers.get('Authorization', '')
+        if hmac.compare_digest(header.encode(), f'Bearer {token}'.encode()):
+            return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_active and user.is_staff
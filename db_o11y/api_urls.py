@@ -0,0 +1,12 @@
+from django.urls import path
+
+from . import api
+
+
+# include these to expose the query API e.g. path('o11y/api/', include('db_o11y.api_urls'))
+app_name = 'db_o11y_api'
+
+urlpatterns = [
+    path('routes/', api.routes, name='routes'),
+    path('slow-routes/', api.slow_routes, name='slow-routes'),
+]
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class O11yLogsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'db_o11y'
+
+    def ready(self):
+        from . import checks  # noqa: F401 - registers the system checks
+        from .queries import connection_created_handler
+        from .routers import configure_connection
+
+        connection_created.connect(
+            configure_connection, dispatch_uid='db_o11y_configure_connection'
+        )
+        connection_created.connect(
+            connection_created_handler, dispatch_uid='db_o11y_record_queries'
+        )
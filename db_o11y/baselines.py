@@ -0,0 +1,72 @@
+import math
+
+from .conf import get_setting
+
+
+class Baseline:
+    '''Exponentially weighted moving mean and variance of one route's latency
+
+    Each update moves the mean alpha of the way towards the new value, so recent requests count
+    for more and the baseline follows gradual changes, while a single slow request barely moves
+    it.
+    '''
+    __slots__ = ('mean', 'variance', 'count')
+
+    def __init__(self):
+        self.mean = 0.0
+        self.variance = 0.0
+        self.count = 0
+
+    def update(self, value, alpha):
+        if self.count == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + diff * increment)
+        self.count += 1
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+
+# (route, method) -> Baseline, for this process. Threads share it without a lock: at worst two
+# requests finishing at the same moment both update from the same starting point, and one
+# update is lost
+_baselines = {}
+
+
+def get_baselines():
+    return _baselines
+
+
+def is_anomalous(route, method, duration):
+    '''Compare a request's duration with its route's baseline, then add it to the baseline
+
+    A request is anomalous if it took longer than all of:
+    * O11Y_ANOMALY_FACTOR times the baseline mean
+    * the mean plus O11Y_ANOMALY_STDDEVS standard deviations, so that routes whose latency
+      usually varies a lot aren't flagged for it
+    * O11Y_ANOMALY_MIN_DURATION seconds, so that fast routes aren't flagged for a few
+      milliseconds
+    Nothing is flagged until the route has O11Y_BASELINE_MIN_REQUESTS requests in its baseline.
+    Requests which didn't resolve to a route have no baseline.
+    '''
+    if route is None or duration is None:
+        return False
+
+    key = (route, method)
+    baseline = _baselines.get(key)
+    if baseline is None:
+        baseline = _baselines.setdefault(key, Baseline())
+
+    anomalous = (
+        baseline.count >= get_setting('O11Y_BASELINE_MIN_REQUESTS')
+        and duration > get_setting('O11Y_ANOMALY_MIN_DURATION')
+        and duration > baseline.mean * get_setting('O11Y_ANOMALY_FACTOR')
+        and duration > baseline.mean + baseline.stddev * get_setting('O11Y_ANOMALY_STDDEVS')
+    )
+    baseline.update(duration, get_setting('O11Y_BASELINE_ALPHA'))
+    return anomalous
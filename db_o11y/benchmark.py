@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+
+import django
+from django.db import connection, connections
+from django.http import JsonResponse
+from django.test.client import RequestFactory
+
+from .buffer import ignore_log, ignore_span
+from .models import O11yLog
+from .utils import auto_log
+from .views import HtmlViews, JsonViews
+
+
+def synthetic_view(request, log_count=0, payload_bytes=0):
+    '''Adds log_count logs and returns a JSON body of about payload_bytes'''
+    for i in range(log_count):
+        request.add_log(f'log {i}')
+    return JsonResponse({'data': 'x' * payload_bytes})
+
+
+# the views from db_o11y.views which don't sleep, undecorated. They are methods, so are called
+# with an instance of their class
+VIEWS = {
+    'html': (HtmlViews.get.__wrapped__, HtmlViews),
+    'json': (JsonViews.get.__wrapped__, JsonViews),
+    'json-put': (JsonViews.put.__wrapped__, JsonViews),
+}
+
+
+class Scenario:
+    '''One combination of view, logs, payload size, auto_log options and concurrency
+
+    Each scenario's view is run twice: bare, as the baseline, and decorated with auto_log, and
+    the difference between the two is the overhead. Views are called directly with
+    RequestFactory requests, so neither the test client nor URL resolution is measured.
+    '''
+
+    def __init__(
+        self, view='synthetic', log_count=0, payload_bytes=0, log_inputs=False, log_outputs=False,
+        concurrency=1,
+    ):
+        self.view = view
+        self.log_count = log_count
+        self.payload_bytes = payload_bytes
+        self.log_inputs = log_inputs
+        self.log_outputs = log_outputs
+        self.concurrency = concurrency
+
+    def as_dict(self):
+        return {
+            'view': self.view,
+            'log_count': self.log_count,
+            'payload_bytes': self.payload_bytes,
+            'log_inputs': self.log_inputs,
+            'log_outputs': self.log_outputs,
+            'concurrency': self.concurrency,
+        }
+
+    def key(self):
+        return tuple(sorted(self.as_dict().items()))
+
+    def request(self):
+        factory = RequestFactory()
+        if self.view == 'json-put' or self.payload_bytes:
+            body = json.dumps({'data': 'x' * self.payload_bytes})
+            return factory.put('/benchmark/', data=body, content_type='application/json')
+        return factory.get('/benchmark/')
+
+    def views(self):
+        '''The bare view and the same view decorated with auto_log, both taking just the request'''
+        if self.view == 'synthetic':
+            def func(request):
+                return synthetic_view(request, self.log_count, self.payload_bytes)
+        else:
+            method, cls = VIEWS[self.view]
+            instance = cls()
+
+            def func(request):
+                return method(instance, request)
+
+        def baseline(request):
+            # what the view expects auto_log to have set up
+            request.add_log = ignore_log
+            request.span = ignore_span
+            return func(request)
+
+        decorated = auto_log(log_inputs=self.log_inputs, log_outputs=self.log_outputs)(func)
+        return baseline, decorated
+
+
+def scenarios(views, log_counts, payload_sizes, io_modes, concurrency_levels):
+    '''Every combination of the options. Log counts and payload sizes only apply to the
+    synthetic view - the others are run once for each of the remaining options
+    '''
+    for view in views:
+        if view != 'synthetic' and view not in VIEWS:
+            raise ValueError(f'Unknown view: {view}')
+        logs_and_sizes = (
+            itertools.product(log_counts, payload_sizes) if view == 'synthetic' else [(0, 0)]
+        )
+        combinations = itertools.product(logs_and_sizes, io_modes, concurrency_levels)
+        for (log_count, payload_bytes), (log_inputs, log_outputs), concurrency in combinations:
+            yield Scenario(view, log_count, payload_bytes, log_inputs, log_outputs, concurrency)
+
+
+def run(scenario, requests=500, warmup=20, allocation_requests=50):
+    '''Benchmark one scenario, returning its results as a JSON-serialisable dict
+
+    Times are in seconds. Allocations are measured in a separate, sequential pass under
+    tracemalloc, which would otherwise distort the timings.
+    '''
+    baseline, decorated = scenario.views()
+    for view in (baseline, decorated):
+        _time_requests(view, scenario, warmup, 1)
+
+    results = scenario.as_dict()
+    for name, view in (('baseline', baseline), ('auto_log', decorated)):
+        latencies, elapsed = _time_requests(view, scenario, requests, scenario.concurrency)
+        results[name] = {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'requests_per_second': len(latencies) / elapsed if elapsed else None,
+        }
+        if allocation_requests:
+            results[name].update(_measure_allocations(view, scenario, allocation_requests))
+
+    results['overhead'] = {
+        key: results['auto_log'][key] - results['baseline'][key] for key in ('p50', 'p99')
+    }
+    if allocation_requests:
+        for key in ('peak_bytes', 'retained_bytes'):
+            results['overhead'][key] = results['auto_log'][key] - results['baseline'][key]
+    return results
+
+
+def run_all(scenarios, requests=500, warmup=20, allocation_requests=50, keep_logs=False):
+    '''Run every scenario, returning the report written by o11y_benchmark
+
+    The logs written during the run are deleted afterwards unless keep_logs is set.
+    '''
+    start_id = O11yLog.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    try:
+        results = [
+            run(scenario, requests, warmup, allocation_requests) for scenario in scenarios
+        ]
+    finally:
+        if not keep_logs:
+            O11yLog.objects.filter(id__gt=start_id).delete()
+
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'requests': requests,
+            'allocation_requests': allocation_requests,
+        },
+        'results': results,
+    }
+
+
+def compare(previous, current, keys=('p50', 'p99')):
+    '''Change in overhead of each scenario found in both reports, as
+    (scenario, key, previous, current) tuples
+    '''
+    before = {_scenario(result).key(): result for result in previous['results']}
+    changes = []
+    for result in current['results']:
+        scenario = _scenario(result)
+        old = before.get(scenario.key())
+        if old is None:
+            continue
+        for key in keys:
+            changes.append((scenario, key, old['overhead'][key], result['overhead'][key]))
+    return changes
+
+
+def percentile(values, q):
+    '''q-th quantile (0 < q <= 1) of values, by nearest rank'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _scenario(result):
+    return Scenario(**{key: result[key] for key in Scenario().as_dict()})
+
+
+def _time_requests(view, scenario, count, concurrency):
+    '''Latency of each of count requests, split between concurrency threads, and the total
+    wall-clock time taken
+    '''
+    if concurrency <= 1:
+        start = time.perf_counter()
+        latencies = _timed_calls(view, scenario, count)
+        return latencies, time.perf_counter() - start
+
+    per_thread = [count // concurrency + (i < count % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        batches = list(executor.map(
+            lambda n: _in_thread(_timed_calls, view, scenario, n), per_thread
+        ))
+    elapsed = time.perf_counter() - start
+    return [latency for batch in batches for latency in batch], elapsed
+
+
+def _timed_calls(view, scenario, count):
+    latencies = []
+    for _ in range(count):
+        request = scenario.request()
+        start = time.perf_counter_ns()
+        view(request)
+        latencies.append((time.perf_counter_ns() - start) / 1e9)
+    return latencies
+
+
+def _in_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # each thread has its own connections, which would otherwise be left open
+        connections.close_all()
+
+
+def _measure_allocations(view, scenario, count):
+    '''Mean bytes allocated at the peak of each request, and still allocated after it'''
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        peaks = []
+        retained = []
+        for _ in range(count):
+            request = scenario.request()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            view(request)
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        if started:
+            tracemalloc.stop()
+    return {'peak_bytes': sum(peaks) / count, 'retained_bytes': sum(retained) / count}
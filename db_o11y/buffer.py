@@ -0,0 +1,278 @@
+from collections import deque
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+from functools import wraps
+import time
+
+from asgiref.sync import iscoroutinefunction
+
+from .conf import get_setting
+
+
+# the buffer of the request being handled, so that code without access to the request can
+# still log to it (see log, span and handlers.O11yLogHandler). As a ContextVar it is separate for
+# each thread and asyncio task, and is carried across sync_to_async / async_to_sync
+_current_buffer = ContextVar('o11y_current_buffer', default=None)
+
+# the innermost open span, so that new spans know their parent. A ContextVar rather than a
+# stack on the buffer, so that spans opened in concurrent asyncio tasks don't nest inside each other
+_current_span = ContextVar('o11y_current_span', default=None)
+
+
+def _size(message):
+    '''Bytes the message takes up once stored as UTF-8'''
+    if not isinstance(message, str):
+        message = str(message)
+    # isascii is a flag check, so the common case is never encoded
+    return len(message) if message.isascii() else len(message.encode('utf-8', 'replace'))
+
+
+class RequestBuffer:
+    '''Everything the view records while its request is being logged
+
+    request.add_log and request.span are bound to the buffer of the current request. Times are
+    measured with perf_counter_ns relative to when the buffer was created.
+
+    The logs kept are bounded: the first keep_first logs are kept, then the latest keep_last
+    in a ring buffer, and the messages kept never add up to more than max_bytes bytes of UTF-8.
+    Anything else is dropped and counted in `dropped`. None means no limit. Logs are held as
+    parallel sequences of timestamps and messages, and only turned into dicts by logs().
+    '''
+
+    def __init__(self, keep_first=None, keep_last=None, max_bytes=None):
+        self.start_ns = time.perf_counter_ns()
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+        self.max_bytes = max_bytes
+        self.dropped = 0
+
+        self._head_ns = []
+        self._head_messages = []
+        self._head_bytes = 0
+        # once a log has gone past the head, later ones can't go back into it
+        self._head_closed = False
+        self._tail_ns = deque()
+        self._tail_messages = deque()
+        self._tail_sizes = deque()
+        self._tail_bytes = 0
+
+        self._spans = []
+        self._token = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            keep_first=get_setting('O11Y_LOG_KEEP_FIRST'),
+            keep_last=get_setting('O11Y_LOG_KEEP_LAST'),
+            max_bytes=get_setting('O11Y_LOG_MAX_BYTES'),
+        )
+
+    def activate(self):
+        '''Make this the buffer of the current context, until deactivate is called'''
+        self._token = _current_buffer.set(self)
+
+    def deactivate(self):
+        if self._token is not None:
+            _current_buffer.reset(self._token)
+            self._token = None
+
+    def add_log(self, message):
+        elapsed_ns = time.perf_counter_ns() - self.start_ns
+        size = _size(message)
+
+        if not self._head_closed:
+            if (self.keep_first is None or len(self._head_ns) < self.keep_first) and (
+                self.max_bytes is None or self._head_bytes + size <= self.max_bytes
+            ):
+                self._head_ns.append(elapsed_ns)
+                self._head_messages.append(message)
+                self._head_bytes += size
+                return
+            self._head_closed = True
+
+        if self.keep_last == 0 or (
+            self.max_bytes is not None and self._head_bytes + size > self.max_bytes
+        ):
+            self.dropped += 1
+            return
+
+        if self.keep_last is not None and len(self._tail_ns) >= self.keep_last:
+            self._drop_oldest_tail()
+        self._tail_ns.append(elapsed_ns)
+        self._tail_messages.append(message)
+        self._tail_sizes.append(size)
+        self._tail_bytes += size
+        while self.max_bytes is not None and self._head_bytes + self._tail_bytes > self.max_bytes:
+            self._drop_oldest_tail()
+
+    def _drop_oldest_tail(self):
+        self._tail_ns.popleft()
+        self._tail_messages.popleft()
+        self._tail_bytes -= self._tail_sizes.popleft()
+        self.dropped += 1
+
+    def logs(self):
+        '''The logs kept, as a list of {'elapsed', 'message'} dicts
+
+        If any were dropped, a marker saying how many is included where they would have been.
+        '''
+        logs = [
+            {'elapsed': elapsed_ns / 1e9, 'message': message}
+            for elapsed_ns, message in zip(self._head_ns, self._head_messages)
+        ]
+        if self.dropped:
+            elapsed_ns = self._tail_ns[0] if self._tail_ns else time.perf_counter_ns() - self.start_ns
+            logs.append({
+                'elapsed': elapsed_ns / 1e9,
+                'message': f'[{self.dropped} logs dropped]',
+                'dropped': self.dropped,
+            })
+        logs.extend(
+            {'elapsed': elapsed_ns / 1e9, 'message': message}
+            for elapsed_ns, message in zip(self._tail_ns, self._tail_messages)
+        )
+        return logs
+
+    def span(self, name, **attributes):
+        '''Time a block of code, as a context manager or decorator
+
+            with request.span('load basket', basket_id=basket.id) as span:
+                ...
+                span.set('items', len(items))
+        '''
+        return Span(self, name, attributes)
+
+    def spans(self):
+        '''The finished spans, in the order they were started
+
+        Each is a dict of name, start (seconds since the request started), duration (seconds),
+        parent (index of the parent span in this list, or None) and, if any, attributes.
+        '''
+        return [span for span in self._spans if span is not None]
+
+
+class _ContextDecorator(ContextDecorator):
+    '''ContextDecorator which can also decorate async functions'''
+
+    def __call__(self, func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def inner(*args, **kwargs):
+                with self._recreate_cm():
+                    return await func(*args, **kwargs)
+            return inner
+        return super().__call__(func)
+
+
+class Span(_ContextDecorator):
+
+    def __init__(self, buffer, name, attributes):
+        self.buffer = buffer
+        self.name = name
+        self.attributes = attributes
+        self.index = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent = parent.index if parent is not None and parent.buffer is self.buffer else None
+        # reserve the slot now so that spans are listed in start order
+        self.index = len(self.buffer._spans)
+        self.buffer._spans.append(None)
+        self._token = _current_span.set(self)
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end_ns = time.perf_counter_ns()
+        _current_span.reset(self._token)
+        span = {
+            'name': self.name,
+            'start': (self._start_ns - self.buffer.start_ns) / 1e9,
+            'duration': (end_ns - self._start_ns) / 1e9,
+            'parent': self.parent,
+        }
+        if self.attributes:
+            span['attributes'] = self.attributes
+        if exc_info[0] is not None:
+            span['error'] = exc_info[0].__name__
+        self.buffer._spans[self.index] = span
+        return False
+
+    def _recreate_cm(self):
+        # each call of a decorated function is a span of its own
+        return Span(self.buffer, self.name, dict(self.attributes))
+
+
+class _CurrentRequestSpan(_ContextDecorator):
+    '''Span of whichever request is being handled when the block is entered
+
+    Looked up on entry rather than creation, so that functions can be decorated at import time.
+    '''
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        buffer = _current_buffer.get()
+        self._span = buffer.span(self.name, **self.attributes) if buffer else IGNORED_SPAN
+        return self._span.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._span.__exit__(*exc_info)
+
+    def _recreate_cm(self):
+        return _CurrentRequestSpan(self.name, dict(self.attributes))
+
+
+class _IgnoredSpan(ContextDecorator):
+    '''Stands in for a Span when the request isn't being logged'''
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __call__(self, func):
+        return func
+
+
+IGNORED_SPAN = _IgnoredSpan()
+
+
+def current_buffer():
+    '''The buffer of the request being handled, or None if it isn't being logged'''
+    return _current_buffer.get()
+
+
+def log(message):
+    '''Add a log to the current request, the same as request.add_log
+
+    Does nothing if there is no request being logged, so is safe to call from anywhere.
+    '''
+    buffer = _current_buffer.get()
+    if buffer is not None:
+        buffer.add_log(message)
+
+
+def span(name, **attributes):
+    '''Time a block of code in the current request, the same as request.span
+
+    Can be used as a decorator on any function, including at import time.
+    '''
+    return _CurrentRequestSpan(name, attributes)
+
+
+def ignore_log(message):
+    pass
+
+
+def ignore_span(name, **attributes):
+    return IGNORED_SPAN
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+from django.db import router
+
+from .conf import get_setting
+from .routers import O11yRouter
+
+
+@register()
+def check_o11y_database(app_configs, **kwargs):
+    alias = get_setting('O11Y_DATABASE')
+    if alias is None:
+        return []
+
+    errors = []
+    if alias not in settings.DATABASES:
+        errors.append(Error(
+            f'O11Y_DATABASE is set to {alias!r}, which is not in DATABASES.',
+            id='db_o11y.E001',
+        ))
+    elif settings.DATABASES[alias].get('ATOMIC_REQUESTS'):
+        errors.append(Warning(
+            f'ATOMIC_REQUESTS is enabled for the O11Y_DATABASE {alias!r}.',
+            hint='Logs for failed requests will be rolled back. Disable ATOMIC_REQUESTS for it.',
+            id='db_o11y.W001',
+        ))
+
+    if not any(isinstance(r, O11yRouter) for r in router.routers):
+        errors.append(Warning(
+            'O11Y_DATABASE is set, but O11yRouter is not installed so it has no effect.',
+            hint="Add 'db_o11y.routers.O11yRouter' to DATABASE_ROUTERS.",
+            id='db_o11y.W002',
+        ))
+    return errors
@@ -0,0 +1,111 @@
+from django.conf import settings
+
+
+# Every setting the app reads, along with its default. Projects override any of these by
+# defining the same name in their settings.py.
+DEFAULTS = {
+    # Buffered writer - see db_o11y.writer
+    'O11Y_BUFFERED_WRITES': False,
+    'O11Y_BUFFER_MAX_SIZE': 10000,
+    'O11Y_BUFFER_BATCH_SIZE': 500,
+    'O11Y_BUFFER_FLUSH_INTERVAL': 1.0,
+    'O11Y_BUFFER_FULL_POLICY': 'drop',
+    'O11Y_BUFFER_BLOCK_TIMEOUT': 0.1,
+
+    # Spool files - see db_o11y.spool. Takes priority over O11Y_BUFFERED_WRITES when set
+    'O11Y_SPOOL_DIR': None,
+    'O11Y_SPOOL_MAX_BYTES': 64 * 1024 * 1024,
+
+    # Separate database - see db_o11y.routers
+    'O11Y_DATABASE': None,
+    'O11Y_SQLITE_WAL': True,
+
+    # Per-request log buffer - see db_o11y.buffer.RequestBuffer. None means no limit
+    'O11Y_LOG_KEEP_FIRST': 500,
+    'O11Y_LOG_KEEP_LAST': 500,
+    'O11Y_LOG_MAX_BYTES': 256 * 1024,
+
+    # Payload capture - see db_o11y.payloads. None means no limit
+    'O11Y_PAYLOAD_MAX_BYTES': 64 * 1024,
+    'O11Y_PAYLOAD_PARSE_MAX_BYTES': 16 * 1024,
+
+    # Side table for the heavy O11yLog columns - see db_o11y.storage
+    'O11Y_DETAIL_TABLE': False,
+
+    # Compression of the heavy O11yLog columns - see db_o11y.fields
+    'O11Y_COMPRESS': False,
+    'O11Y_COMPRESS_LEVEL': 6,
+    'O11Y_COMPRESS_MIN_BYTES': 1024,
+
+    # Query instrumentation - see db_o11y.queries
+    'O11Y_LOG_QUERIES': False,
+    'O11Y_SLOWEST_QUERIES': 5,
+    'O11Y_REPEATED_QUERY_THRESHOLD': 5,
+
+    # Memory instrumentation - see db_o11y.memory
+    'O11Y_LOG_MEMORY': False,
+    'O11Y_MEMORY_SAMPLE_RATE': 0.1,
+    'O11Y_MEMORY_TOP_THRESHOLD': 10 * 1024 * 1024,
+    'O11Y_MEMORY_TOP_SITES': 10,
+
+    # Sampling profiler - see db_o11y.profiler. Interval and threshold in seconds
+    'O11Y_PROFILE': False,
+    'O11Y_PROFILE_INTERVAL': 0.005,
+    'O11Y_PROFILE_THRESHOLD': 1.0,
+    'O11Y_PROFILE_MAX_STACKS': 200,
+
+    # Prometheus metrics - see db_o11y.metrics. Without a directory, each process only reports
+    # its own requests
+    'O11Y_METRICS': False,
+    'O11Y_METRICS_DIR': None,
+    'O11Y_METRICS_TOKEN': None,
+
+    # Latency baselines and anomalies - see db_o11y.baselines. Durations in seconds
+    'O11Y_BASELINES': False,
+    'O11Y_BASELINE_ALPHA': 0.05,
+    'O11Y_BASELINE_MIN_REQUESTS': 50,
+    'O11Y_ANOMALY_FACTOR': 3.0,
+    'O11Y_ANOMALY_STDDEVS': 3.0,
+    'O11Y_ANOMALY_MIN_DURATION': 0.1,
+
+    # Middleware - see db_o11y.middleware
+    'O11Y_MIDDLEWARE_INCLUDE': [],
+    'O11Y_MIDDLEWARE_EXCLUDE': [],
+    'O11Y_MIDDLEWARE_LOG_INPUTS': False,
+    'O11Y_MIDDLEWARE_LOG_OUTPUTS': False,
+
+    # Sampling - see db_o11y.sampling. O11Y_SAMPLE_RATES patterns match request.path_info
+    'O11Y_SAMPLE_RATE': 1.0,
+    'O11Y_SAMPLE_RATES': {},
+    'O11Y_TAIL_KEEP_ERRORS': True,
+    'O11Y_TAIL_SLOW_THRESHOLD': None,
+    'O11Y_TAIL_KEEP_ANOMALOUS': True,
+
+    # Retention - see the o11y_prune management command
+    'O11Y_RETENTION_DAYS': 30,
+    'O11Y_RETENTION_DAYS_BY_STATUS': {},
+
+    # Admin - see db_o11y.admin
+    'O11Y_ADMIN_HIGH_VOLUME': False,
+    'O11Y_ADMIN_COUNT_LIMIT': 10000,
+    'O11Y_ADMIN_FILTER_CACHE_TIMEOUT': 300,
+    'O11Y_ADMIN_FILTER_SAMPLE_SIZE': 100000,
+    'O11Y_ADMIN_FILTER_MAX_CHOICES': 50,
+
+    # Query API - see db_o11y.api. Windows and buckets in seconds
+    'O11Y_API_TOKEN': None,
+    'O11Y_API_CACHE_BUCKET': 10,
+    'O11Y_API_DEFAULT_WINDOW': 3600,
+    'O11Y_API_MAX_WINDOW': 7 * 24 * 3600,
+
+    # Rollups - see db_o11y.rollup. One of 'minute' or 'hour'
+    'O11Y_ROLLUP_BUCKET': 'hour',
+}
+
+
+def get_setting(name):
+    '''Read a setting from the Django settings, falling back to the app default
+
+    Looked up on every call rather than cached so that override_settings works in tests.
+    '''
+    return getattr(settings, name, DEFAULTS[name])
@@ -0,0 +1,152 @@
+from datetime import timedelta
+import hashlib
+import re
+import traceback
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import O11yException, O11yLog
+
+
+_FRAME = re.compile(r'^\s*File "(?P<file>[^"]+)", line \d+, in (?P<function>.+)$', re.MULTILINE)
+
+
+def fingerprint_exception(exc):
+    '''Fingerprint, exception type and summary of an exception, as it is caught
+
+    The fingerprint covers the exception type and the file and function of every frame - of the
+    exception and any it was raised from or while handling - but not the message or line
+    numbers, which vary between occurrences of the same error. Paths are taken from
+    site-packages onwards, so the same library gives the same fingerprint wherever it is
+    installed. The summary is the exception's type and message, however many lines it has.
+    '''
+    exception_type = _type_name(type(exc))
+    frames = [
+        (frame.filename, frame.name)
+        for chained in _chain(exc)
+        for frame in traceback.extract_tb(chained.__traceback__)
+    ]
+    summary = ''.join(traceback.format_exception_only(type(exc), exc)).rstrip()
+    return _fingerprint(exception_type, frames), exception_type, summary
+
+
+def fingerprint_traceback(traceback_text):
+    '''fingerprint_exception for a traceback which has already been formatted, e.g. one loaded
+    by o11y_ingest
+
+    The summary is everything after the last frame, less its indented source lines, so messages
+    spanning several lines are kept whole.
+    '''
+    matches = list(_FRAME.finditer(traceback_text))
+    rest = traceback_text[matches[-1].end():] if matches else traceback_text
+    lines = [line for line in rest.strip('\n').splitlines() if line and not line[0].isspace()]
+    if not lines:
+        # nothing unindented after the last frame - fall back to its last line
+        lines = traceback_text.rstrip().splitlines()[-1:]
+    summary = '\n'.join(lines)
+    exception_type = summary.partition(':')[0].strip()
+    frames = [(match['file'], match['function']) for match in matches]
+    return _fingerprint(exception_type, frames), exception_type, summary
+
+
+def _fingerprint(exception_type, frames):
+    key = [exception_type] + [
+        f"{filename.rpartition('site-packages/')[2]}:{function}" for filename, function in frames
+    ]
+    return hashlib.sha1('\n'.join(key).encode()).hexdigest()
+
+
+def _type_name(cls):
+    # as the traceback module prints it
+    if cls.__module__ in ('builtins', '__main__'):
+        return cls.__qualname__
+    return f'{cls.__module__}.{cls.__qualname__}'
+
+
+def _chain(exc):
+    '''The exception and those it was raised from or while handling, oldest first, as printed'''
+    chain = []
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        chain.append(exc)
+        if exc.__cause__ is not None:
+            exc = exc.__cause__
+        elif not exc.__suppress_context__:
+            exc = exc.__context__
+        else:
+            exc = None
+    return reversed(chain)
+
+
+def group_exceptions(logs):
+    '''Link each log with an exception to its O11yException, before the logs are written
+
+    The groups' counts and first / last seen times are updated in place by the database, so
+    concurrent writers never lose an update. The log's exception is cut down to the exception's
+    type and message - the traceback itself is only stored on the group.
+
+    Logs whose exception was fingerprinted when it was caught (see db_o11y.utils) use that;
+    others, such as those loaded from spool files, have their traceback text parsed instead.
+    '''
+    groups = {}
+    for log in logs:
+        if not log.exception or log.exception_group_id is not None:
+            continue
+        fingerprint = getattr(log, '_exception_fingerprint', None)
+        key, exception_type, summary = fingerprint or fingerprint_traceback(log.exception)
+        if key not in groups:
+            groups[key] = (exception_type, log.exception, [])
+        groups[key][2].append(log)
+        log.exception_group_id = key
+        log.exception = summary
+
+    if not groups:
+        return
+
+    using = router.db_for_write(O11yException)
+    with transaction.atomic(using=using):
+        for key, (exception_type, traceback_text, group_logs) in groups.items():
+            _record(using, key, exception_type, traceback_text, group_logs)
+
+
+def _record(using, key, exception_type, traceback_text, logs):
+    seen = [log.created_at for log in logs]
+    updates = {
+        'count': F('count') + len(logs),
+        'first_seen': Least('first_seen', min(seen)),
+        'last_seen': Greatest('last_seen', max(seen)),
+    }
+    if O11yException.objects.using(using).filter(fingerprint=key).update(**updates):
+        return
+    try:
+        # a savepoint, so that losing the race to create the group doesn't break the transaction
+        with transaction.atomic(using=using):
+            O11yException.objects.using(using).create(
+                fingerprint=key, exception_type=exception_type[:255], traceback=traceback_text,
+                count=len(logs), first_seen=min(seen), last_seen=max(seen),
+            )
+    except IntegrityError:
+        O11yException.objects.using(using).filter(fingerprint=key).update(**updates)
+
+
+def top_exceptions(since=None, limit=10):
+    '''The exceptions raised most often since `since` (default the last hour), most frequent
+    first, as (O11yException, count) pairs
+
+    Counted from O11yLog by its (exception_group, created_at) index.
+    '''
+    if since is None:
+        since = timezone.now() - timedelta(hours=1)
+    counts = list(
+        O11yLog.objects
+        .filter(created_at__gte=since, exception_group__isnull=False)
+        .values_list('exception_group')
+        .annotate(n=Count('id'))
+        .order_by('-n')[:limit]
+    )
+    groups = O11yException.objects.in_bulk([key for key, _ in counts])
+    return [(groups[key], n) for key, n in counts if key in groups]
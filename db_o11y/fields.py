@@ -0,0 +1,80 @@
+import base64
+import json
+import zlib
+
+from django.db import models
+from django.db.models.expressions import BaseExpression
+
+from .conf import get_setting
+
+
+# prefix of a compressed value in a text column
+TEXT_MARKER = 'zlib:'
+# only key of the object which holds a compressed value in a JSON column
+JSON_MARKER = '__o11y_zlib__'
+
+
+def compress(text, level=None):
+    '''zlib-compress text, returning it as base64 so that it fits a text or JSON column'''
+    if level is None:
+        level = get_setting('O11Y_COMPRESS_LEVEL')
+    return base64.b64encode(zlib.compress(text.encode('utf-8'), level)).decode('ascii')
+
+
+def decompress(value):
+    return zlib.decompress(base64.b64decode(value)).decode('utf-8')
+
+
+def _should_compress(text, force=False):
+    if force:
+        return True
+    if not get_setting('O11Y_COMPRESS'):
+        return False
+    size = len(text) if text.isascii() else len(text.encode('utf-8'))
+    return size >= get_setting('O11Y_COMPRESS_MIN_BYTES')
+
+
+class CompressedTextField(models.TextField):
+    '''TextField which is zlib-compressed when saved, if O11Y_COMPRESS is enabled
+
+    Values shorter than O11Y_COMPRESS_MIN_BYTES are stored as they are. Compressed values are
+    stored as TEXT_MARKER followed by base64, and decompressed when loaded, so the column holds
+    a mix of both and compression can be turned on and off at any time. Values which happen to
+    start with the marker are always compressed, so that they are never mistaken for one.
+    '''
+
+    def from_db_value(self, value, expression, connection):
+        if isinstance(value, str) and value.startswith(TEXT_MARKER):
+            return decompress(value[len(TEXT_MARKER):])
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        if isinstance(value, str) and _should_compress(value, value.startswith(TEXT_MARKER)):
+            value = TEXT_MARKER + compress(value)
+        return super().get_db_prep_save(value, connection)
+
+
+class CompressedJSONField(models.JSONField):
+    '''JSONField which is zlib-compressed when saved, if O11Y_COMPRESS is enabled
+
+    Compressed values are stored as {JSON_MARKER: base64}, so the column type is unchanged and
+    still holds valid JSON. As for CompressedTextField, small values are left as they are and
+    values are decompressed when loaded. Lookups into compressed values don't match.
+    '''
+
+    def from_db_value(self, value, expression, connection):
+        value = super().from_db_value(value, expression, connection)
+        if _is_compressed(value):
+            return json.loads(decompress(value[JSON_MARKER]), cls=self.decoder)
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        if value is not None and not isinstance(value, BaseExpression):
+            text = json.dumps(value, cls=self.encoder)
+            if _should_compress(text, _is_compressed(value)):
+                value = {JSON_MARKER: compress(text)}
+        return super().get_db_prep_save(value, connection)
+
+
+def _is_compressed(value):
+    return isinstance(value, dict) and len(value) == 1 and isinstance(value.get(JSON_MARKER), str)
@@ -0,0 +1,28 @@
+import logging
+
+from .buffer import current_buffer
+
+
+class O11yLogHandler(logging.Handler):
+    '''Sends standard library logging records to the logs of the request being handled
+
+    Records emitted outside a logged request - including requests which were not sampled - are
+    dropped before they are formatted, so only the logger's own level check is paid for them.
+
+        LOGGING = {
+            ...
+            'handlers': {
+                'o11y': {'class': 'db_o11y.handlers.O11yLogHandler', 'level': 'INFO'},
+            },
+            'root': {'handlers': ['o11y']},
+        }
+    '''
+
+    def emit(self, record):
+        buffer = current_buffer()
+        if buffer is None:
+            return
+        try:
+            buffer.add_log(self.format(record))
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,120 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from db_o11y.benchmark import compare, run_all, scenarios
+from db_o11y.models import O11yLog
+
+
+IO_MODES = {
+    'none': (False, False),
+    'inputs': (True, False),
+    'outputs': (False, True),
+    'both': (True, True),
+}
+
+
+class Command(BaseCommand):
+    help = '''Measure the overhead auto_log adds to each request
+
+    Runs every combination of the options against the configured database (e.g. SQLite locally)
+    and reports the p50 / p99 latency auto_log adds, requests per second with and without it,
+    and the extra memory allocated per request. --output writes the full results as JSON, and
+    --compare prints how the overhead changed since an earlier run.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per measurement')
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument(
+            '--allocation-requests', type=int, default=50,
+            help='Requests to measure allocations over, 0 to skip',
+        )
+        parser.add_argument(
+            '--views', default='synthetic,html,json',
+            help='Comma-separated: synthetic, html, json, json-put',
+        )
+        parser.add_argument('--logs', default='0,10,100', help='Log counts for the synthetic view')
+        parser.add_argument(
+            '--payload-bytes', default='0,1024,65536', help='Payload sizes for the synthetic view',
+        )
+        parser.add_argument(
+            '--io', default='none,both', help=f'auto_log payload logging: {", ".join(IO_MODES)}',
+        )
+        parser.add_argument('--concurrency', default='1,4', help='Threads making requests')
+        parser.add_argument('--output', default=None, help='File to write the JSON results to')
+        parser.add_argument('--compare', default=None, help='JSON results of an earlier run')
+        parser.add_argument(
+            '--keep-logs', action='store_true', help="Don't delete the logs written by the run",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            O11yLog.objects.exists()
+        except DatabaseError as e:
+            raise CommandError(f'Cannot read O11yLog - has the database been migrated? ({e})')
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        try:
+            io_modes = [IO_MODES[mode] for mode in _split(options['io'])]
+            report = run_all(
+                scenarios(
+                    _split(options['views']),
+                    [int(n) for n in _split(options['logs'])],
+                    [int(n) for n in _split(options['payload_bytes'])],
+                    io_modes,
+                    [int(n) for n in _split(options['concurrency'])],
+                ),
+                requests=options['requests'],
+                warmup=options['warmup'],
+                allocation_requests=options['allocation_requests'],
+                keep_logs=options['keep_logs'],
+            )
+        except (KeyError, ValueError) as e:
+            raise CommandError(f'Invalid option: {e}')
+
+        for result in report['results']:
+            self.stdout.write(_format(result))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
+
+        if previous is not None:
+            for scenario, key, old, new in compare(previous, report):
+                change = f'{(new - old) / old * 100:+.0f}%' if old > 0 else ''
+                self.stdout.write(
+                    f'{_label(scenario.as_dict())} {key}: '
+                    f'{old * 1e6:.0f}us -> {new * 1e6:.0f}us {change}'
+                )
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _label(result):
+    io = [name for name in ('inputs', 'outputs') if result[f'log_{name}']]
+    return (
+        f"{result['view']} logs={result['log_count']} payload={result['payload_bytes']} "
+        f"io={'+'.join(io) or 'none'} threads={result['concurrency']}"
+    )
+
+
+def _format(result):
+    overhead = result['overhead']
+    line = (
+        f"{_label(result)}: {overhead['p50'] * 1e6:+.0f}us p50, "
+        f"{overhead['p99'] * 1e6:+.0f}us p99, "
+        f"{result['baseline']['requests_per_second']:.0f} -> "
+        f"{result['auto_log']['requests_per_second']:.0f} req/s"
+    )
+    if 'peak_bytes' in overhead:
+        line += f", {overhead['peak_bytes'] / 1024:+.1f}KB peak"
+    return line
@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import Max, Min, Sum, TextField
+from django.db.models.functions import Cast, Coalesce, Length
+
+from db_o11y.conf import get_setting
+from db_o11y.fields import CompressedJSONField, CompressedTextField
+from db_o11y.models import O11yLog, O11yLogDetail
+
+
+class Command(BaseCommand):
+    help = '''Rewrite existing O11yLog and O11yLogDetail rows so that their heavy columns are
+    stored according to the current O11Y_COMPRESS settings
+
+    With O11Y_COMPRESS enabled this compresses rows written before it was; with it disabled it
+    decompresses them again. Rows are rewritten in primary key ranges of --chunk-size, each in
+    its own transaction, and the size of the columns before and after is reported.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument(
+            '--sleep', type=float, default=0.1, help='Seconds to wait between chunks',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        state = 'compressed' if get_setting('O11Y_COMPRESS') else 'uncompressed'
+        t0 = time.monotonic()
+        rows = before = after = 0
+        for model in (O11yLog, O11yLogDetail):
+            model_rows, model_before, model_after = self._rewrite(model, options)
+            rows += model_rows
+            before += model_before
+            after += model_after
+
+        ratio = before / after if after else 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Rewrote {rows} rows as {state} in {time.monotonic() - t0:.2f}s: '
+            f'{before} -> {after} characters ({ratio:.2f}x)'
+        ))
+
+    def _rewrite(self, model, options):
+        fields = [
+            field.name for field in model._meta.concrete_fields
+            if isinstance(field, (CompressedJSONField, CompressedTextField))
+        ]
+        pk = model._meta.pk.name
+        bounds = model.objects.aggregate(lo=Min('pk'), hi=Max('pk'))
+        if bounds['lo'] is None:
+            return 0, 0, 0
+
+        rows = before = after = 0
+        lo = bounds['lo']
+        while lo <= bounds['hi']:
+            chunk = model.objects.filter(pk__gte=lo, pk__lt=lo + options['chunk_size'])
+            with transaction.atomic(using=router.db_for_write(model)):
+                objs = list(chunk.only(pk, *fields))
+                before += _stored_size(chunk, fields)
+                model.objects.bulk_update(objs, fields)
+                after += _stored_size(chunk, fields)
+            rows += len(objs)
+            lo += options['chunk_size']
+            if options['sleep'] and lo <= bounds['hi']:
+                time.sleep(options['sleep'])
+        return rows, before, after
+
+
+def _stored_size(queryset, fields):
+    '''Total length of the fields as stored, measured by the database'''
+    sizes = {
+        name: Coalesce(Length(Cast(name, output_field=TextField())), 0) for name in fields
+    }
+    return sum(value or 0 for value in queryset.aggregate(
+        **{f'{name}_size': Sum(size) for name, size in sizes.items()}
+    ).values())
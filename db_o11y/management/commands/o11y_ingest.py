@@ -0,0 +1,118 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from db_o11y.conf import get_setting
+from db_o11y.models import O11yHighWaterMark, O11yLog
+from db_o11y.spool import ACTIVE_SUFFIX, COMPLETE_SUFFIX, deserialize, is_abandoned
+from db_o11y.storage import write_logs
+
+
+class Command(BaseCommand):
+    help = '''Load spooled logs (see O11Y_SPOOL_DIR) into the database
+
+    Files are streamed in batches of --batch-size lines. The byte offset reached in each file is
+    saved in the same transaction as each batch, so an interrupted ingest resumes exactly where
+    it stopped without duplicating or losing logs. Files still being written are read up to their
+    last complete line, and files are deleted once they are complete and fully loaded. A file
+    still being written is only treated as complete once the process writing it has gone.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool-dir', default=None, help='Default O11Y_SPOOL_DIR')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--stale-after', type=float, default=3600,
+            help='Treat files left behind by a process which has exited (e.g. was killed) as '
+                 'complete once unchanged for this many seconds',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['spool_dir'] or get_setting('O11Y_SPOOL_DIR')
+        if not directory:
+            raise CommandError('No spool directory - set O11Y_SPOOL_DIR or pass --spool-dir')
+        if not os.path.isdir(directory):
+            self.stdout.write(f'Spool directory {directory} does not exist')
+            return
+
+        t0 = time.monotonic()
+        loaded = skipped = 0
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith((ACTIVE_SUFFIX, COMPLETE_SUFFIX)):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                file_loaded, file_skipped = self._ingest_file(path, options)
+            except FileNotFoundError:
+                # rotated or removed by another ingest since it was listed. A rotated file is
+                # loaded under its new name, from the same offset, by the next run
+                continue
+            loaded += file_loaded
+            skipped += file_skipped
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(f'Skipped {skipped} malformed lines'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {loaded} logs in {time.monotonic() - t0:.2f}s'
+        ))
+
+    def _ingest_file(self, path, options):
+        loaded = skipped = 0
+        # opened first, so that no offset is saved for a file which has already gone
+        with open(path, 'rb') as f:
+            mark, _ = O11yHighWaterMark.objects.get_or_create(name=f'spool:{_stem(path)}')
+            f.seek(mark.last_id)
+            while True:
+                lines, offset = _read_lines(f, options['batch_size'])
+                if not lines:
+                    break
+
+                logs = []
+                for line in lines:
+                    try:
+                        logs.append(deserialize(json.loads(line)))
+                    except (ValueError, TypeError):
+                        skipped += 1
+
+                with transaction.atomic(using=router.db_for_write(O11yLog)):
+                    write_logs(logs)
+                    mark.last_id = offset
+                    mark.save(update_fields=['last_id'])
+                loaded += len(logs)
+
+        complete = path.endswith(COMPLETE_SUFFIX) or (
+            time.time() - os.path.getmtime(path) > options['stale_after'] and is_abandoned(path)
+        )
+        if complete and mark.last_id >= os.path.getsize(path):
+            os.remove(path)
+            mark.delete()
+        return loaded, skipped
+
+
+def _read_lines(f, batch_size):
+    '''Read up to batch_size complete lines, returning them and the offset after the last one
+
+    A trailing line without a newline is still being written, so is left for the next run.
+    '''
+    lines = []
+    offset = f.tell()
+    while len(lines) < batch_size:
+        line = f.readline()
+        if not line.endswith(b'\n'):
+            f.seek(offset)
+            break
+        offset = f.tell()
+        if line.strip():
+            lines.append(line)
+    return lines, offset
+
+
+def _stem(path):
+    name = os.path.basename(path)
+    for suffix in (ACTIVE_SUFFIX, COMPLETE_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
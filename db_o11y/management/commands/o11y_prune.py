@@ -0,0 +1,140 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from db_o11y.conf import get_setting
+from db_o11y.models import O11yException, O11yLog, O11yLogDetail
+
+
+STATUS_CLASSES = {
+    '1xx': (100, 200),
+    '2xx': (200, 300),
+    '3xx': (300, 400),
+    '4xx': (400, 500),
+    '5xx': (500, 600),
+}
+
+
+class Command(BaseCommand):
+    help = '''Delete O11yLog rows older than the retention period
+
+    Rows are deleted in primary key ranges of --chunk-size with a plain DELETE, so neither
+    memory use nor lock duration grows with the size of the table. Retention defaults to
+    O11Y_RETENTION_DAYS, and can be set per response class with O11Y_RETENTION_DAYS_BY_STATUS
+    e.g. {'5xx': 90}. Exception groups not seen within the longest retention period are
+    deleted too.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=float, default=None,
+            help='Days to keep logs for (default O11Y_RETENTION_DAYS)',
+        )
+        parser.add_argument(
+            '--status-days', action='append', default=[], metavar='CLASS=DAYS',
+            help='Days to keep logs for a response class e.g. 5xx=90. Can be repeated',
+        )
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument(
+            '--sleep', type=float, default=0.1, help='Seconds to wait between chunks',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Count the rows that would be deleted',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        days = options['days']
+        if days is None:
+            days = get_setting('O11Y_RETENTION_DAYS')
+        status_days = dict(get_setting('O11Y_RETENTION_DAYS_BY_STATUS'))
+        status_days.update(_parse_status_days(options['status_days']))
+
+        total = 0
+        t0 = time.monotonic()
+        oldest_cutoff = None
+        for label, condition, cutoff in _retention_rules(days, status_days):
+            oldest_cutoff = cutoff if oldest_cutoff is None else min(oldest_cutoff, cutoff)
+            queryset = O11yLog.objects.filter(condition, created_at__lt=cutoff)
+            if options['dry_run']:
+                count = queryset.count()
+                self.stdout.write(f'{label}: would delete {count} logs older than {cutoff}')
+            else:
+                count = self._delete_in_chunks(queryset, options['chunk_size'], options['sleep'])
+                self.stdout.write(f'{label}: deleted {count} logs older than {cutoff}')
+            total += count
+
+        exceptions = O11yException.objects.filter(last_seen__lt=oldest_cutoff)
+        if options['dry_run']:
+            self.stdout.write(f'Would delete {exceptions.count()} exception groups')
+            self.stdout.write(self.style.SUCCESS(f'Would delete {total} logs'))
+            return
+        # few rows, and none of them still referenced by a log, so the collector is cheap here
+        deleted_exceptions, _ = exceptions.delete()
+        self.stdout.write(f'Deleted {deleted_exceptions} exception groups')
+
+        elapsed = time.monotonic() - t0
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {total} logs in {elapsed:.2f}s ({rate:.0f} rows/s)'
+        ))
+
+    def _delete_in_chunks(self, queryset, chunk_size, sleep):
+        bounds = queryset.aggregate(lo=Min('id'), hi=Max('id'))
+        if bounds['lo'] is None:
+            return 0
+
+        deleted = 0
+        lo = bounds['lo']
+        while lo <= bounds['hi']:
+            chunk = queryset.filter(id__gte=lo, id__lt=lo + chunk_size)
+            # _raw_delete skips the collector, so no objects are loaded and no signals are sent -
+            # but nor are the logs' O11yLogDetail rows deleted, so they are deleted first
+            with transaction.atomic(using=router.db_for_write(O11yLog)):
+                details = O11yLogDetail.objects.filter(
+                    log_id__gte=lo, log_id__lt=lo + chunk_size, log__in=chunk,
+                )
+                details._raw_delete(details.db)
+                deleted += chunk._raw_delete(chunk.db)
+            lo += chunk_size
+            if sleep and lo <= bounds['hi']:
+                time.sleep(sleep)
+        return deleted
+
+
+def _parse_status_days(values):
+    parsed = {}
+    for value in values:
+        label, _, days = value.partition('=')
+        if label not in STATUS_CLASSES or not days:
+            raise CommandError(f'Invalid --status-days value: {value}')
+        try:
+            parsed[label] = float(days)
+        except ValueError:
+            raise CommandError(f'Invalid --status-days value: {value}')
+    return parsed
+
+
+def _retention_rules(days, status_days):
+    '''Yield (label, condition, cutoff) for each retention rule
+
+    Every row falls under exactly one rule - rows in a response class with its own retention
+    are excluded from the default rule.
+    '''
+    now = timezone.now()
+    overridden = Q()
+    for label, days_for_status in status_days.items():
+        if label not in STATUS_CLASSES:
+            raise CommandError(f'Unknown response class: {label}')
+        lo, hi = STATUS_CLASSES[label]
+        condition = Q(response_code__gte=lo, response_code__lt=hi)
+        overridden |= condition
+        yield label, condition, now - timedelta(days=days_for_status)
+
+    yield 'default', ~overridden, now - timedelta(days=days)
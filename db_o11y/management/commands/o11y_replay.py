@@ -0,0 +1,145 @@
+from datetime import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from db_o11y.replay import replay, select_logs, summarise
+
+
+class Command(BaseCommand):
+    help = '''Replay logged requests against a server, as a load test
+
+    Rebuilds each selected O11yLog's request from its url, method and request_payload (so only
+    views logged with log_inputs=True are replayed with their data), sends them to base_url, and
+    reports the replayed latency percentiles next to the recorded ones, along with any requests
+    whose status code changed. Requests whose payload was truncated or binary are skipped.
+
+    Cookies and auth headers are not logged, so send any the target needs with --header.
+    Replaying writes to the target just as the original requests did - point it at a test
+    server, or use --method GET to only send reads.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='e.g. http://localhost:8000')
+        parser.add_argument('--route', default=None, help='Only logs for this route')
+        parser.add_argument(
+            '--method', action='append', default=None, dest='methods',
+            help='Only logs with this method. Can be given more than once',
+        )
+        parser.add_argument('--since', default=None, help='ISO 8601 date or time')
+        parser.add_argument('--until', default=None, help='ISO 8601 date or time')
+        parser.add_argument(
+            '--sample', type=float, default=None, help='Fraction of the matching logs to replay',
+        )
+        parser.add_argument('--seed', type=int, default=None, help='Seed for --sample')
+        parser.add_argument('--limit', type=int, default=None, help='Most requests to send')
+        parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight')
+        parser.add_argument('--rate', type=float, default=None, help='Most requests per second')
+        parser.add_argument(
+            '--speed', type=float, default=None,
+            help='Keep the original gaps between requests, divided by this e.g. 1 for real time',
+        )
+        parser.add_argument(
+            '--header', action='append', default=[], dest='headers',
+            help="'Name: value' to send with every request. Can be given more than once",
+        )
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds per request')
+        parser.add_argument('--output', default=None, help='File to write the JSON summary to')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        for name in ('rate', 'speed'):
+            if options[name] is not None and options[name] <= 0:
+                raise CommandError(f'--{name} must be positive')
+        if options['sample'] is not None and not 0 < options['sample'] <= 1:
+            raise CommandError('--sample must be between 0 and 1')
+
+        logs = select_logs(
+            route=options['route'],
+            methods=[method.upper() for method in options['methods'] or []],
+            since=_parse_time(options['since'], '--since'),
+            until=_parse_time(options['until'], '--until'),
+            sample=options['sample'],
+            limit=options['limit'],
+            seed=options['seed'],
+        )
+        results, skipped, elapsed = replay(
+            logs,
+            options['base_url'],
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            speed=options['speed'],
+            headers=_parse_headers(options['headers']),
+            timeout=options['timeout'],
+        )
+        summary = summarise(results, elapsed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Replayed {summary['requests']} requests in {elapsed:.2f}s "
+            f"({summary['requests_per_second'] or 0:.1f} req/s), skipped {skipped}"
+        ))
+        self.stdout.write('          recorded   replayed')
+        for key in ('p50', 'p95', 'p99'):
+            self.stdout.write(
+                f"{key:<8}{_ms(summary['recorded'][key]):>10}{_ms(summary['replayed'][key]):>11}"
+            )
+
+        for (recorded, replayed), count in summary['status_changes'].most_common():
+            self.stdout.write(self.style.WARNING(f'Status {recorded} -> {replayed}: {count}'))
+        for error, count in summary['errors'].most_common():
+            self.stdout.write(self.style.ERROR(f'Failed: {error}: {count}'))
+
+        if summary['slowest_routes']:
+            self.stdout.write('Slowest routes by replayed p95 (recorded -> replayed):')
+        for route, recorded, replayed, count in summary['slowest_routes']:
+            self.stdout.write(f'  {route or "-"}: {_ms(recorded)} -> {_ms(replayed)} ({count})')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(_serialisable(summary, skipped, elapsed), f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote summary to {options["output"]}'))
+
+
+def _parse_time(value, name):
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'{name} must be an ISO 8601 date or time')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _parse_headers(headers):
+    parsed = {}
+    for header in headers:
+        name, sep, value = header.partition(':')
+        if not sep or not name.strip():
+            raise CommandError(f"--header must look like 'Name: value', not {header!r}")
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def _ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.1f}ms'
+
+
+def _serialisable(summary, skipped, elapsed):
+    return {
+        **summary,
+        'skipped': skipped,
+        'elapsed': elapsed,
+        'errors': dict(summary['errors']),
+        'status_changes': [
+            {'recorded': recorded, 'replayed': replayed, 'count': count}
+            for (recorded, replayed), count in summary['status_changes'].items()
+        ],
+        'slowest_routes': [
+            {'route': route, 'recorded_p95': recorded, 'replayed_p95': replayed, 'count': count}
+            for route, recorded, replayed, count in summary['slowest_routes']
+        ],
+    }
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from db_o11y.rollup import rollup_new_logs
+
+
+class Command(BaseCommand):
+    help = '''Add any O11yLog rows not yet processed to the O11yRollup latency summaries
+
+    Resumes from the last id processed, so can be run as often as needed e.g. from cron.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument(
+            '--lag', type=float, default=60,
+            help='Leave logs created in the last LAG seconds for the next run',
+        )
+
+    def handle(self, *args, **options):
+        t0 = time.monotonic()
+        processed = rollup_new_logs(options['batch_size'], options['lag'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {processed} logs in {time.monotonic() - t0:.2f}s'
+        ))
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+import os
+import random
+import threading
+import tracemalloc
+
+from .conf import get_setting
+
+
+# tracemalloc is process-wide, so only one request is traced at a time - requests which are
+# sampled while another is being traced are skipped
+_tracing = threading.Lock()
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = None
+
+
+def memory_sampled(sample_rate=None):
+    if sample_rate is None:
+        sample_rate = get_setting('O11Y_MEMORY_SAMPLE_RATE')
+    return sample_rate >= 1 or random.random() < sample_rate
+
+
+@contextmanager
+def record_memory(log):
+    '''Trace the memory allocated inside the block, and store the results on the log's
+    memory_peak, memory_rss_delta and memory_top fields
+
+    memory_peak is the most memory allocated by Python at any point, above what was allocated
+    at the start. memory_rss_delta is the change in the process's resident set size, where the
+    platform reports it. If the peak is at least O11Y_MEMORY_TOP_THRESHOLD bytes, memory_top
+    lists the O11Y_MEMORY_TOP_SITES lines which allocated the most memory still held at the end.
+
+    Allocations by other threads and, for async views, other tasks running at the same time
+    are included.
+    '''
+    if not _tracing.acquire(blocking=False):
+        yield
+        return
+
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start()
+        rss_start = _rss()
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            rss_end = _rss()
+            log.memory_peak = max(peak - start, 0)
+            if rss_start is not None and rss_end is not None:
+                log.memory_rss_delta = rss_end - rss_start
+            if log.memory_peak >= get_setting('O11Y_MEMORY_TOP_THRESHOLD'):
+                log.memory_top = _top_sites(get_setting('O11Y_MEMORY_TOP_SITES'))
+    finally:
+        if started:
+            tracemalloc.stop()
+        _tracing.release()
+
+
+def _top_sites(limit):
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    return [
+        {
+            'site': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+            'size': stat.size,
+            'count': stat.count,
+        }
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+
+def _rss():
+    '''Resident set size of the process in bytes, or None if it can't be read'''
+    if _PAGE_SIZE is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
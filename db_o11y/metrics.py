@@ -0,0 +1,328 @@
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import glob
+import hmac
+import json
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+
+from .conf import get_setting
+from .rollup import LATENCY_BUCKETS
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LABELS = ('route', 'method', 'status')
+
+# the summed metrics of every worker which has exited - see mark_process_dead
+DEAD_FILE = 'o11y_metrics_dead.db'
+# held shared while collecting and exclusively while merging, so that a scrape never sees a
+# worker's counts twice or not at all
+LOCK_FILE = 'o11y_metrics.lock'
+
+# used bytes and number of latency buckets, at the start of every file
+_HEADER = struct.Struct('<II')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+class MetricsFile:
+    '''Request counts and latency histograms of one process, kept in a memory-mapped file
+
+    Each label set (route, method, status) is stored as its key followed by a block of doubles:
+    the request count, the sum of their durations, then the number of requests in each
+    LATENCY_BUCKETS bucket and the open-ended last one. New entries are written in full before
+    the used length in the header is moved past them, so other processes can read the file at
+    any time without a lock.
+
+    With no path the map is anonymous, and only seen by the process itself.
+    '''
+
+    def __init__(self, path=None, buckets=LATENCY_BUCKETS, initial_size=64 * 1024):
+        self.path = path
+        self.buckets = buckets
+        self.width = len(buckets) + 3
+        self._positions = {}
+        # only held for the handful of writes each request makes, and only contended by the
+        # threads of this process
+        self._lock = threading.Lock()
+
+        if path is None:
+            self._mmap = mmap.mmap(-1, initial_size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < initial_size:
+                    os.ftruncate(fd, initial_size)
+                self._mmap = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+
+        used, bucket_count = _HEADER.unpack_from(self._mmap, 0)
+        if used < _HEADER.size or bucket_count != len(buckets):
+            # new, or left by a version with other buckets
+            _HEADER.pack_into(self._mmap, 0, _HEADER.size, len(buckets))
+        else:
+            # left by an earlier process with the same pid - carry on from its counts
+            self._positions = {
+                labels: offset for labels, offset in _entries(self._mmap, self.width)
+            }
+
+    def observe(self, labels, duration):
+        '''Count one request with the given (route, method, status) labels'''
+        bucket = bisect_left(self.buckets, duration)
+        with self._lock:
+            offset = self._positions.get(labels)
+            if offset is None:
+                offset = self._add(labels)
+            data = self._mmap
+            _increment(data, offset, 1)
+            _increment(data, offset + _VALUE.size, duration)
+            _increment(data, offset + (2 + bucket) * _VALUE.size, 1)
+
+    def add(self, labels, values):
+        '''Add another file's [count, sum, bucket counts...] for the labels'''
+        with self._lock:
+            offset = self._positions.get(labels)
+            if offset is None:
+                offset = self._add(labels)
+            for i, value in enumerate(values):
+                _increment(self._mmap, offset + i * _VALUE.size, value)
+
+    def values(self):
+        '''{labels: [count, sum, bucket counts...]} of this process'''
+        return {
+            labels: _read_values(self._mmap, offset, self.width)
+            for labels, offset in _entries(self._mmap, self.width)
+        }
+
+    def close(self):
+        self._mmap.close()
+
+    def _add(self, labels):
+        key = json.dumps(labels).encode()
+        key_size = _padded(_KEY_LENGTH.size + len(key))
+        used, _ = _HEADER.unpack_from(self._mmap, 0)
+        end = used + key_size + self.width * _VALUE.size
+        if end > len(self._mmap):
+            self._mmap.resize(max(end, 2 * len(self._mmap)))
+
+        data = self._mmap
+        _KEY_LENGTH.pack_into(data, used, len(key))
+        data[used + _KEY_LENGTH.size:used + _KEY_LENGTH.size + len(key)] = key
+        offset = used + key_size
+        # the space may hold an entry from a file which was reset
+        data[offset:end] = bytes(end - offset)
+        _HEADER.pack_into(data, 0, end, len(self.buckets))
+        self._positions[labels] = offset
+        return offset
+
+
+def _padded(size):
+    # keeps the doubles 8-byte aligned, so that readers never see half of one written
+    return size + -size % 8
+
+
+def _entries(data, width):
+    '''(labels, offset of values) of every complete entry in a file'''
+    used, _ = _HEADER.unpack_from(data, 0)
+    position = _HEADER.size
+    while position < used:
+        (length,) = _KEY_LENGTH.unpack_from(data, position)
+        start = position + _KEY_LENGTH.size
+        labels = tuple(json.loads(bytes(data[start:start + length])))
+        offset = position + _padded(_KEY_LENGTH.size + length)
+        yield labels, offset
+        position = offset + width * _VALUE.size
+
+
+def _read_values(data, offset, width):
+    return list(struct.unpack_from(f'<{width}d', data, offset))
+
+
+def _increment(data, offset, amount):
+    (value,) = _VALUE.unpack_from(data, offset)
+    _VALUE.pack_into(data, offset, value + amount)
+
+
+_metrics = None
+_metrics_key = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    '''This process's MetricsFile, in O11Y_METRICS_DIR if set
+
+    Created on first use, and again in a forked child so that each worker has a file of its
+    own.
+    '''
+    global _metrics, _metrics_key
+    key = (os.getpid(), get_setting('O11Y_METRICS_DIR'))
+    if _metrics is None or _metrics_key != key:
+        with _metrics_lock:
+            if _metrics is None or _metrics_key != key:
+                pid, directory = key
+                path = None
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, f'o11y_metrics_{pid}.db')
+                    atexit.register(_exit, pid, directory)
+                _metrics = MetricsFile(path)
+                _metrics_key = key
+    return _metrics
+
+
+def _exit(pid, directory):
+    # forked children inherit the handler, but their files are their own
+    if os.getpid() == pid and os.path.isdir(directory):
+        try:
+            mark_process_dead(pid, directory)
+        except OSError:
+            pass
+
+
+def mark_process_dead(pid, directory=None):
+    '''Fold the metrics of a worker which has exited into DEAD_FILE, and delete its file
+
+    Workers do this themselves when they exit normally. For those which are killed, call it
+    from the server's hook for exited workers e.g. gunicorn's child_exit. Returns whether there
+    was a file to fold in.
+    '''
+    directory = directory or get_setting('O11Y_METRICS_DIR')
+    path = os.path.join(directory, f'o11y_metrics_{pid}.db')
+    with _directory_lock(directory, exclusive=True):
+        data = _read_file(path)
+        if data is None:
+            return False
+        if data:
+            dead = MetricsFile(os.path.join(directory, DEAD_FILE))
+            try:
+                width = len(LATENCY_BUCKETS) + 3
+                for labels, offset in _entries(data, width):
+                    dead.add(labels, _read_values(data, offset, width))
+            finally:
+                dead.close()
+        os.remove(path)
+    return True
+
+
+def record_request(route, method, status, duration):
+    '''Count a request in the metrics of this process'''
+    get_metrics().observe((route or '', method, str(status)), duration)
+
+
+def collect(directory=None):
+    '''{labels: [count, sum, bucket counts...]} summed over every process writing to directory
+
+    Workers which have exited are included, via DEAD_FILE, so that counters never go backwards.
+    With no directory, only this process's metrics are returned.
+    '''
+    if not directory:
+        return get_metrics().values()
+
+    width = len(LATENCY_BUCKETS) + 3
+    totals = {}
+    with _directory_lock(directory, exclusive=False):
+        for path in sorted(glob.glob(os.path.join(directory, 'o11y_metrics_*.db'))):
+            data = _read_file(path)
+            if not data:
+                continue
+            for labels, offset in _entries(data, width):
+                values = _read_values(data, offset, width)
+                total = totals.setdefault(labels, [0] * width)
+                for i, value in enumerate(values):
+                    total[i] += value
+    return totals
+
+
+def _read_file(path):
+    '''The contents of a metrics file, b'' if it is unusable, or None if it doesn't exist'''
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return b''
+    if len(data) < _HEADER.size or _HEADER.unpack_from(data, 0)[1] != len(LATENCY_BUCKETS):
+        return b''
+    return data
+
+
+@contextmanager
+def _directory_lock(directory, exclusive):
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+
+def render(totals, buckets=LATENCY_BUCKETS):
+    '''Metrics in the Prometheus text exposition format'''
+    lines = [
+        '# HELP o11y_requests_total Requests handled by auto_log views.',
+        '# TYPE o11y_requests_total counter',
+    ]
+    ordered = sorted(totals.items())
+    for labels, values in ordered:
+        lines.append(f'o11y_requests_total{{{_labels(labels)}}} {_number(values[0])}')
+
+    name = 'o11y_request_duration_seconds'
+    lines += [
+        f'# HELP {name} Time taken by auto_log views.',
+        f'# TYPE {name} histogram',
+    ]
+    edges = [_number(edge) for edge in buckets] + ['+Inf']
+    for labels, values in ordered:
+        cumulative = 0
+        for edge, count in zip(edges, values[2:]):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{_labels(labels)},le="{edge}"}} {_number(cumulative)}')
+        lines.append(f'{name}_sum{{{_labels(labels)}}} {_number(values[1])}')
+        lines.append(f'{name}_count{{{_labels(labels)}}} {_number(values[0])}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(LABELS, labels))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+@require_GET
+def metrics_view(request):
+    '''The metrics of every worker, for Prometheus to scrape. Never touches the database
+
+    If O11Y_METRICS_TOKEN is set, requests must send it as a bearer token.
+    '''
+    token = get_setting('O11Y_METRICS_TOKEN')
+    if token:
+        header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(header.encode(), f'Bearer {token}'.encode()):
+            return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(
+        render(collect(get_setting('O11Y_METRICS_DIR'))), content_type=CONTENT_TYPE,
+    )
@@ -0,0 +1,69 @@
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .conf import get_setting
+from .buffer import ignore_log, ignore_span
+from .utils import auto_log, _is_logging, _record_exception
+
+
+class O11yMiddleware:
+    '''Logs every request, exactly as if each view had been decorated with auto_log
+
+    Which requests are logged is controlled by two lists of regular expressions, matched against
+    the start of request.path_info:
+    * O11Y_MIDDLEWARE_INCLUDE - if set, only matching paths are logged
+    * O11Y_MIDDLEWARE_EXCLUDE - matching paths are never logged e.g. static files, health checks
+
+    Both are compiled once, when Django builds the middleware chain at startup, into a single
+    regex each so that skipped requests cost one or two regex matches and never touch the DB.
+
+    Should be placed after SessionMiddleware so that the session id is available.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.include = _compile_patterns(get_setting('O11Y_MIDDLEWARE_INCLUDE'))
+        self.exclude = _compile_patterns(get_setting('O11Y_MIDDLEWARE_EXCLUDE'))
+
+        # exceptions from the view are already converted to responses by Django before they get
+        # here, so they are picked up by process_exception instead
+        self.logged_get_response = auto_log(
+            log_inputs=get_setting('O11Y_MIDDLEWARE_LOG_INPUTS'),
+            log_outputs=get_setting('O11Y_MIDDLEWARE_LOG_OUTPUTS'),
+            catch_exceptions=False,
+        )(get_response)
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        # for async get_response, both branches return a coroutine for Django to await
+        if self.should_log(request.path_info):
+            return self.logged_get_response(request)
+
+        # views may still call add_log, so they must not break when their path is skipped
+        request.add_log = ignore_log
+        request.span = ignore_span
+        return self.get_response(request)
+
+    def should_log(self, path):
+        if self.include is not None and not self.include.match(path):
+            return False
+        if self.exclude is not None and self.exclude.match(path):
+            return False
+        return True
+
+    def process_exception(self, request, exception):
+        if _is_logging(request):
+            _record_exception(request._o11y_log, exception)
+        # let Django carry on and build the error response
+        return None
+
+
+def _compile_patterns(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
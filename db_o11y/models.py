@@ -1,22 +1,155 @@
 from django.db import models
+from django.utils import timezone
+
+from .fields import CompressedJSONField, CompressedTextField
+
+
+class O11yException(models.Model):
+    '''One kind of exception, shared by every log which raised it
+
+    Exceptions are grouped by fingerprint - the exception type and the file and function of each
+    frame, so the same error from the same place is one group whatever its message or line
+    numbers. The traceback is stored here once, and count / first_seen / last_seen are kept up to
+    date as logs are written - see db_o11y.errors.
+    '''
+    fingerprint = models.CharField(max_length=40, primary_key=True)
+    exception_type = models.CharField(max_length=255)
+    # the traceback of the first log in the group
+    traceback = models.TextField()
+    count = models.PositiveBigIntegerField(default=0)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_seen'], name='o11yexception_last_seen_idx'),
+        ]
+
+    def __str__(self):
+        return f'O11y Exception: {self.exception_type} ({self.fingerprint[:8]})'
 
 
 class O11yLog(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so that logs written later (buffered or spooled) keep their original time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     url = models.CharField(max_length=500)
+    # the URL pattern that matched e.g. /orders/<int:pk>/ - unlike url this has low cardinality
+    route = models.CharField(max_length=500, null=True, blank=True)
     method = models.CharField(max_length=20)
     session_id = models.CharField(max_length=50, null=True, blank=True)
 
     request_start = models.DateTimeField(null=True, blank=True)
     request_end = models.DateTimeField(null=True, blank=True)
     duration = models.FloatField(null=True, blank=True)
+    # slower than usual for its route, with O11Y_BASELINES enabled - see db_o11y.baselines
+    anomalous = models.BooleanField(default=False)
 
-    request_payload = models.JSONField(null=True, blank=True)
+    # the heavy columns are compressed if O11Y_COMPRESS is enabled - see db_o11y.fields
+    request_payload = CompressedJSONField(null=True, blank=True)
     response_code = models.IntegerField(null=True, blank=True)
-    response_payload = models.JSONField(null=True, blank=True)
+    response_payload = CompressedJSONField(null=True, blank=True)
+
+    # the full traceback until the log is written, then only the exception's type and message,
+    # with the traceback kept once on the exception_group
+    exception = CompressedTextField(null=True, blank=True)
+    # indexed along with created_at below
+    exception_group = models.ForeignKey(
+        O11yException, null=True, blank=True, on_delete=models.SET_NULL, db_index=False,
+        related_name='logs',
+    )
+    logs = CompressedJSONField(null=True, blank=True)
+    # timed blocks from request.span - see db_o11y.buffer.RequestBuffer.spans
+    spans = models.JSONField(null=True, blank=True)
 
-    exception = models.TextField(null=True, blank=True)
-    logs = models.JSONField(null=True, blank=True)
+    # only recorded with auto_log(log_queries=True) - see db_o11y.queries
+    query_count = models.IntegerField(null=True, blank=True)
+    query_time = models.FloatField(null=True, blank=True)
+    queries = models.JSONField(null=True, blank=True)
+
+    # only recorded with auto_log(log_memory=True), for a sample of requests - see db_o11y.memory.
+    # Both in bytes
+    memory_peak = models.BigIntegerField(null=True, blank=True)
+    memory_rss_delta = models.BigIntegerField(null=True, blank=True)
+    memory_top = models.JSONField(null=True, blank=True)
+
+    # stack samples of slow requests, with auto_log(profile=True) - see db_o11y.profiler
+    profile = CompressedJSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='o11ylog_created_at_idx'),
+            models.Index(fields=['route', 'created_at'], name='o11ylog_route_created_idx'),
+            models.Index(fields=['response_code', 'created_at'], name='o11ylog_code_created_idx'),
+            models.Index(
+                fields=['exception_group', 'created_at'], name='o11ylog_exception_created_idx',
+            ),
+            models.Index(fields=['anomalous', 'created_at'], name='o11ylog_anomalous_created_idx'),
+        ]
 
     def __str__(self):
         return f'O11y Log: {self.url} - {self.method} @ {self.created_at.isoformat()}'
+
+
+class O11yLogDetail(models.Model):
+    '''The heavy columns of an O11yLog, when O11Y_DETAIL_TABLE is enabled
+
+    Keeps O11yLog narrow, so that list pages, counts and rollups don't read the payloads. Only
+    written for logs which have something to store in it - see db_o11y.storage.write_logs.
+    '''
+    log = models.OneToOneField(
+        O11yLog, primary_key=True, on_delete=models.CASCADE, related_name='detail',
+    )
+    request_payload = CompressedJSONField(null=True, blank=True)
+    response_payload = CompressedJSONField(null=True, blank=True)
+    exception = CompressedTextField(null=True, blank=True)
+    logs = CompressedJSONField(null=True, blank=True)
+
+    def __str__(self):
+        return f'O11y Log Detail: {self.log_id}'
+
+
+class O11yRollup(models.Model):
+    '''Latency summary for one route, method and response class over one time bucket
+
+    Built from O11yLog by the o11y_rollup management command - see db_o11y.rollup.
+    histogram holds the number of requests in each of rollup.LATENCY_BUCKETS.
+    '''
+    bucket = models.DateTimeField()
+    route = models.CharField(max_length=500)
+    method = models.CharField(max_length=20)
+    status_class = models.CharField(max_length=3)
+
+    count = models.PositiveIntegerField(default=0)
+    duration_sum = models.FloatField(default=0)
+    duration_min = models.FloatField(null=True, blank=True)
+    duration_max = models.FloatField(null=True, blank=True)
+    histogram = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['route', 'method', 'status_class', 'bucket'], name='o11yrollup_key',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['bucket'], name='o11yrollup_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return (
+            f'O11y Rollup: {self.route} - {self.method} {self.status_class} '
+            f'@ {self.bucket.isoformat()}'
+        )
+
+
+class O11yHighWaterMark(models.Model):
+    '''How far an incremental job has got, so that it can resume from there
+
+    For o11y_rollup this is the last O11yLog id processed, and for o11y_ingest the byte offset
+    reached in a spool file.
+    '''
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'O11y High Water Mark: {self.name} = {self.last_id}'
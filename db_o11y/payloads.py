@@ -0,0 +1,213 @@
+import json
+
+from .conf import get_setting
+
+
+# content types which are never text, whatever their bytes look like. Anything else is treated as
+# text if it decodes cleanly
+BINARY_TYPES = ('image/', 'audio/', 'video/', 'font/', 'application/pdf', 'application/zip',
+                'application/gzip', 'application/x-tar', 'application/vnd.')
+JSON_TYPES = ('application/json', '+json')
+
+TRUNCATED_MARKER = '... [truncated, {} bytes]'
+BINARY_MARKER = '[binary content: {}, {} bytes]'
+
+
+def request_payload(request):
+    '''Payload of the request in an easily readable / serializable format'''
+    if request.method == 'GET':
+        return _capped_dict(request.GET)
+    elif request.method == 'POST':
+        return _capped_dict(request.POST)
+    # other methods send their data in the body, usually as JSON
+    return to_payload(request.body, request.content_type, parse_json=True)
+
+
+def response_payload(response):
+    '''Payload of a response which is not streaming - see capture_stream for those'''
+    content_type = response.get('Content-Type', '')
+    return to_payload(response.content, content_type, parse_json=_is_json(content_type))
+
+
+def to_payload(raw, content_type, parse_json=False, size=None):
+    '''Turn the raw bytes of a body into what is stored in the log
+
+    Binary bodies are replaced with a short description. Text bodies are cut to
+    O11Y_PAYLOAD_MAX_BYTES with a marker saying how big they were. JSON is only parsed if it is
+    no bigger than O11Y_PAYLOAD_PARSE_MAX_BYTES - larger bodies are stored as raw text, which
+    saves decoding and re-encoding them on the request thread.
+
+    size is the full size of the body, if raw is only the start of it.
+    '''
+    size = len(raw) if size is None else size
+    if not size:
+        return None
+
+    mime_type, _, params = (content_type or '').partition(';')
+    mime_type = mime_type.strip().lower()
+    max_bytes = get_setting('O11Y_PAYLOAD_MAX_BYTES')
+    if max_bytes is not None:
+        raw = raw[:max_bytes]
+    truncated = size > len(raw)
+
+    text = None
+    if not mime_type.startswith(BINARY_TYPES) and b'\x00' not in raw[:1024]:
+        text = _decode(raw, _charset(params), truncated)
+    if text is None:
+        return BINARY_MARKER.format(mime_type or 'unknown', size)
+    if truncated:
+        return text + TRUNCATED_MARKER.format(size)
+
+    parse_max_bytes = get_setting('O11Y_PAYLOAD_PARSE_MAX_BYTES')
+    if parse_json and (parse_max_bytes is None or size <= parse_max_bytes):
+        try:
+            return json.loads(text) or None
+        except ValueError:
+            pass
+    return text or None
+
+
+def capture_stream(response, on_complete, aon_complete):
+    '''Copy the start of a streaming response's body as it is sent, without holding up or
+    buffering the rest of it
+
+    Once the response has been sent (or closed), on_complete is called with the payload - or,
+    for responses streaming from an async iterator, aon_complete is awaited.
+    '''
+    max_bytes = get_setting('O11Y_PAYLOAD_MAX_BYTES')
+    if response.is_async:
+        capture = _AsyncStreamCapture(response, max_bytes, on_complete, aon_complete)
+    else:
+        capture = _StreamCapture(response, max_bytes, on_complete)
+    response.streaming_content = capture
+
+
+def _capped_dict(query_dict):
+    '''The (last) value of each key, within O11Y_PAYLOAD_MAX_BYTES of keys and values in total
+
+    The value which crosses the limit is cut, and any after it replaced, with TRUNCATED_MARKER
+    giving its full size.
+    '''
+    max_bytes = get_setting('O11Y_PAYLOAD_MAX_BYTES')
+    payload = {}
+    remaining = max_bytes
+    for key in query_dict:
+        value = query_dict[key]
+        if max_bytes is not None:
+            encoded = value.encode()
+            remaining -= len(key.encode())
+            if len(encoded) > remaining:
+                kept = encoded[:max(remaining, 0)].decode(errors='ignore')
+                value = kept + TRUNCATED_MARKER.format(len(encoded))
+            remaining = max(remaining - len(encoded), 0)
+        payload[key] = value
+    return payload or None
+
+
+def _is_json(content_type):
+    mime_type = content_type.partition(';')[0].strip().lower()
+    return mime_type.endswith(JSON_TYPES)
+
+
+def _decode(raw, charset, truncated):
+    '''raw as text, or None if it isn't text'''
+    try:
+        return raw.decode(charset)
+    except LookupError:
+        return None
+    except UnicodeDecodeError as e:
+        # the cut may have split the last character in two
+        if truncated and e.start >= len(raw) - 3:
+            return _decode(raw[:e.start], charset, False)
+        return None
+
+
+def _charset(params):
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip().strip('"')
+    return 'utf-8'
+
+
+class _Capture:
+    '''Keeps the first max_bytes of a streaming response as it is sent
+
+    Django closes the response once it has been sent, which closes this, so the payload is
+    completed whether the body was sent in full, the client went away, or it was never iterated.
+    '''
+
+    def __init__(self, response, max_bytes):
+        self._content_type = response.get('Content-Type', '')
+        self._max_bytes = max_bytes
+        self._head = bytearray()
+        self._size = 0
+        self._done = False
+
+    def _keep(self, chunk):
+        self._size += len(chunk)
+        if self._max_bytes is None:
+            self._head += chunk
+        elif len(self._head) < self._max_bytes:
+            self._head += chunk[:self._max_bytes - len(self._head)]
+
+    def _payload(self):
+        self._done = True
+        return to_payload(
+            bytes(self._head), self._content_type, parse_json=_is_json(self._content_type),
+            size=self._size,
+        )
+
+
+class _StreamCapture(_Capture):
+
+    def __init__(self, response, max_bytes, on_complete):
+        super().__init__(response, max_bytes)
+        self._iterator = iter(response.streaming_content)
+        self._on_complete = on_complete
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+        self._keep(chunk)
+        return chunk
+
+    def close(self):
+        if not self._done:
+            self._on_complete(self._payload())
+
+
+class _AsyncStreamCapture(_Capture):
+
+    def __init__(self, response, max_bytes, on_complete, aon_complete):
+        super().__init__(response, max_bytes)
+        self._iterator = aiter(response.streaming_content)
+        self._on_complete = on_complete
+        self._aon_complete = aon_complete
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await anext(self._iterator)
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+        self._keep(chunk)
+        return chunk
+
+    async def aclose(self):
+        if not self._done:
+            await self._aon_complete(self._payload())
+
+    def close(self):
+        # Django closes the response from a thread, so the sync callback is safe here
+        if not self._done:
+            self._on_complete(self._payload())
@@ -0,0 +1,213 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import sys
+import threading
+import time
+
+from asgiref.sync import SyncToAsync, sync_to_async
+
+from .conf import get_setting
+
+
+# the profile of the request being handled, so that the thread its sync code runs on can be
+# found from inside that thread - see follow_sync_thread
+_current_profile = ContextVar('o11y_current_profile', default=None)
+
+# sync_to_async calls the sync function from this, in its worker thread
+_SYNC_TO_ASYNC_ROOT = SyncToAsync.thread_handler.__code__
+
+
+class StackSampler:
+    '''Background thread which samples the stacks of the threads handling profiled requests
+
+    Every interval seconds, the current frame of each registered thread is read with
+    sys._current_frames, and its stack - from the view down - is counted in collapsed form:
+    one 'file:function;file:function;...' string per distinct stack. The thread only runs while
+    there is something to sample.
+
+    Concurrent async requests share their event loop's thread, so a thread can have several
+    profiles at once. Each sample of the thread is offered to all of them, and each only counts
+    it if the stack runs through its own view. Under ASGI, the sync part of a request runs in a
+    worker thread, which is sampled for it as well - see follow_sync_thread.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, profile):
+        with self._lock:
+            self._profiles.setdefault(profile.thread_id, []).append(profile)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='db_o11y-profiler', daemon=True,
+                )
+                self._thread.start()
+        self._wake.set()
+
+    def unregister(self, profile):
+        with self._lock:
+            profiles = self._profiles.get(profile.thread_id, [])
+            if profile in profiles:
+                profiles.remove(profile)
+            if not profiles:
+                self._profiles.pop(profile.thread_id, None)
+
+    def sample(self):
+        '''Take one sample of every registered thread'''
+        with self._lock:
+            threads = [
+                (thread_id, list(profiles)) for thread_id, profiles in self._profiles.items()
+            ]
+        if not threads:
+            return
+        frames = sys._current_frames()
+        for thread_id, profiles in threads:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                for profile in profiles:
+                    profile.add(frame)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._profiles
+                if idle:
+                    self._wake.clear()
+            if idle:
+                self._wake.wait()
+                continue
+            time.sleep(self.interval)
+            self.sample()
+
+
+class Profile:
+    '''The samples taken of one request'''
+
+    def __init__(self, root, thread_id=None):
+        # the frame the view is called from, or the code of one - only frames below it are counted
+        self.root = root
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = 0
+        self.stacks = Counter()
+        self.branches = []
+
+    def add(self, frame):
+        self.samples += 1
+        self._count(frame)
+
+    def _count(self, frame):
+        root = self.root
+        names = []
+        while frame is not None and frame is not root and frame.f_code is not root:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        # an async view's thread spends some of its time running other tasks, which are skipped
+        if frame is not None and names:
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def branch(self, root):
+        '''Sample the current thread too, from root down, counting its stacks in this profile'''
+        branch = _Branch(self, root)
+        self.branches.append(branch)
+        return branch
+
+    def as_dict(self, interval, max_stacks):
+        return {
+            'interval': interval,
+            'samples': self.samples,
+            'stacks': dict(self.stacks.most_common(max_stacks)),
+        }
+
+
+class _Branch(Profile):
+    '''The part of a profile taken from another thread
+
+    Its stacks are counted in the profile it belongs to. Samples are only counted by that
+    profile, as each is taken of every thread at once.
+    '''
+
+    def __init__(self, profile, root):
+        super().__init__(root)
+        self.stacks = profile.stacks
+
+    def add(self, frame):
+        self._count(frame)
+
+
+_sampler = None
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    '''The process's StackSampler, created on first use (and again in a forked child)'''
+    global _sampler, _sampler_pid
+    pid = os.getpid()
+    if _sampler is None or _sampler_pid != pid:
+        with _sampler_lock:
+            if _sampler is None or _sampler_pid != pid:
+                _sampler = StackSampler(get_setting('O11Y_PROFILE_INTERVAL'))
+                _sampler_pid = pid
+    return _sampler
+
+
+@contextmanager
+def record_profile(log, root, threshold=None):
+    '''Sample the stack of the current thread while the block runs, from root (the frame the
+    view is called from) down, and store the samples on the log's profile field if the block
+    took at least threshold seconds (default O11Y_PROFILE_THRESHOLD)
+    '''
+    if threshold is None:
+        threshold = get_setting('O11Y_PROFILE_THRESHOLD')
+    sampler = get_sampler()
+    profile = Profile(root)
+    start = time.perf_counter()
+    sampler.register(profile)
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        sampler.unregister(profile)
+        for branch in profile.branches:
+            sampler.unregister(branch)
+            branch.root = None
+        profile.root = None
+        if time.perf_counter() - start >= threshold and profile.stacks:
+            log.profile = profile.as_dict(sampler.interval, get_setting('O11Y_PROFILE_MAX_STACKS'))
+
+
+async def follow_sync_thread():
+    '''Also sample the thread the current request's sync code runs on, if it is being profiled
+
+    Under ASGI, sync views (and sync_to_async calls from async ones) run in a worker thread
+    rather than on the event loop's, below sync_to_async's own frame there. Django gives each
+    request a thread of its own for this, which this finds by running there with
+    thread_sensitive=True, the same as the view will.
+    '''
+    profile = _current_profile.get()
+    if profile is not None:
+        await sync_to_async(_branch, thread_sensitive=True)(profile)
+
+
+def _branch(profile):
+    get_sampler().register(profile.branch(_SYNC_TO_ASYNC_ROOT))
+
+
+def flame_tree(stacks):
+    '''Merge collapsed stacks into a tree of {'name', 'count', 'children'} nodes'''
+    root = {'name': 'all', 'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        root['count'] += count
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'count': 0, 'children': {}})
+            node['count'] += count
+    return root
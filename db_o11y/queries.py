@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+import heapq
+import re
+import time
+
+from django.db import connections
+
+from .conf import get_setting
+
+
+MAX_SQL_LENGTH = 1000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s)\s*,?)+\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+class QueryRecorder:
+    '''execute_wrapper which times every query run during a request
+
+    Keeps the total count and time, the `slowest` slowest statements, and a count per
+    fingerprint so that statements repeated at least `repeat_threshold` times - the signature of
+    an N+1 - can be reported.
+    '''
+
+    def __init__(self, slowest=5, repeat_threshold=5):
+        self.slowest_limit = slowest
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.time = 0
+        self._slowest = []
+        self._fingerprints = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, elapsed):
+        self.count += 1
+        self.time += elapsed
+
+        entry = (elapsed, self.count, sql)
+        if len(self._slowest) < self.slowest_limit:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+        stats = self._fingerprints.setdefault(fingerprint(sql), [0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+
+    def summary(self):
+        return {
+            'slowest': [
+                {'sql': sql[:MAX_SQL_LENGTH], 'time': elapsed}
+                for elapsed, _, sql in sorted(self._slowest, reverse=True)
+            ],
+            'repeated': sorted(
+                (
+                    {'fingerprint': fp[:MAX_SQL_LENGTH], 'count': count, 'time': total}
+                    for fp, (count, total) in self._fingerprints.items()
+                    if count >= self.repeat_threshold
+                ),
+                key=lambda item: -item['count'],
+            ),
+        }
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    '''Normalise a statement so that ones differing only in their literals compare equal'''
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+# the QueryRecorder of the request being handled. A context variable rather than a wrapper on
+# the connection, as Django's connections belong to a thread and the queries of async views are
+# run in another one, by sync_to_async - which carries the context variable across
+_current_recorder = ContextVar('db_o11y_query_recorder', default=None)
+
+
+def _dispatch(execute, sql, params, many, context):
+    '''execute_wrapper installed on every connection, which passes queries to the current
+    request's QueryRecorder, if any
+    '''
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_wrapper(connection):
+    '''Add _dispatch to the connection, unless it is the O11Y_DATABASE one or already has it
+
+    Inserted first so that it can't upset Django's push / pop of wrappers added with
+    connection.execute_wrapper.
+    '''
+    if connection.alias != get_setting('O11Y_DATABASE') and (
+        _dispatch not in connection.execute_wrappers
+    ):
+        connection.execute_wrappers.insert(0, _dispatch)
+
+
+def connection_created_handler(sender, connection, **kwargs):
+    install_wrapper(connection)
+
+
+@contextmanager
+def record_queries(log):
+    '''Time every query run on the app's connections inside the block - including, for async
+    views, those run in other threads by sync_to_async - and store the results on the log's
+    query_count, query_time and queries fields
+    '''
+    recorder = QueryRecorder(
+        get_setting('O11Y_SLOWEST_QUERIES'), get_setting('O11Y_REPEATED_QUERY_THRESHOLD')
+    )
+    # connections opened from now on get the wrapper from connection_created
+    for alias in connections:
+        install_wrapper(connections[alias])
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+        log.query_count = recorder.count
+        log.query_time = recorder.time
+        log.queries = recorder.summary()
@@ -0,0 +1,254 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+import json
+import random
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .benchmark import percentile
+from .conf import get_setting
+from .models import O11yLog
+from .payloads import BINARY_MARKER, TRUNCATED_MARKER
+
+
+FIELDS = ('id', 'route', 'url', 'method', 'request_start', 'duration', 'response_code')
+
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+# the payloads of logs which can't be rebuilt into the original request
+_BINARY_PREFIX = BINARY_MARKER.split('{}')[0]
+_TRUNCATED_PREFIX = TRUNCATED_MARKER.split('{}')[0]
+
+
+class Skip(Exception):
+    '''The log can't be replayed, e.g. because only part of its payload was stored'''
+
+
+class Result:
+    '''The outcome of replaying one log, along with what was recorded for it'''
+    __slots__ = ('log_id', 'route', 'method', 'recorded_duration', 'recorded_code', 'duration',
+                 'code', 'error')
+
+    def __init__(self, log, duration=None, code=None, error=None):
+        self.log_id = log.id
+        self.route = log.route
+        self.method = log.method
+        self.recorded_duration = log.duration
+        self.recorded_code = log.response_code
+        self.duration = duration
+        self.code = code
+        self.error = error
+
+
+def select_logs(
+    route=None, methods=None, since=None, until=None, sample=None, limit=None, seed=None,
+    chunk_size=1000,
+):
+    '''Stream the logs to replay, oldest first
+
+    Logs are read in primary key ranges of chunk_size, so neither the whole selection nor a
+    long-running cursor is held. sample keeps that fraction of the matching logs, chosen at
+    random (repeatably, given a seed).
+    '''
+    logs = O11yLog.objects.all()
+    if route is not None:
+        logs = logs.filter(route=route)
+    if methods:
+        logs = logs.filter(method__in=methods)
+    if since is not None:
+        logs = logs.filter(created_at__gte=since)
+    if until is not None:
+        logs = logs.filter(created_at__lt=until)
+
+    # payloads moved to the detail table are loaded with the log, in the same query
+    fields = [*FIELDS, 'request_payload']
+    if get_setting('O11Y_DETAIL_TABLE'):
+        logs = logs.select_related('detail')
+        fields.append('detail__request_payload')
+    logs = logs.only(*fields).order_by('id')
+
+    rng = random.Random(seed)
+    returned = 0
+    last_id = 0
+    while True:
+        chunk = list(logs.filter(id__gt=last_id)[:chunk_size])
+        for log in chunk:
+            if sample is not None and rng.random() >= sample:
+                continue
+            yield log
+            returned += 1
+            if limit is not None and returned >= limit:
+                return
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+
+def build_request(log, base_url, headers=None):
+    '''The urllib Request which repeats what was logged
+
+    Raises Skip if the request can't be rebuilt from the stored payload.
+    '''
+    payload = _payload(log)
+    # GET and POST payloads have each of their values cut to fit
+    values = payload.values() if isinstance(payload, dict) else [payload]
+    if any(isinstance(value, str) and _cut(value) for value in values):
+        raise Skip('payload was not stored in full')
+
+    url = base_url.rstrip('/') + log.url
+    headers = dict(headers or {})
+    body = None
+    if log.method == 'GET':
+        # GET payloads are the query string
+        if payload:
+            url = f'{url}?{urlencode(payload)}'
+    elif log.method == 'POST' and isinstance(payload, dict):
+        # stored from request.POST - a form, or None if the body was something else
+        body = urlencode(payload).encode()
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+    elif isinstance(payload, (dict, list)):
+        body = json.dumps(payload).encode()
+        headers.setdefault('Content-Type', 'application/json')
+    elif payload:
+        # JSON over O11Y_PAYLOAD_PARSE_MAX_BYTES is stored as the text it was sent as
+        body = payload.encode()
+        headers.setdefault(
+            'Content-Type', 'application/json' if _is_json(payload) else 'text/plain; charset=utf-8'
+        )
+    return Request(url, data=body, headers=headers, method=log.method)
+
+
+def _cut(text):
+    return text.startswith(_BINARY_PREFIX) or _TRUNCATED_PREFIX in text
+
+
+def _is_json(text):
+    if not text.lstrip().startswith(('{', '[')):
+        return False
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+
+def send(request, timeout=30):
+    '''Send the request, returning (seconds taken, status code, error)'''
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            response.read()
+            code = response.status
+    except HTTPError as e:
+        e.read()
+        code = e.code
+    except (URLError, HTTPException, OSError) as e:
+        return time.perf_counter() - start, None, str(getattr(e, 'reason', e))
+    return time.perf_counter() - start, code, None
+
+
+def replay(
+    logs, base_url, concurrency=1, rate=None, speed=None, headers=None, timeout=30,
+    send_request=send,
+):
+    '''Replay the logs against base_url, returning (results, number skipped, seconds taken)
+
+    Requests are started in the order they were logged by up to concurrency threads:
+    * as fast as the threads allow by default
+    * at no more than rate requests per second, if set
+    * with the gaps between their original start times divided by speed, if set - so 1 is real
+      time and 10 is ten times faster. If both are set, the slower of the two applies.
+    If the threads fall behind, requests are sent as soon as one is free.
+    '''
+    results = []
+    skipped = 0
+    slots = threading.BoundedSemaphore(concurrency)
+    lock = threading.Lock()
+
+    def run(log, request):
+        try:
+            duration, code, error = send_request(request, timeout)
+            with lock:
+                results.append(Result(log, duration, code, error))
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    first_start = None
+    sent = 0
+    with ThreadPoolExecutor(concurrency) as executor:
+        for log in logs:
+            try:
+                request = build_request(log, base_url, headers)
+            except Skip:
+                skipped += 1
+                continue
+
+            due = 0
+            if rate:
+                due = sent / rate
+            if speed and log.request_start is not None:
+                if first_start is None:
+                    first_start = log.request_start
+                due = max(due, (log.request_start - first_start).total_seconds() / speed)
+            wait = start + due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+            slots.acquire()
+            executor.submit(run, log, request)
+            sent += 1
+    return results, skipped, time.perf_counter() - start
+
+
+def summarise(results, elapsed):
+    '''Latency percentiles of the recorded and replayed requests, and how the status codes of the
+    replayed requests differ from those recorded
+    '''
+    replayed = [result.duration for result in results if result.code is not None]
+    recorded = [
+        result.recorded_duration for result in results if result.recorded_duration is not None
+    ]
+    changes = Counter(
+        (result.recorded_code, result.code) for result in results
+        if result.code is not None and result.code != result.recorded_code
+    )
+    return {
+        'requests': len(results),
+        'errors': Counter(result.error for result in results if result.error is not None),
+        'requests_per_second': len(results) / elapsed if elapsed else None,
+        'recorded': {key: percentile(recorded, q) for key, q in PERCENTILES},
+        'replayed': {key: percentile(replayed, q) for key, q in PERCENTILES},
+        'status_changes': changes,
+        'slowest_routes': _slowest_routes(results),
+    }
+
+
+def _slowest_routes(results, limit=10):
+    '''(route, p95 recorded, p95 replayed, count) of the routes with the slowest replayed p95'''
+    by_route = {}
+    for result in results:
+        if result.code is not None:
+            by_route.setdefault(result.route or '', []).append(result)
+    routes = []
+    for route, route_results in by_route.items():
+        recorded = [r.recorded_duration for r in route_results if r.recorded_duration is not None]
+        routes.append((
+            route,
+            percentile(recorded, 0.95),
+            percentile([r.duration for r in route_results], 0.95),
+            len(route_results),
+        ))
+    routes.sort(key=lambda item: item[2], reverse=True)
+    return routes[:limit]
+
+
+def _payload(log):
+    detail = getattr(log, 'detail', None) if get_setting('O11Y_DETAIL_TABLE') else None
+    if log.request_payload is None and detail is not None:
+        return detail.request_payload
+    return log.request_payload
@@ -0,0 +1,215 @@
+from datetime import timedelta
+
+from django.db import router, transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncHour, TruncMinute
+from django.utils import timezone
+
+from .conf import get_setting
+from .models import O11yHighWaterMark, O11yLog, O11yRollup
+
+
+# upper bounds, in seconds, of the latency histogram buckets - the last bucket is everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HIGH_WATER_MARK = 'rollup'
+
+TRUNCATE = {
+    'minute': TruncMinute,
+    'hour': TruncHour,
+}
+
+
+def rollup_new_logs(batch_size=50000, lag=60):
+    '''Fold every log not yet rolled up into O11yRollup, batch_size ids at a time
+
+    Logs created in the last `lag` seconds are left for the next run, so that rows whose
+    transactions commit out of id order are not skipped. Returns the number of logs processed.
+    '''
+    settled = O11yLog.objects.filter(
+        created_at__lt=timezone.now() - timedelta(seconds=lag)
+    ).aggregate(hi=Max('id'))['hi']
+    if settled is None:
+        return 0
+
+    processed = 0
+    while True:
+        with transaction.atomic(using=router.db_for_write(O11yRollup)):
+            mark, _ = O11yHighWaterMark.objects.select_for_update().get_or_create(
+                name=HIGH_WATER_MARK
+            )
+            if mark.last_id >= settled:
+                return processed
+
+            end_id = min(mark.last_id + batch_size, settled)
+            processed += rollup_logs(mark.last_id, end_id)
+            mark.last_id = end_id
+            mark.save(update_fields=['last_id'])
+
+
+def rollup_logs(start_id, end_id):
+    '''Add the logs with start_id < id <= end_id to the rollups. Returns the number of logs
+
+    The aggregation is done by the database - only one row per route, method, response code
+    and bucket comes back to Python, where response codes are folded into their class.
+    '''
+    truncate = TRUNCATE[get_setting('O11Y_ROLLUP_BUCKET')]
+    groups = (
+        O11yLog.objects
+        .filter(id__gt=start_id, id__lte=end_id, duration__isnull=False)
+        .annotate(bucket=truncate('created_at'))
+        .values('bucket', 'route', 'method', 'response_code')
+        .annotate(
+            n=Count('id'),
+            duration_sum=Sum('duration'),
+            duration_min=Min('duration'),
+            duration_max=Max('duration'),
+            **histogram_aggregates(),
+        )
+        .order_by()
+    )
+
+    summaries = {}
+    processed = 0
+    for group in groups:
+        key = (
+            group['route'] or '',
+            group['method'],
+            _status_class(group['response_code']),
+            group['bucket'],
+        )
+        histogram = histogram_from(group, group['n'])
+        summary = O11yRollup(
+            route=key[0], method=key[1], status_class=key[2], bucket=key[3],
+            count=group['n'], duration_sum=group['duration_sum'],
+            duration_min=group['duration_min'], duration_max=group['duration_max'],
+            histogram=histogram,
+        )
+        if key in summaries:
+            _merge(summaries[key], summary)
+        else:
+            summaries[key] = summary
+        processed += group['n']
+
+    if summaries:
+        _save_summaries(summaries)
+    return processed
+
+
+def histogram_aggregates():
+    '''Aggregates counting the logs at or under each LATENCY_BUCKETS edge, so that the database
+    builds the histogram - see histogram_from
+    '''
+    return {
+        f'le_{i}': Count('id', filter=Q(duration__lte=edge))
+        for i, edge in enumerate(LATENCY_BUCKETS)
+    }
+
+
+def histogram_from(row, count):
+    '''The LATENCY_BUCKETS histogram of a row aggregated with histogram_aggregates'''
+    cumulative = [row[f'le_{i}'] for i in range(len(LATENCY_BUCKETS))] + [count]
+    return [cumulative[0]] + [b - a for a, b in zip(cumulative, cumulative[1:])]
+
+
+def latency_summary(route, since, until=None, method=None):
+    '''Count, mean, min, max and p50 / p95 / p99 latency for a route between since and until
+
+    Reads only O11yRollup, so the cost depends on the number of buckets, not requests.
+    '''
+    rollups = O11yRollup.objects.filter(route=route, bucket__gte=since)
+    if until is not None:
+        rollups = rollups.filter(bucket__lt=until)
+    if method is not None:
+        rollups = rollups.filter(method=method)
+
+    total = O11yRollup(count=0, histogram=[])
+    for rollup in rollups.only(
+        'count', 'duration_sum', 'duration_min', 'duration_max', 'histogram'
+    ).iterator():
+        _merge(total, rollup)
+
+    if not total.count:
+        return {'count': 0}
+    return {
+        'count': total.count,
+        'mean': total.duration_sum / total.count,
+        'min': total.duration_min,
+        'max': total.duration_max,
+        'p50': percentile(total.histogram, 0.5, total.duration_max),
+        'p95': percentile(total.histogram, 0.95, total.duration_max),
+        'p99': percentile(total.histogram, 0.99, total.duration_max),
+    }
+
+
+def percentile(histogram, q, duration_max=None):
+    '''Estimate the q-th quantile (0 < q <= 1) of a LATENCY_BUCKETS histogram
+
+    Interpolates linearly within the bucket the quantile falls in. The last bucket has no upper
+    bound, so duration_max is used for it if known, otherwise the last bucket edge.
+    '''
+    total = sum(histogram)
+    if not total:
+        return None
+
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(histogram):
+        if count and cumulative + count >= rank:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0
+            if i < len(LATENCY_BUCKETS):
+                upper = LATENCY_BUCKETS[i]
+            else:
+                upper = max(duration_max or lower, lower)
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+    return duration_max
+
+
+def status_code(response_code):
+    '''The status code a logged request was answered with
+
+    No response code means the exception was left for Django, which will have returned a 500.
+    '''
+    return 500 if response_code is None else response_code
+
+
+def _status_class(response_code):
+    return f'{status_code(response_code) // 100}xx'
+
+
+def _merge(total, rollup):
+    '''Add rollup's counts into total, in place'''
+    total.count += rollup.count
+    total.duration_sum += rollup.duration_sum
+    total.duration_min = _none_min(total.duration_min, rollup.duration_min)
+    total.duration_max = _none_max(total.duration_max, rollup.duration_max)
+    if not total.histogram:
+        total.histogram = [0] * len(rollup.histogram)
+    total.histogram = [a + b for a, b in zip(total.histogram, rollup.histogram)]
+
+
+def _save_summaries(summaries):
+    '''Merge summaries into any existing rollups for the same keys and save them'''
+    existing = O11yRollup.objects.select_for_update().filter(
+        bucket__in={key[3] for key in summaries}
+    )
+    to_update = []
+    for rollup in existing:
+        key = (rollup.route, rollup.method, rollup.status_class, rollup.bucket)
+        if key in summaries:
+            _merge(rollup, summaries.pop(key))
+            to_update.append(rollup)
+
+    O11yRollup.objects.bulk_update(
+        to_update, ['count', 'duration_sum', 'duration_min', 'duration_max', 'histogram']
+    )
+    O11yRollup.objects.bulk_create(summaries.values())
+
+
+def _none_min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _none_max(a, b):
+    return b if a is None else a if b is None else max(a, b)
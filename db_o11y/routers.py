@@ -0,0 +1,59 @@
+from django.db import DEFAULT_DB_ALIAS
+
+from .conf import get_setting
+
+
+APP_LABEL = 'db_o11y'
+
+
+class O11yRouter:
+    '''Sends every db_o11y model to the O11Y_DATABASE alias, if it is set
+
+    Writing the logs to a database of their own means they aren't rolled back along with a
+    failing request's transaction (e.g. with ATOMIC_REQUESTS), and they don't contend with the
+    app's own writes for locks. Has no effect while O11Y_DATABASE is None. If it is 'default',
+    the logs share the project's database, and every other app still migrates there.
+
+    Add it to DATABASE_ROUTERS:
+        DATABASE_ROUTERS = ['db_o11y.routers.O11yRouter']
+    '''
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return get_setting('O11Y_DATABASE')
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == APP_LABEL and obj2._meta.app_label == APP_LABEL:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = get_setting('O11Y_DATABASE')
+        if alias is None:
+            return None
+        if app_label == APP_LABEL:
+            return db == alias
+        # keep the log database for logs only - unless it is the project's own database
+        if db == alias and alias != DEFAULT_DB_ALIAS:
+            return False
+        return None
+
+
+def configure_connection(sender, connection, **kwargs):
+    '''connection_created receiver which puts a SQLite log database into WAL mode
+
+    In WAL mode readers (e.g. the admin) don't block the writer and vice versa, and with
+    synchronous=NORMAL each commit no longer waits for an fsync.
+    '''
+    if (
+        connection.alias == get_setting('O11Y_DATABASE')
+        and connection.vendor == 'sqlite'
+        and get_setting('O11Y_SQLITE_WAL')
+    ):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
@@ -0,0 +1,55 @@
+from functools import lru_cache
+import random
+import re
+
+from .conf import get_setting
+
+
+def head_sampled(path, sample_rate=None):
+    '''Decide, before the view runs, whether a request should be fully logged
+
+    sample_rate is the fraction of requests to log, where None means the rate comes from the
+    settings: the first O11Y_SAMPLE_RATES pattern matching the start of the path, otherwise
+    O11Y_SAMPLE_RATE. The path is request.path_info, without any SCRIPT_NAME prefix, as for
+    O11yMiddleware's include and exclude patterns.
+    '''
+    if sample_rate is None:
+        sample_rate = _route_sample_rate(path)
+    if sample_rate >= 1:
+        return True
+    return random.random() < sample_rate
+
+
+def tail_keep(response_code, exception, duration, slow_threshold=None, anomalous=False):
+    '''Decide, after the view has run, whether a request that was not head-sampled is kept anyway
+
+    Requests which raised an exception or returned a 5xx are kept if O11Y_TAIL_KEEP_ERRORS is
+    enabled, anomalous requests (slow for their route - see db_o11y.baselines) are kept if
+    O11Y_TAIL_KEEP_ANOMALOUS is enabled, and requests slower than slow_threshold seconds
+    (default O11Y_TAIL_SLOW_THRESHOLD) are always kept.
+    '''
+    if get_setting('O11Y_TAIL_KEEP_ERRORS') and (
+        exception is not None or (response_code is not None and response_code >= 500)
+    ):
+        return True
+
+    if anomalous and get_setting('O11Y_TAIL_KEEP_ANOMALOUS'):
+        return True
+
+    if slow_threshold is None:
+        slow_threshold = get_setting('O11Y_TAIL_SLOW_THRESHOLD')
+    return slow_threshold is not None and duration > slow_threshold
+
+
+def _route_sample_rate(path):
+    rates = get_setting('O11Y_SAMPLE_RATES')
+    if rates:
+        for pattern, rate in _compile_rates(tuple(rates.items())):
+            if pattern.match(path):
+                return rate
+    return get_setting('O11Y_SAMPLE_RATE')
+
+
+@lru_cache(maxsize=8)
+def _compile_rates(rates):
+    return [(re.compile(pattern), rate) for pattern, rate in rates]
@@ -0,0 +1,182 @@
+import atexit
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .conf import get_setting
+from .models import O11yLog
+
+
+logger = logging.getLogger(__name__)
+
+# files still being appended to end in ACTIVE_SUFFIX, and are renamed once rotated
+ACTIVE_SUFFIX = '.jsonl.part'
+COMPLETE_SUFFIX = '.jsonl'
+
+
+class SpoolWriter:
+    '''Appends logs as JSON lines to a local file, to be loaded later by o11y_ingest
+
+    Each log is written with a single os.write on a file opened with O_APPEND, so lines from
+    concurrent threads never interleave and nothing is buffered in the process. Once a file
+    reaches max_bytes it is closed and renamed from ACTIVE_SUFFIX to COMPLETE_SUFFIX, and a new
+    one is started.
+
+    The active file is held with an exclusive flock for as long as it is open, which is how
+    o11y_ingest tells a live process's file from one left behind by a process which died. If the
+    file is deleted from under the writer anyway, it notices and starts a new one rather than
+    writing into the deleted file.
+
+    Failures to write are logged and counted in `dropped` - they never fail the request.
+    '''
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        self._path = None
+        self._size = 0
+
+    def write(self, log):
+        data = (json.dumps(serialize(log)) + '\n').encode('utf-8')
+        with self._lock:
+            try:
+                if self._fd is not None and os.fstat(self._fd).st_nlink == 0:
+                    # deleted by something else - the lines written to it are gone, but later
+                    # ones needn't be
+                    logger.warning('Spool file %s was deleted while in use', self._path)
+                    self._discard()
+                if self._fd is None or (self._size and self._size + len(data) > self.max_bytes):
+                    self._rotate()
+                os.write(self._fd, data)
+                self._size += len(data)
+            except OSError:
+                logger.exception('Failed to write O11yLog to spool %s', self.directory)
+                self.dropped += 1
+                return False
+        return True
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _rotate(self):
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        self._path = os.path.join(self.directory, f'o11y-{os.getpid()}-{stamp}{ACTIVE_SUFFIX}')
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._size = 0
+
+    def _close(self):
+        path = self._discard()
+        if path is not None:
+            try:
+                os.rename(path, path[:-len(ACTIVE_SUFFIX)] + COMPLETE_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def _discard(self):
+        '''Close the active file, if any, and forget it. Returns its path'''
+        fd, path = self._fd, self._path
+        # cleared first so that a failure below can't leave a closed fd to be used again
+        self._fd = None
+        self._path = None
+        if fd is not None:
+            os.close(fd)
+        return path
+
+
+def is_abandoned(path):
+    '''Whether an active spool file's writer has gone, e.g. because its process was killed
+
+    The writer holds an exclusive flock on the file while it has it open. Where flock isn't
+    available, the pid in the file name is checked instead, on POSIX systems.
+    '''
+    if fcntl is not None:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+        return True
+
+    if os.name != 'posix':
+        # no way to tell without signalling the process, so fall back on the file's age alone
+        return True
+    try:
+        pid = int(os.path.basename(path).split('-')[1])
+    except (IndexError, ValueError):
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # e.g. PermissionError - the process exists but belongs to another user
+        pass
+    return False
+
+
+def serialize(log):
+    '''Every field of the log except the id, as a JSON-serialisable dict'''
+    data = {}
+    for field in O11yLog._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        value = field.value_from_object(log)
+        # isoformat rather than DjangoJSONEncoder, which drops the microseconds
+        data[field.attname] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+def deserialize(data):
+    '''Rebuild an unsaved O11yLog from the output of serialize
+
+    Keys for fields which no longer exist are ignored, so old spool files can still be loaded.
+    '''
+    fields = {
+        field.attname: field for field in O11yLog._meta.concrete_fields if not field.primary_key
+    }
+    return O11yLog(**{
+        name: fields[name].to_python(value) if isinstance(value, str) else value
+        for name, value in data.items()
+        if name in fields
+    })
+
+
+_spool = None
+_spool_pid = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    '''Return this process's spool writer, creating it on first use'''
+    global _spool, _spool_pid
+    if _spool is not None and _spool_pid == os.getpid():
+        return _spool
+
+    with _spool_lock:
+        if _spool is None or _spool_pid != os.getpid():
+            _spool = SpoolWriter(
+                get_setting('O11Y_SPOOL_DIR'), get_setting('O11Y_SPOOL_MAX_BYTES')
+            )
+            _spool_pid = os.getpid()
+            atexit.register(_spool.close)
+    return _spool
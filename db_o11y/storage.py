@@ -0,0 +1,48 @@
+from django.db import connections, router, transaction
+
+from .conf import get_setting
+from .errors import group_exceptions
+from .models import O11yLog, O11yLogDetail
+
+
+# the O11yLog fields moved to O11yLogDetail when O11Y_DETAIL_TABLE is enabled
+DETAIL_FIELDS = ['request_payload', 'response_payload', 'exception', 'logs']
+
+
+def write_logs(logs):
+    '''Insert logs into the database - every way of saving logs ends up here
+
+    Exceptions are grouped first (see db_o11y.errors). With O11Y_DETAIL_TABLE enabled, the heavy
+    fields are moved to O11yLogDetail rows, written in the same transaction.
+    '''
+    group_exceptions(logs)
+    details = split_details(logs) if get_setting('O11Y_DETAIL_TABLE') else []
+
+    using = router.db_for_write(O11yLog)
+    with transaction.atomic(using=using):
+        if len(logs) == 1 or (
+            details and not connections[using].features.can_return_rows_from_bulk_insert
+        ):
+            # the details need the logs' ids, which some databases don't return from bulk inserts
+            for log in logs:
+                log.save(using=using)
+        else:
+            O11yLog.objects.using(using).bulk_create(logs)
+        if details:
+            O11yLogDetail.objects.using(using).bulk_create(details)
+
+
+def split_details(logs):
+    '''Move the heavy fields of each log to an unsaved O11yLogDetail, returning the details
+
+    Logs with nothing (or only empty values) in the fields don't get one.
+    '''
+    details = []
+    for log in logs:
+        values = {name: getattr(log, name) for name in DETAIL_FIELDS}
+        if all(value in (None, '', [], {}) for value in values.values()):
+            continue
+        for name in DETAIL_FIELDS:
+            setattr(log, name, None)
+        details.append(O11yLogDetail(log=log, **values))
+    return details
@@ -1,13 +1,55 @@
+import asyncio
+from datetime import timedelta
+from io import StringIO
 import json
+import logging
+import multiprocessing
+import os
 from random import random
-from unittest.mock import MagicMock
-
-from django.http import HttpResponse, JsonResponse
-from django.test import TestCase, Client
-from django.test.client import RequestFactory
+import sys
+import tempfile
+import time
+import traceback
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.test import (
+    TestCase, TransactionTestCase, LiveServerTestCase, AsyncClient, Client, override_settings,
+)
+from django.test.client import AsyncRequestFactory, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from .models import O11yLog
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+
+from .admin import EstimatedCountPaginator, estimate_count, render_flame_graph, render_waterfall
+from .api import route_stats
+import db_o11y
+from .baselines import Baseline, get_baselines, is_anomalous
+from .benchmark import Scenario, percentile as nearest_rank, scenarios
+from .buffer import RequestBuffer, current_buffer
+from .checks import check_o11y_database
+from .fields import JSON_MARKER, TEXT_MARKER
+from .errors import (
+    fingerprint_exception, fingerprint_traceback, group_exceptions, top_exceptions,
+)
+from .handlers import O11yLogHandler
+from .queries import QueryRecorder, fingerprint
+from .replay import Skip, build_request, replay, select_logs, summarise
+from . import memory
+from .metrics import MetricsFile, collect, mark_process_dead, render
+from .middleware import O11yMiddleware
+from .profiler import Profile, StackSampler, flame_tree
+from .routers import O11yRouter, configure_connection
+from .models import O11yException, O11yHighWaterMark, O11yLog, O11yLogDetail, O11yRollup
+from .rollup import LATENCY_BUCKETS, latency_summary, percentile, rollup_new_logs
 from .views import HtmlViews, HtmlFunView, ErrorFunView
 from .utils import (
     auto_log, 
@@ -15,10 +57,18 @@ from .utils import (
     _extract_request, 
     _extract_request_payload, 
     _extract_response_payload,
+    _extract_route,
     _extract_session_id, 
     _get_404,
     _get_500,
 )
+from .sampling import head_sampled, tail_keep
+from .spool import SpoolWriter, deserialize, serialize
+from .storage import write_logs
+from .writer import BufferedWriter
+
+
+WITH_MIDDLEWARE = settings.MIDDLEWARE + ['db_o11y.middleware.O11yMiddleware']
 
 
 def _pre_configure_response(func, request):
@@ -132,6 +182,55 @@ class AutoLogTest(WithClientMixin):
             self.assertIn('elapsed', item)
 
 
+class AsyncAutoLogTest(TestCase):
+
+    async def test_async_class_view(self):
+        response = await AsyncClient().get(reverse('async'))
+        self.assertEqual(response.status_code, 200)
+
+        log = await O11yLog.objects.alast()
+        self.assertEqual(log.response_code, 200)
+        self.assertEqual(log.method, 'GET')
+        self.assertEqual(len(log.logs), 1)
+        self.assertGreater(log.duration, 0)
+
+    async def test_async_exception_with_catch(self):
+        response = await AsyncClient().post(reverse('async'))
+        self.assertEqual(response.status_code, 500)
+
+        log = await O11yLog.objects.alast()
+        self.assertEqual(log.response_code, 500)
+        self.assertIn('async POST', log.exception)
+
+    async def test_async_function_view(self):
+        request = AsyncRequestFactory().get(f'{reverse("async")}?key1=value1')
+
+        @auto_log(log_inputs=True, log_outputs=True)
+        async def view(request):
+            request.add_log('inside')
+            return JsonResponse({'key': 'value'})
+        response = await view(request)
+
+        self.assertEqual(response.status_code, 200)
+        log = await O11yLog.objects.alast()
+        self.assertDictEqual(log.request_payload, {'key1': 'value1'})
+        self.assertDictEqual(log.response_payload, {'key': 'value'})
+        self.assertEqual(log.logs[0]['message'], 'inside')
+
+    async def test_async_exception_no_catch(self):
+        request = AsyncRequestFactory().get(reverse('async'))
+
+        @auto_log(catch_exceptions=False)
+        async def view(request):
+            raise ValueError('Bad async value')
+
+        with self.assertRaises(ValueError):
+            await view(request)
+        log = await O11yLog.objects.alast()
+        self.assertIn('Bad async value', log.exception)
+        self.assertIsNone(log.response_code)
+
+
 class Test404(WithClientMixin):
 
     def test_404_handled_html(self):
@@ -165,6 +264,25 @@ class ExtractRequestBaseUrlTest(WithClientMixin):
         self.assertEqual(extracted, url)
 
 
+class ExtractRouteTest(WithClientMixin):
+
+    def test_route_recorded(self):
+        self.client.get(reverse('json-detail', kwargs={'pk': 123}))
+
+        log = O11yLog.objects.last()
+        self.assertEqual(log.url, '/json/123/')
+        self.assertEqual(log.route, '/json/<int:pk>/')
+
+    def test_no_resolver_match(self):
+        request = RequestFactory().get(reverse('json-detail', kwargs={'pk': 123}))
+        self.assertIsNone(_extract_route(request))
+
+    @override_settings(MIDDLEWARE=WITH_MIDDLEWARE)
+    def test_route_recorded_by_middleware(self):
+        self.client.get(reverse('plain'))
+        self.assertEqual(O11yLog.objects.last().route, '/plain/')
+
+
 class ExtractRequestTest(WithClientMixin):
 
     def test_first_arg(self):
@@ -183,6 +301,10 @@ class ExtractRequestTest(WithClientMixin):
         args[idx] = request
         self.assertEqual(_extract_request(*args), request)
 
+    def test_asgi_request(self):
+        request = AsyncRequestFactory().get(reverse("html"))
+        self.assertEqual(_extract_request(None, request), request)
+
     def test_no_request_present(self):
         args = [i for i in range(100)]
         with self.assertRaises(Exception):
@@ -367,3 +489,1923 @@ class FunctionViewTest(WithClientMixin):
         response = view(request)
 
         self.assertEqual(response, custom_500)
+
+
+class BufferedWriterTest(TestCase):
+
+    def _log(self):
+        return O11yLog(url='/', method='GET')
+
+    def test_flush_writes_queued_logs(self):
+        writer = BufferedWriter(batch_size=2)
+        for _ in range(5):
+            self.assertTrue(writer.put(self._log()))
+        self.assertEqual(O11yLog.objects.count(), 0)
+
+        writer.flush()
+        self.assertEqual(O11yLog.objects.count(), 5)
+        self.assertEqual(writer.stats(), {'queued': 0, 'dropped': 0, 'flushed': 5, 'failed': 0})
+
+    def test_full_queue_drops(self):
+        writer = BufferedWriter(max_size=2)
+        results = [writer.put(self._log()) for _ in range(3)]
+        self.assertListEqual(results, [True, True, False])
+        self.assertEqual(writer.dropped, 1)
+
+    def test_full_queue_block_policy_drops_after_timeout(self):
+        writer = BufferedWriter(max_size=1, policy='block', block_timeout=0.01)
+        writer.put(self._log())
+        self.assertFalse(writer.put(self._log()))
+        self.assertEqual(writer.dropped, 1)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BufferedWriter(policy='nope')
+
+    def test_failed_write_is_counted(self):
+        writer = BufferedWriter()
+        writer.put(self._log())
+        with (
+            patch('db_o11y.writer.write_logs', side_effect=Exception('db down')),
+            self.assertLogs('db_o11y.writer', level='ERROR'),
+        ):
+            writer.flush()
+        self.assertEqual(writer.failed, 1)
+        self.assertEqual(writer.flushed, 0)
+
+    def test_stop_flushes_without_thread(self):
+        writer = BufferedWriter()
+        writer.put(self._log())
+        writer.stop()
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    @override_settings(O11Y_BUFFERED_WRITES=True)
+    def test_auto_log_uses_writer(self):
+        writer = BufferedWriter()
+        with patch('db_o11y.utils.get_writer', return_value=writer):
+            Client().get(reverse('html'))
+
+        self.assertEqual(O11yLog.objects.count(), 0)
+        writer.flush()
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+
+class BufferedWriterThreadTest(TransactionTestCase):
+
+    def test_thread_writes_on_stop(self):
+        writer = BufferedWriter(batch_size=10, flush_interval=0.05)
+        writer.start()
+        self.assertTrue(writer.running)
+        for _ in range(25):
+            writer.put(O11yLog(url='/', method='GET'))
+
+        writer.stop()
+        self.assertFalse(writer.running)
+        self.assertEqual(O11yLog.objects.count(), 25)
+        self.assertEqual(writer.flushed, 25)
+
+
+@override_settings(MIDDLEWARE=WITH_MIDDLEWARE)
+class O11yMiddlewareTest(TestCase):
+
+    def test_logs_undecorated_view(self):
+        Client().get(reverse('plain'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+        log = O11yLog.objects.first()
+        self.assertEqual(log.url, reverse('plain'))
+        self.assertEqual(log.response_code, 200)
+        self.assertEqual(len(log.logs), 1)
+
+    def test_view_exception_recorded(self):
+        response = Client(raise_request_exception=False).get(reverse('plain-error'))
+        self.assertEqual(response.status_code, 500)
+
+        log = O11yLog.objects.last()
+        self.assertEqual(log.response_code, 500)
+        self.assertIn('Bad value', log.exception)
+
+    def test_decorated_view_logged_once(self):
+        Client().get(reverse('error'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+        # the decorator's catch_exceptions still applies, with the exception on the outer log
+        log = O11yLog.objects.first()
+        self.assertEqual(log.response_code, 500)
+        self.assertIn('Raising on GET', log.exception)
+
+    def test_unknown_url_logged(self):
+        Client().get('/does-not-exist/')
+        self.assertEqual(O11yLog.objects.last().response_code, 404)
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE)
+    def test_undecorated_view_without_middleware(self):
+        response = Client().get(reverse('plain'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(O11yLog.objects.exists())
+
+        with self.assertRaises(ValueError):
+            Client().get(reverse('plain-error'))
+
+    @override_settings(O11Y_MIDDLEWARE_EXCLUDE=[r'/plain/', r'/health'])
+    def test_exclude(self):
+        Client().get(reverse('plain'))
+        self.assertEqual(O11yLog.objects.count(), 0)
+        Client().get(reverse('json'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    @override_settings(O11Y_MIDDLEWARE_INCLUDE=[r'/json/'])
+    def test_include(self):
+        Client().get(reverse('plain'))
+        self.assertEqual(O11yLog.objects.count(), 0)
+        Client().get(reverse('json'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    @override_settings(O11Y_MIDDLEWARE_LOG_INPUTS=True)
+    def test_log_inputs(self):
+        Client().get(f'{reverse("plain")}?key1=value1')
+        self.assertDictEqual(O11yLog.objects.last().request_payload, {'key1': 'value1'})
+
+    async def test_async(self):
+        response = await AsyncClient().get(reverse('plain'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await O11yLog.objects.acount(), 1)
+
+    def test_should_log(self):
+        with self.settings(
+            O11Y_MIDDLEWARE_INCLUDE=[r'/api/'], O11Y_MIDDLEWARE_EXCLUDE=[r'/api/health']
+        ):
+            middleware = O11yMiddleware(lambda request: None)
+        self.assertTrue(middleware.should_log('/api/orders/'))
+        self.assertFalse(middleware.should_log('/api/health/'))
+        self.assertFalse(middleware.should_log('/admin/'))
+
+
+class SamplingTest(TestCase):
+
+    def _view(self, status=200, exc=None, **kwargs):
+        @auto_log(**kwargs)
+        def view(request):
+            request.add_log('ignored if not sampled')
+            if exc is not None:
+                raise exc
+            return HttpResponse('<h1>GET</h1>', status=status)
+        return view
+
+    def test_not_sampled_not_saved(self):
+        self._view(sample_rate=0)(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.count(), 0)
+
+    def test_sampled_saved(self):
+        self._view(sample_rate=1)(RequestFactory().get(reverse('html')))
+        self.assertEqual(len(O11yLog.objects.get().logs), 1)
+
+    def test_not_sampled_payload_not_extracted(self):
+        with patch('db_o11y.utils._extract_request_payload') as extract:
+            self._view(sample_rate=0, log_inputs=True)(RequestFactory().get(reverse('html')))
+        extract.assert_not_called()
+
+    def test_not_sampled_exception_kept(self):
+        response = self._view(sample_rate=0, exc=ValueError('kept'))(
+            RequestFactory().get(reverse('html'))
+        )
+        self.assertEqual(response.status_code, 500)
+
+        log = O11yLog.objects.get()
+        self.assertEqual(log.response_code, 500)
+        self.assertIn('kept', log.exception)
+        self.assertIsNone(log.logs)
+        self.assertIsNotNone(log.duration)
+
+    def test_not_sampled_5xx_kept(self):
+        self._view(sample_rate=0, status=503)(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.get().response_code, 503)
+
+    @override_settings(O11Y_TAIL_KEEP_ERRORS=False)
+    def test_not_sampled_errors_dropped_if_disabled(self):
+        self._view(sample_rate=0, status=503)(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.count(), 0)
+
+    def test_not_sampled_slow_kept(self):
+        self._view(sample_rate=0, slow_threshold=-1)(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    def test_not_sampled_exception_no_catch(self):
+        view = self._view(sample_rate=0, exc=ValueError('raised'), catch_exceptions=False)
+        with self.assertRaises(ValueError):
+            view(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().response_code)
+
+    @override_settings(O11Y_SAMPLE_RATE=0, O11Y_SAMPLE_RATES={r'/json/': 1})
+    def test_route_rates(self):
+        self.assertTrue(head_sampled('/json/'))
+        self.assertFalse(head_sampled('/html/'))
+        # an explicit rate beats the settings
+        self.assertTrue(head_sampled('/html/', 1))
+
+    @override_settings(O11Y_SAMPLE_RATE=0, O11Y_SAMPLE_RATES={r'/json/': 1})
+    def test_route_rates_ignore_script_name(self):
+        @auto_log()
+        def view(request):
+            return HttpResponse('<h1>GET</h1>')
+
+        view(RequestFactory().get('/json/', SCRIPT_NAME='/app'))
+        self.assertEqual(O11yLog.objects.get().url, '/app/json/')
+
+    def test_tail_keep(self):
+        self.assertTrue(tail_keep(500, None, 0))
+        self.assertTrue(tail_keep(None, 'Traceback', 0))
+        self.assertFalse(tail_keep(404, None, 0))
+        self.assertFalse(tail_keep(200, None, 2))
+        self.assertTrue(tail_keep(200, None, 2, slow_threshold=1))
+        with self.settings(O11Y_TAIL_SLOW_THRESHOLD=1):
+            self.assertTrue(tail_keep(200, None, 2))
+
+    @override_settings(MIDDLEWARE=WITH_MIDDLEWARE, O11Y_SAMPLE_RATE=0)
+    def test_middleware_not_sampled(self):
+        Client().get(reverse('json'))
+        self.assertEqual(O11yLog.objects.count(), 0)
+        Client().get(reverse('error'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+
+class PruneCommandTest(TestCase):
+
+    def _create(self, days_old, response_code):
+        log = O11yLog.objects.create(url='/', method='GET', response_code=response_code)
+        O11yLog.objects.filter(id=log.id).update(
+            created_at=timezone.now() - timedelta(days=days_old)
+        )
+
+    def _prune(self, *args):
+        out = StringIO()
+        call_command('o11y_prune', '--sleep=0', *args, stdout=out)
+        return out.getvalue()
+
+    def setUp(self):
+        for days_old, response_code in (
+            (1, 200), (40, 200), (40, None), (40, 500), (100, 500), (100, 404),
+        ):
+            self._create(days_old, response_code)
+
+    def test_default_retention(self):
+        output = self._prune()
+        self.assertIn('Deleted 5 logs', output)
+        self.assertIn('rows/s', output)
+        self.assertListEqual(list(O11yLog.objects.values_list('response_code', flat=True)), [200])
+
+    def test_status_retention(self):
+        self._prune('--status-days=5xx=60', '--chunk-size=1')
+        self.assertListEqual(
+            sorted(O11yLog.objects.values_list('response_code', flat=True)), [200, 500]
+        )
+
+    @override_settings(O11Y_RETENTION_DAYS=365, O11Y_RETENTION_DAYS_BY_STATUS={'4xx': 10})
+    def test_settings(self):
+        self._prune()
+        self.assertEqual(O11yLog.objects.count(), 5)
+        self.assertFalse(O11yLog.objects.filter(response_code=404).exists())
+
+    def test_dry_run(self):
+        output = self._prune('--dry-run', '--days=50')
+        self.assertIn('Would delete 2 logs', output)
+        self.assertEqual(O11yLog.objects.count(), 6)
+
+    def test_invalid_status_days(self):
+        for value in ('6xx=10', '5xx', '5xx=soon'):
+            with self.subTest(value), self.assertRaises(CommandError):
+                self._prune(f'--status-days={value}')
+
+
+class HighVolumeAdminTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.client.force_login(
+            User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        )
+        O11yLog.objects.bulk_create([
+            O11yLog(url=f'/orders/{i}/', route='/orders/<int:pk>/', method='GET',
+                    response_code=200 if i % 2 else 500, logs=[{'message': 'x'}])
+            for i in range(5)
+        ])
+        self.url = reverse('admin:db_o11y_o11ylog_changelist')
+
+    def test_default_mode(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(getattr(response.context['cl'], 'keyset', False))
+
+    @override_settings(O11Y_ADMIN_HIGH_VOLUME=True)
+    def test_keyset_pages(self):
+        with patch('db_o11y.admin.O11yLogAdmin.list_per_page', 2):
+            seen = []
+            url = self.url
+            while url:
+                response = self.client.get(url if url.startswith('/') else self.url + url)
+                self.assertEqual(response.status_code, 200)
+                cl = response.context['cl']
+                seen.extend(log.id for log in cl.result_list)
+                url = cl.next_page_url
+
+        expected = O11yLog.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        self.assertListEqual(seen, list(expected))
+
+    @override_settings(O11Y_ADMIN_HIGH_VOLUME=True)
+    def test_heavy_fields_deferred(self):
+        cl = self.client.get(self.url).context['cl']
+        self.assertIn('logs', cl.result_list[0].get_deferred_fields())
+
+    @override_settings(O11Y_ADMIN_HIGH_VOLUME=True)
+    def test_cached_filter(self):
+        response = self.client.get(self.url, {'response_code': '500'})
+        cl = response.context['cl']
+        self.assertEqual(len(cl.result_list), 3)
+        self.assertEqual(cl.result_count, 3)
+
+        # choices are cached, so new values don't show up straight away
+        O11yLog.objects.create(url='/', method='PATCH')
+        response = self.client.get(self.url)
+        self.assertNotContains(response, '?method=PATCH')
+
+    @override_settings(O11Y_ADMIN_HIGH_VOLUME=True)
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_estimate_count(self):
+        self.assertEqual(estimate_count(O11yLog), 5)
+
+    def test_estimate_count_from_statistics(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        # not counted until the statistics are next updated
+        O11yLog.objects.create(url='/orders/5/', method='GET')
+        self.assertEqual(estimate_count(O11yLog), 5)
+
+    def test_estimate_count_without_statistics(self):
+        # rows kept among deleted ones leave gaps in the ids
+        O11yLog.objects.create(url='/orders/5/', method='GET')
+        O11yLog.objects.filter(id__in=O11yLog.objects.order_by('id').values('id')[1:4]).delete()
+        # small tables are counted
+        self.assertEqual(estimate_count(O11yLog), 3)
+        # larger ones are estimated from the range of their ids
+        with override_settings(O11Y_ADMIN_COUNT_LIMIT=2):
+            self.assertEqual(estimate_count(O11yLog), 6)
+
+    @override_settings(O11Y_ADMIN_COUNT_LIMIT=3)
+    def test_filtered_count_limited(self):
+        paginator = EstimatedCountPaginator(O11yLog.objects.filter(method='GET').order_by('id'), 2)
+        self.assertEqual(paginator.count, 3)
+
+
+def _create_log(route, duration, response_code=200, method='GET', minutes_old=10):
+    log = O11yLog.objects.create(
+        url=route, route=route, method=method, response_code=response_code, duration=duration
+    )
+    O11yLog.objects.filter(id=log.id).update(
+        created_at=timezone.now() - timedelta(minutes=minutes_old)
+    )
+
+
+class RollupTest(TestCase):
+
+    def test_rollup(self):
+        for duration in (0.001, 0.02, 0.3, 20):
+            _create_log('/checkout/', duration)
+        _create_log('/checkout/', 1, response_code=503)
+        _create_log('/checkout/', 1, minutes_old=0)  # too recent
+
+        self.assertEqual(rollup_new_logs(), 5)
+        ok = O11yRollup.objects.get(route='/checkout/', status_class='2xx')
+        self.assertEqual(ok.count, 4)
+        self.assertEqual(ok.duration_min, 0.001)
+        self.assertEqual(ok.duration_max, 20)
+        self.assertAlmostEqual(ok.duration_sum, 20.321)
+        self.assertEqual(len(ok.histogram), len(LATENCY_BUCKETS) + 1)
+        buckets = [i for i, n in enumerate(ok.histogram) for _ in range(n)]
+        self.assertListEqual(buckets, [0, 2, 6, 11])
+        self.assertEqual(O11yRollup.objects.get(status_class='5xx').count, 1)
+
+    def test_incremental(self):
+        _create_log('/checkout/', 0.1)
+        self.assertEqual(rollup_new_logs(), 1)
+        self.assertEqual(rollup_new_logs(), 0)
+
+        _create_log('/checkout/', 0.3)
+        _create_log('/checkout/', 0.2)
+        self.assertEqual(rollup_new_logs(batch_size=1), 2)
+
+        rollup = O11yRollup.objects.get()
+        self.assertEqual(rollup.count, 3)
+        self.assertEqual(rollup.duration_max, 0.3)
+        self.assertEqual(
+            O11yHighWaterMark.objects.get(name='rollup').last_id, O11yLog.objects.latest('id').id
+        )
+
+    def test_latency_summary(self):
+        for i in range(100):
+            _create_log('/checkout/', (i + 1) / 1000)
+        _create_log('/other/', 5)
+        rollup_new_logs()
+
+        summary = latency_summary('/checkout/', timezone.now() - timedelta(days=1))
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['max'], 0.1)
+        self.assertAlmostEqual(summary['mean'], 0.0505)
+        self.assertAlmostEqual(summary['p50'], 0.05)
+        self.assertAlmostEqual(summary['p95'], 0.095)
+        self.assertDictEqual(latency_summary('/checkout/', timezone.now()), {'count': 0})
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([0] * 12, 0.5))
+        # all in the open-ended last bucket, so interpolate up to the max
+        self.assertEqual(percentile([0] * 11 + [2], 1, duration_max=30), 30)
+
+    def test_command(self):
+        _create_log('/checkout/', 0.1)
+        out = StringIO()
+        call_command('o11y_rollup', stdout=out)
+        self.assertIn('Rolled up 1 logs', out.getvalue())
+
+
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def _log(self, **kwargs):
+        return O11yLog(url='/', method='GET', response_code=200, **kwargs)
+
+    def _ingest(self, *args):
+        out = StringIO()
+        call_command('o11y_ingest', f'--spool-dir={self.directory}', *args, stdout=out)
+        return out.getvalue()
+
+    def test_serialize_round_trip(self):
+        log = self._log(request_payload={'key': 'value'}, response_payload='<h1>GET</h1>')
+        data = json.loads(json.dumps(serialize(log)))
+        copy = deserialize(data)
+        self.assertEqual(copy.created_at, log.created_at)
+        self.assertDictEqual(copy.request_payload, {'key': 'value'})
+        self.assertEqual(copy.response_payload, '<h1>GET</h1>')
+        self.assertEqual(deserialize({'url': '/x/', 'removed_field': 1}).url, '/x/')
+
+    def test_write_and_rotate(self):
+        spool = SpoolWriter(self.directory, max_bytes=1000)
+        for _ in range(10):
+            self.assertTrue(spool.write(self._log()))
+        spool.close()
+
+        names = os.listdir(self.directory)
+        self.assertGreater(len(names), 1)
+        self.assertTrue(all(name.endswith('.jsonl') for name in names))
+
+    def test_ingest(self):
+        spool = SpoolWriter(self.directory, max_bytes=1000)
+        for _ in range(10):
+            spool.write(self._log())
+        spool.close()
+
+        self.assertIn('Loaded 10 logs', self._ingest('--batch-size=3'))
+        self.assertEqual(O11yLog.objects.count(), 10)
+        self.assertListEqual(os.listdir(self.directory), [])
+        self.assertFalse(O11yHighWaterMark.objects.exists())
+
+    def test_ingest_active_file_resumes(self):
+        spool = SpoolWriter(self.directory)
+        spool.write(self._log())
+        self._ingest()
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+        # the file is still being written to, so it's kept and only new lines are loaded
+        spool.write(self._log())
+        with open(spool._path, 'ab') as f:
+            f.write(b'{"url": "/partial"')
+        self._ingest()
+        self.assertEqual(O11yLog.objects.count(), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_idle_active_file_kept(self):
+        spool = SpoolWriter(self.directory, max_bytes=1)
+        spool.write(self._log())
+        # idle for a long time, but its process is still running
+        os.utime(spool._path, (0, 0))
+        self._ingest('--stale-after=1')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        spool.write(self._log())
+        spool.close()
+        self._ingest()
+        self.assertEqual(O11yLog.objects.count(), 2)
+
+    def test_abandoned_active_file_loaded(self):
+        spool = SpoolWriter(self.directory)
+        spool.write(self._log())
+        # as if the process had been killed, which releases its lock
+        os.close(spool._fd)
+        spool._fd = None
+        os.utime(spool._path, (0, 0))
+        self._ingest('--stale-after=1')
+        self.assertEqual(O11yLog.objects.count(), 1)
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_deleted_active_file(self):
+        spool = SpoolWriter(self.directory, max_bytes=1)
+        spool.write(self._log())
+        os.remove(spool._path)
+        with self.assertLogs('db_o11y.spool'):
+            self.assertTrue(spool.write(self._log()))
+        # and rotates normally afterwards
+        self.assertTrue(spool.write(self._log()))
+        spool.close()
+        self._ingest()
+        self.assertEqual(O11yLog.objects.count(), 2)
+
+        spool.write(self._log())
+        os.remove(spool._path)
+        spool.close()
+        self.assertIsNone(spool._fd)
+
+    def test_ingest_file_gone(self):
+        with open(os.path.join(self.directory, 'o11y-2-1.jsonl'), 'w') as f:
+            f.write('{"url": "/", "method": "GET"}\n')
+        listdir = os.listdir
+
+        # as if another ingest had removed the first file since it was listed
+        def listed(directory):
+            return ['o11y-1-1.jsonl', *listdir(directory)]
+
+        with patch('os.listdir', listed):
+            self.assertIn('Loaded 1 logs', self._ingest())
+        self.assertEqual(O11yLog.objects.count(), 1)
+        self.assertFalse(O11yHighWaterMark.objects.exists())
+
+    def test_ingest_skips_malformed(self):
+        with open(os.path.join(self.directory, 'o11y-1-1.jsonl'), 'w') as f:
+            f.write('not json\n{"url": "/", "method": "GET"}\n')
+        self.assertIn('Skipped 1 malformed lines', self._ingest())
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    def test_write_failure_counted(self):
+        spool = SpoolWriter(os.path.join(self.directory, 'missing'))
+        with patch('os.write', side_effect=OSError('disk full')), self.assertLogs('db_o11y.spool'):
+            self.assertFalse(spool.write(self._log()))
+        self.assertEqual(spool.dropped, 1)
+
+    def test_auto_log_uses_spool(self):
+        spool = SpoolWriter(self.directory)
+        with (
+            self.settings(O11Y_SPOOL_DIR=self.directory),
+            patch('db_o11y.utils.get_spool', return_value=spool),
+        ):
+            Client().get(reverse('html'))
+        spool.close()
+
+        self.assertEqual(O11yLog.objects.count(), 0)
+        self._ingest()
+        self.assertEqual(O11yLog.objects.get().url, reverse('html'))
+
+
+class O11yRouterTest(TestCase):
+
+    def test_no_database_set(self):
+        self.assertIsNone(O11yRouter().db_for_write(O11yLog))
+        self.assertIsNone(O11yRouter().allow_migrate('default', 'db_o11y'))
+
+    @override_settings(O11Y_DATABASE='o11y')
+    def test_database_set(self):
+        router = O11yRouter()
+        self.assertEqual(router.db_for_read(O11yLog), 'o11y')
+        self.assertEqual(router.db_for_write(O11yRollup), 'o11y')
+        self.assertIsNone(router.db_for_write(User))
+
+        self.assertTrue(router.allow_migrate('o11y', 'db_o11y'))
+        self.assertFalse(router.allow_migrate('default', 'db_o11y'))
+        self.assertFalse(router.allow_migrate('o11y', 'auth'))
+        self.assertIsNone(router.allow_migrate('default', 'auth'))
+
+    @override_settings(O11Y_DATABASE='default')
+    def test_default_database_set(self):
+        router = O11yRouter()
+        self.assertTrue(router.allow_migrate('default', 'db_o11y'))
+        self.assertIsNone(router.allow_migrate('default', 'auth'))
+
+    def test_checks(self):
+        self.assertListEqual(check_o11y_database(None), [])
+        with self.settings(O11Y_DATABASE='missing'):
+            self.assertListEqual([e.id for e in check_o11y_database(None)], ['db_o11y.E001'])
+
+        o11y_database = {**settings.DATABASES['default'], 'ATOMIC_REQUESTS': True}
+        with (
+            self.settings(O11Y_DATABASE='o11y'),
+            patch.dict(settings.DATABASES, {'o11y': o11y_database}),
+        ):
+            self.assertListEqual([e.id for e in check_o11y_database(None)], ['db_o11y.W001'])
+
+    def test_sqlite_wal(self):
+        connection = MagicMock(alias='o11y', vendor='sqlite')
+        cursor = connection.cursor.return_value.__enter__.return_value
+
+        configure_connection(None, connection)
+        cursor.execute.assert_not_called()
+
+        with self.settings(O11Y_DATABASE='o11y'):
+            configure_connection(None, connection)
+        cursor.execute.assert_any_call('PRAGMA journal_mode=WAL')
+
+
+class QueryInstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user{i}') for i in range(6)]
+
+    def _view(self, **kwargs):
+        @auto_log(**kwargs)
+        def view(request):
+            # an N+1 - one query per user
+            for user in self.users:
+                User.objects.filter(id=user.id).first()
+            list(User.objects.filter(username__in=['a', 'b']))
+            return HttpResponse('<h1>GET</h1>')
+        return view
+
+    def test_disabled_by_default(self):
+        self._view()(RequestFactory().get(reverse('html')))
+        log = O11yLog.objects.get()
+        self.assertIsNone(log.query_count)
+        self.assertIsNone(log.queries)
+
+    def test_queries_recorded(self):
+        self._view(log_queries=True)(RequestFactory().get(reverse('html')))
+
+        log = O11yLog.objects.get()
+        self.assertEqual(log.query_count, 7)
+        self.assertGreater(log.query_time, 0)
+        self.assertEqual(len(log.queries['slowest']), 5)
+        self.assertEqual(len(log.queries['repeated']), 1)
+        self.assertEqual(log.queries['repeated'][0]['count'], 6)
+        self.assertIn('"auth_user"', log.queries['repeated'][0]['fingerprint'])
+
+    @override_settings(O11Y_LOG_QUERIES=True, O11Y_SAMPLE_RATE=0, O11Y_TAIL_SLOW_THRESHOLD=-1)
+    def test_not_sampled_not_instrumented(self):
+        self._view()(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().query_count)
+
+    def test_recorded_on_exception(self):
+        @auto_log(log_queries=True)
+        def view(request):
+            User.objects.count()
+            raise ValueError('Bad value')
+        view(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.get().query_count, 1)
+
+    async def test_async_view(self):
+        @auto_log(log_queries=True)
+        async def view(request):
+            await User.objects.acount()
+            async for user in User.objects.filter(username__startswith='user'):
+                pass
+            return HttpResponse('<h1>GET</h1>')
+
+        await view(AsyncRequestFactory().get(reverse('html')))
+        log = await O11yLog.objects.aget()
+        self.assertEqual(log.query_count, 2)
+        self.assertIn('"auth_user"', log.queries['slowest'][0]['sql'])
+
+    def test_outside_request_not_recorded(self):
+        @auto_log(log_queries=True)
+        def view(request):
+            return HttpResponse('<h1>GET</h1>')
+
+        view(RequestFactory().get(reverse('html')))
+        User.objects.count()
+        self.assertEqual(O11yLog.objects.get().query_count, 0)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE a = 'x''y' AND b = 12.5\n AND c IN (1, 2, 3)"),
+            'SELECT * FROM t WHERE a = ? AND b = ? AND c IN (...)',
+        )
+        self.assertEqual(
+            fingerprint('SELECT * FROM t WHERE id IN (%s, %s)'), 'SELECT * FROM t WHERE id IN (...)'
+        )
+
+    def test_recorder_keeps_slowest(self):
+        recorder = QueryRecorder(slowest=2, repeat_threshold=2)
+        for i, elapsed in enumerate((0.1, 0.5, 0.2, 0.4)):
+            recorder.record(f'SELECT {i}', elapsed)
+        summary = recorder.summary()
+        self.assertListEqual([q['time'] for q in summary['slowest']], [0.5, 0.4])
+        self.assertEqual(summary['repeated'][0]['count'], 4)
+        self.assertAlmostEqual(recorder.time, 1.2)
+
+    def test_admin_filter(self):
+        O11yLog.objects.create(url='/', method='GET', query_time=2)
+        O11yLog.objects.create(url='/', method='GET', query_time=0.001)
+        client = Client()
+        client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = client.get(reverse('admin:db_o11y_o11ylog_changelist'), {'query_time': 'gt1s'})
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+
+
+class SpanTest(TestCase):
+
+    def test_view_span(self):
+        Client().get(reverse('misc'))
+        span = O11yLog.objects.get().spans[0]
+        self.assertEqual(span['name'], 'sleep')
+        self.assertGreater(span['duration'], 1)
+        self.assertDictEqual(span['attributes'], {'seconds': 1})
+        self.assertIsNone(span['parent'])
+
+    def test_nested_spans(self):
+        @auto_log()
+        def view(request):
+            with request.span('outer') as outer:
+                with request.span('inner'):
+                    pass
+                outer.set('key', 'value')
+            with request.span('second'):
+                pass
+            return HttpResponse('<h1>GET</h1>')
+        view(RequestFactory().get(reverse('html')))
+
+        spans = O11yLog.objects.get().spans
+        self.assertListEqual([span['name'] for span in spans], ['outer', 'inner', 'second'])
+        self.assertListEqual([span['parent'] for span in spans], [None, 0, None])
+        self.assertDictEqual(spans[0]['attributes'], {'key': 'value'})
+        self.assertLessEqual(spans[0]['start'], spans[1]['start'])
+        self.assertGreaterEqual(spans[0]['duration'], spans[1]['duration'])
+
+    def test_span_decorator_and_error(self):
+        @auto_log()
+        def view(request):
+            @request.span('helper')
+            def helper(fail):
+                if fail:
+                    raise ValueError('Bad value')
+
+            helper(False)
+            helper(True)
+        view(RequestFactory().get(reverse('html')))
+
+        spans = O11yLog.objects.get().spans
+        self.assertEqual(len(spans), 2)
+        self.assertNotIn('error', spans[0])
+        self.assertEqual(spans[1]['error'], 'ValueError')
+
+    async def test_async_spans(self):
+        @auto_log()
+        async def view(request):
+            @request.span('task')
+            async def task():
+                await asyncio.sleep(0.01)
+
+            with request.span('gather'):
+                await asyncio.gather(task(), task())
+            return HttpResponse('<h1>GET</h1>')
+        await view(AsyncRequestFactory().get(reverse('html')))
+
+        spans = (await O11yLog.objects.aget()).spans
+        self.assertListEqual([span['name'] for span in spans], ['gather', 'task', 'task'])
+        # concurrent tasks are both children of the span that started them, not of each other
+        self.assertListEqual([span['parent'] for span in spans], [None, 0, 0])
+
+    def test_not_sampled_span_ignored(self):
+        @auto_log(sample_rate=0)
+        def view(request):
+            with request.span('ignored') as span:
+                span.set('key', 'value')
+            return HttpResponse('<h1>GET</h1>')
+        view(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.count(), 0)
+
+    def test_no_spans(self):
+        Client().get(reverse('html'))
+        self.assertIsNone(O11yLog.objects.get().spans)
+
+    def test_render_waterfall(self):
+        self.assertEqual(render_waterfall(None), '-')
+        html = render_waterfall([
+            {'name': 'outer', 'start': 0, 'duration': 0.5, 'parent': None},
+            {'name': '<inner>', 'start': 0.1, 'duration': 0.2, 'parent': 0, 'error': 'ValueError'},
+        ], duration=1)
+        self.assertIn('width: 50.00%', html)
+        self.assertIn('padding-left: 16px', html)
+        self.assertIn('&lt;inner&gt;', html)
+        self.assertIn('#ba2121', html)
+
+    def test_admin_change_page(self):
+        Client().get(reverse('misc'))
+        client = Client()
+        client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        log = O11yLog.objects.filter(spans__isnull=False).get()
+        response = client.get(reverse('admin:db_o11y_o11ylog_change', args=[log.id]))
+        self.assertContains(response, 'Span waterfall')
+        self.assertContains(response, 'title="sleep"')
+
+
+@db_o11y.span('decorated at import')
+def _service_call():
+    db_o11y.log('from the service')
+    logging.getLogger('db_o11y.tests.service').info('via logging %s', 'args')
+
+
+class CurrentRequestTest(TestCase):
+
+    def setUp(self):
+        self.handler = O11yLogHandler()
+        self.handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = logging.getLogger('db_o11y.tests.service')
+        logger.addHandler(self.handler)
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.removeHandler, self.handler)
+
+    def _view(self, **kwargs):
+        @auto_log(**kwargs)
+        def view(request):
+            _service_call()
+            return HttpResponse('<h1>GET</h1>')
+        return view
+
+    def test_logs_without_request(self):
+        self._view()(RequestFactory().get(reverse('html')))
+
+        log = O11yLog.objects.get()
+        self.assertListEqual(
+            [item['message'] for item in log.logs], ['from the service', 'INFO via logging args']
+        )
+        self.assertEqual(log.spans[0]['name'], 'decorated at import')
+        self.assertIsNone(current_buffer())
+
+    def test_outside_request(self):
+        # nothing to log to, but nothing breaks
+        _service_call()
+        with db_o11y.span('outside') as span:
+            span.set('key', 'value')
+
+    def test_not_sampled_not_formatted(self):
+        with patch.object(self.handler, 'format') as format:
+            self._view(sample_rate=0)(RequestFactory().get(reverse('html')))
+        format.assert_not_called()
+
+    async def test_async_tasks_isolated(self):
+        @auto_log()
+        async def view(request):
+            db_o11y.log(request.path)
+            await asyncio.sleep(0.01)
+            db_o11y.log(request.path)
+            return HttpResponse('<h1>GET</h1>')
+
+        await asyncio.gather(
+            view(AsyncRequestFactory().get('/first/')), view(AsyncRequestFactory().get('/second/'))
+        )
+        async for log in O11yLog.objects.all():
+            self.assertListEqual([item['message'] for item in log.logs], [log.url, log.url])
+
+
+@override_settings(O11Y_API_TOKEN='secret')
+class QueryApiTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION='Bearer secret')
+
+    def test_route_stats(self):
+        for i in range(100):
+            _create_log('/checkout/', (i + 1) / 1000)
+        _create_log('/checkout/', 2, response_code=503)
+        # an exception left for Django, which answered with a 500
+        _create_log('/checkout/', 1, method='POST', response_code=None)
+        _create_log('/old/', 1, minutes_old=120)
+
+        stats = route_stats(timezone.now() - timedelta(hours=1), timezone.now())
+        self.assertListEqual(
+            [(item['route'], item['method']) for item in stats],
+            [('/checkout/', 'GET'), ('/checkout/', 'POST')],
+        )
+        checkout = stats[0]
+        self.assertEqual(checkout['count'], 101)
+        self.assertAlmostEqual(checkout['error_rate'], 1 / 101)
+        self.assertAlmostEqual(checkout['requests_per_second'], 101 / 3600)
+        self.assertEqual(checkout['max'], 2)
+        self.assertAlmostEqual(checkout['p50'], 0.05, delta=0.005)
+        self.assertGreater(checkout['p99'], checkout['p95'])
+        self.assertEqual(stats[1]['error_rate'], 1)
+
+    def test_routes(self):
+        _create_log('/checkout/', 0.1)
+        _create_log('/other/', 0.2, method='POST')
+        response = self.client.get(reverse('db_o11y_api:routes'), {'method': 'POST'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertListEqual([item['route'] for item in data['routes']], ['/other/'])
+        self.assertIn('since', data)
+
+    def test_slow_routes(self):
+        _create_log('/fast/', 0.01)
+        _create_log('/slow/', 3)
+        _create_log('/medium/', 0.5)
+        response = self.client.get(reverse('db_o11y_api:slow-routes'), {'limit': 2})
+        data = response.json()
+        self.assertEqual(data['by'], 'p95')
+        self.assertListEqual([item['route'] for item in data['routes']], ['/slow/', '/medium/'])
+
+    def test_bad_request(self):
+        url = reverse('db_o11y_api:slow-routes')
+        self.assertEqual(self.client.get(url, {'by': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'window': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'window': 10 ** 9}).status_code, 400)
+        self.assertEqual(self.client.post(url).status_code, 405)
+
+    def test_access(self):
+        url = reverse('db_o11y_api:routes')
+        self.assertEqual(Client().get(url).status_code, 403)
+        self.assertEqual(
+            Client(HTTP_AUTHORIZATION='Bearer wrong').get(url).status_code, 403
+        )
+        client = Client()
+        client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(client.get(url).status_code, 200)
+        client.force_login(User.objects.create(username='user'))
+        self.assertEqual(client.get(url).status_code, 403)
+
+    def test_cached_per_bucket(self):
+        _create_log('/checkout/', 0.1)
+        url = reverse('db_o11y_api:routes')
+        # both requests in the same bucket
+        with patch('db_o11y.api.timezone.now', return_value=timezone.now()):
+            first = self.client.get(url).json()
+            _create_log('/checkout/', 0.1)
+            with CaptureQueriesContext(connection) as queries:
+                second = self.client.get(url).json()
+        self.assertEqual(len(queries), 0)
+        self.assertDictEqual(first, second)
+        # other parameters are cached separately
+        self.assertEqual(self.client.get(url, {'window': 60}).json()['routes'], [])
+
+class RequestBufferTest(TestCase):
+
+    def _messages(self, buffer):
+        return [item['message'] for item in buffer.logs()]
+
+    def test_unbounded(self):
+        buffer = RequestBuffer(keep_first=None, keep_last=None, max_bytes=None)
+        for i in range(1000):
+            buffer.add_log(str(i))
+        self.assertEqual(len(buffer.logs()), 1000)
+        self.assertEqual(buffer.dropped, 0)
+
+    def test_keeps_first_and_last(self):
+        buffer = RequestBuffer(keep_first=3, keep_last=2)
+        for i in range(10):
+            buffer.add_log(str(i))
+
+        logs = buffer.logs()
+        self.assertListEqual(
+            [item['message'] for item in logs], ['0', '1', '2', '[5 logs dropped]', '8', '9']
+        )
+        self.assertEqual(logs[3]['dropped'], 5)
+        elapsed = [item['elapsed'] for item in logs]
+        self.assertListEqual(elapsed, sorted(elapsed))
+
+    def test_no_tail(self):
+        buffer = RequestBuffer(keep_first=2, keep_last=0)
+        for i in range(5):
+            buffer.add_log(str(i))
+        self.assertListEqual(self._messages(buffer), ['0', '1', '[3 logs dropped]'])
+
+    def test_max_bytes(self):
+        buffer = RequestBuffer(keep_first=None, keep_last=10, max_bytes=10)
+        buffer.add_log('a' * 6)
+        # doesn't fit after the first, so goes to the tail, which can't hold it either
+        buffer.add_log('b' * 6)
+        # a later small log still can't go back into the head
+        buffer.add_log('c')
+        buffer.add_log('d' * 3)
+        # evicts the oldest tail logs to make room
+        buffer.add_log('e' * 3)
+        self.assertListEqual(self._messages(buffer), ['aaaaaa', '[3 logs dropped]', 'eee'])
+
+    def test_max_bytes_counts_encoded_bytes(self):
+        buffer = RequestBuffer(keep_first=None, keep_last=10, max_bytes=10)
+        # 3 characters, but 9 bytes as UTF-8
+        buffer.add_log('日本語')
+        buffer.add_log('ab')
+        buffer.add_log('c')
+        self.assertListEqual(self._messages(buffer), ['日本語', '[1 logs dropped]', 'c'])
+
+    @override_settings(O11Y_LOG_KEEP_FIRST=2, O11Y_LOG_KEEP_LAST=1, O11Y_LOG_MAX_BYTES=None)
+    def test_auto_log(self):
+        @auto_log()
+        def view(request):
+            for i in range(5):
+                request.add_log(str(i))
+            return HttpResponse('<h1>GET</h1>')
+
+        view(RequestFactory().get(reverse('html')))
+        log = O11yLog.objects.get()
+        self.assertListEqual(
+            [item['message'] for item in log.logs], ['0', '1', '[2 logs dropped]', '4']
+        )
+
+
+class PayloadCaptureTest(TestCase):
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=10)
+    def test_truncated(self):
+        payload = _extract_response_payload(HttpResponse('x' * 25))
+        self.assertEqual(payload, 'x' * 10 + '... [truncated, 25 bytes]')
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=4)
+    def test_truncated_mid_character(self):
+        payload = _extract_response_payload(HttpResponse('aaa\u00e9e'))
+        self.assertEqual(payload, 'aaa... [truncated, 6 bytes]')
+
+    def test_binary(self):
+        response = HttpResponse(b'\x89PNG\r\n', content_type='image/png')
+        self.assertEqual(_extract_response_payload(response), '[binary content: image/png, 6 bytes]')
+
+        # sniffed when the content type doesn't say
+        response = HttpResponse(b'\xff\xfe\x00\x01', content_type='application/octet-stream')
+        self.assertEqual(
+            _extract_response_payload(response),
+            '[binary content: application/octet-stream, 4 bytes]',
+        )
+
+    @override_settings(O11Y_PAYLOAD_PARSE_MAX_BYTES=10)
+    def test_large_json_not_parsed(self):
+        self.assertDictEqual(_extract_response_payload(JsonResponse({'a': 1})), {'a': 1})
+        payload = _extract_response_payload(JsonResponse({'key': 'value'}))
+        self.assertEqual(payload, '{"key": "value"}')
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=10)
+    def test_request_truncated(self):
+        request = RequestFactory().put(
+            reverse('html'), data=json.dumps({'key': 'a long value'}),
+            content_type='application/json',
+        )
+        self.assertEqual(
+            _extract_request_payload(request), '{"key": "a... [truncated, 23 bytes]'
+        )
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=10)
+    def test_form_truncated(self):
+        request = RequestFactory().post(reverse('html'), data={'a': 'xyz', 'b': 'x' * 1000, 'c': 'z'})
+        self.assertDictEqual(_extract_request_payload(request), {
+            'a': 'xyz',
+            'b': 'xxxxx... [truncated, 1000 bytes]',
+            'c': '... [truncated, 1 bytes]',
+        })
+
+        request = RequestFactory().get(reverse('html'), data={'q': '\u00e9' * 10})
+        self.assertDictEqual(
+            _extract_request_payload(request), {'q': '\u00e9' * 4 + '... [truncated, 20 bytes]'}
+        )
+
+    def _streaming_view(self, chunks, **kwargs):
+        @auto_log(log_outputs=True)
+        def view(request):
+            return StreamingHttpResponse(iter(chunks), **kwargs)
+        return view
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=8)
+    def test_streaming(self):
+        response = self._streaming_view([b'hello ', b'world', b'!'])(
+            RequestFactory().get(reverse('html'))
+        )
+        # not saved until the response has been sent
+        self.assertFalse(O11yLog.objects.exists())
+
+        self.assertEqual(b''.join(response.streaming_content), b'hello world!')
+        response.close()
+        log = O11yLog.objects.get()
+        self.assertEqual(log.response_payload, 'hello wo... [truncated, 12 bytes]')
+        self.assertEqual(log.response_code, 200)
+
+    def test_streaming_closed_unsent(self):
+        response = self._streaming_view([b'hello'])(RequestFactory().get(reverse('html')))
+        response.close()
+        response.close()
+        self.assertIsNone(O11yLog.objects.get().response_payload)
+
+    def test_streaming_binary(self):
+        response = self._streaming_view([b'\x00\x01'], content_type='video/mp4')(
+            RequestFactory().get(reverse('html'))
+        )
+        list(response.streaming_content)
+        self.assertEqual(
+            O11yLog.objects.get().response_payload, '[binary content: video/mp4, 2 bytes]'
+        )
+
+    def test_streaming_not_logged_without_log_outputs(self):
+        @auto_log()
+        def view(request):
+            return StreamingHttpResponse(iter([b'hello']))
+
+        view(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().response_payload)
+
+    async def test_async_streaming(self):
+        async def chunks():
+            yield b'hello '
+            yield b'world'
+
+        @auto_log(log_outputs=True)
+        async def view(request):
+            return StreamingHttpResponse(chunks())
+
+        response = await view(AsyncRequestFactory().get(reverse('html')))
+        self.assertEqual(b''.join([chunk async for chunk in response]), b'hello world')
+        log = await O11yLog.objects.aget()
+        self.assertEqual(log.response_payload, 'hello world')
+
+
+def _raise_value_error(message):
+    raise ValueError(message)
+
+
+class ExceptionGroupTest(TestCase):
+
+    def _view(self, message):
+        @auto_log()
+        def view(request):
+            _raise_value_error(message)
+        return view
+
+    def test_fingerprint_traceback(self):
+        first = 'Traceback:\n  File "/app/views.py", line 10, in get\nValueError: one'
+        moved = 'Traceback:\n  File "/app/views.py", line 12, in get\nValueError: two'
+        other = 'Traceback:\n  File "/app/views.py", line 10, in post\nValueError: one'
+        self.assertEqual(fingerprint_traceback(first)[0], fingerprint_traceback(moved)[0])
+        self.assertNotEqual(fingerprint_traceback(first)[0], fingerprint_traceback(other)[0])
+        self.assertEqual(fingerprint_traceback(first)[1:], ('ValueError', 'ValueError: one'))
+
+        venv = 'File "/venv/lib/site-packages/lib/x.py", line 1, in f\nKeyError: 1'
+        system = 'File "/usr/lib/site-packages/lib/x.py", line 2, in f\nKeyError: 2'
+        self.assertEqual(fingerprint_traceback(venv)[0], fingerprint_traceback(system)[0])
+
+    def test_fingerprint_exception(self):
+        message = 'relation "t" does not exist\nLINE 1: SELECT * FROM t\n                      ^'
+        try:
+            try:
+                _raise_value_error(message)
+            except ValueError as e:
+                raise KeyError('k') from e
+        except KeyError as e:
+            exc = e
+
+        key, exception_type, summary = fingerprint_exception(exc)
+        self.assertEqual(exception_type, 'KeyError')
+        self.assertEqual(summary, "KeyError: 'k'")
+        # the same as parsing the formatted traceback, as for spooled logs
+        self.assertEqual(key, fingerprint_traceback(''.join(traceback.format_exception(exc)))[0])
+
+        key, exception_type, summary = fingerprint_exception(exc.__cause__)
+        self.assertEqual(exception_type, 'ValueError')
+        self.assertEqual(summary, f'ValueError: {message}')
+        self.assertEqual(fingerprint_traceback(
+            ''.join(traceback.format_exception(exc.__cause__))
+        )[1], 'ValueError')
+
+    def test_multiline_message(self):
+        message = 'relation "t" does not exist\nLINE 1: SELECT * FROM t\n                      ^'
+        self._view(message)(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yException.objects.get().exception_type, 'ValueError')
+        self.assertEqual(O11yLog.objects.get().exception, f'ValueError: {message}')
+
+    def test_grouped(self):
+        self._view('first')(RequestFactory().get(reverse('html')))
+        self._view('second')(RequestFactory().get(reverse('html')))
+
+        group = O11yException.objects.get()
+        self.assertEqual(group.count, 2)
+        self.assertEqual(group.exception_type, 'ValueError')
+        self.assertIn('_raise_value_error', group.traceback)
+        self.assertIn('ValueError: first', group.traceback)
+        self.assertLessEqual(group.first_seen, group.last_seen)
+        self.assertListEqual(
+            sorted(O11yLog.objects.values_list('exception', flat=True)),
+            ['ValueError: first', 'ValueError: second'],
+        )
+        self.assertEqual(group.logs.count(), 2)
+
+    def test_batch(self):
+        now = timezone.now()
+        logs = [
+            O11yLog(
+                url='/', method='GET', created_at=now + timedelta(seconds=i),
+                exception=f'  File "/app/x.py", line {i}, in f\nKeyError: {i}',
+            )
+            for i in range(3)
+        ] + [O11yLog(url='/', method='GET')]
+        group_exceptions(logs)
+        O11yLog.objects.bulk_create(logs)
+
+        group = O11yException.objects.get()
+        self.assertEqual(group.count, 3)
+        self.assertEqual(group.first_seen, now)
+        self.assertEqual(group.last_seen, now + timedelta(seconds=2))
+        self.assertIsNone(logs[-1].exception_group_id)
+
+        # already grouped logs aren't counted again
+        group_exceptions(logs)
+        self.assertEqual(O11yException.objects.get().count, 3)
+
+    def test_buffered_writer(self):
+        writer = BufferedWriter()
+        for i in range(2):
+            writer.put(O11yLog(url='/', method='GET', exception=f'KeyError: {i}'))
+        writer.flush()
+        self.assertEqual(O11yException.objects.get().count, 2)
+
+    def test_top_exceptions(self):
+        self._view('first')(RequestFactory().get(reverse('html')))
+        self._view('second')(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yException.objects.count(), 1)
+
+        log = O11yLog.objects.create(url='/', method='GET', exception='KeyError: x')
+        group_exceptions([log])
+        log.save()
+
+        top = top_exceptions()
+        self.assertListEqual(
+            [(group.exception_type, n) for group, n in top], [('ValueError', 2), ('KeyError', 1)]
+        )
+        self.assertListEqual(top_exceptions(since=timezone.now() + timedelta(hours=1)), [])
+
+    def test_pruned(self):
+        self._view('first')(RequestFactory().get(reverse('html')))
+        O11yException.objects.update(last_seen=timezone.now() - timedelta(days=100))
+        O11yLog.objects.update(created_at=timezone.now() - timedelta(days=100))
+        call_command('o11y_prune', '--sleep=0', stdout=StringIO())
+        self.assertFalse(O11yException.objects.exists())
+
+
+@override_settings(O11Y_COMPRESS=True, O11Y_COMPRESS_MIN_BYTES=100)
+class CompressionTest(TestCase):
+
+    def _raw(self, log, field):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {field} FROM db_o11y_o11ylog WHERE id = %s', [log.id])
+            return cursor.fetchone()[0]
+
+    def test_round_trip(self):
+        payload = {'items': ['item'] * 100}
+        log = O11yLog.objects.create(
+            url='/', method='GET', request_payload=payload, response_payload={'small': 1},
+            logs=[{'elapsed': 0.1, 'message': 'x' * 200}], exception='Traceback\n' * 50,
+        )
+        self.assertIn(JSON_MARKER, self._raw(log, 'request_payload'))
+        self.assertNotIn(JSON_MARKER, self._raw(log, 'response_payload'))
+        self.assertTrue(self._raw(log, 'exception').startswith(TEXT_MARKER))
+        self.assertLess(len(self._raw(log, 'request_payload')), len(json.dumps(payload)))
+
+        log = O11yLog.objects.get()
+        self.assertDictEqual(log.request_payload, payload)
+        self.assertDictEqual(log.response_payload, {'small': 1})
+        self.assertEqual(log.logs[0]['message'], 'x' * 200)
+        self.assertEqual(log.exception, 'Traceback\n' * 50)
+
+    def test_min_bytes_counts_encoded_bytes(self):
+        # 60 characters, but 120 bytes as UTF-8
+        log = O11yLog.objects.create(url='/', method='GET', exception='é' * 60)
+        self.assertTrue(self._raw(log, 'exception').startswith(TEXT_MARKER))
+        self.assertEqual(O11yLog.objects.get().exception, 'é' * 60)
+
+    def test_bulk_create(self):
+        O11yLog.objects.bulk_create([O11yLog(url='/', method='GET', logs=['x' * 200])])
+        log = O11yLog.objects.get()
+        self.assertIn(JSON_MARKER, self._raw(log, 'logs'))
+        self.assertListEqual(log.logs, ['x' * 200])
+
+    def test_read_when_disabled(self):
+        log = O11yLog.objects.create(url='/', method='GET', exception='x' * 200)
+        with self.settings(O11Y_COMPRESS=False):
+            self.assertEqual(O11yLog.objects.get().exception, 'x' * 200)
+
+    def test_values_like_marker(self):
+        log = O11yLog.objects.create(
+            url='/', method='GET', request_payload={JSON_MARKER: 'abc'}, exception=TEXT_MARKER,
+        )
+        log = O11yLog.objects.get(id=log.id)
+        self.assertDictEqual(log.request_payload, {JSON_MARKER: 'abc'})
+        self.assertEqual(log.exception, TEXT_MARKER)
+
+    def test_command(self):
+        with self.settings(O11Y_COMPRESS=False):
+            for _ in range(3):
+                O11yLog.objects.create(url='/', method='GET', request_payload={'a': 'b' * 500})
+        self.assertNotIn(JSON_MARKER, self._raw(O11yLog.objects.first(), 'request_payload'))
+
+        out = StringIO()
+        call_command('o11y_compress', '--chunk-size=2', '--sleep=0', stdout=out)
+        self.assertIn('Rewrote 3 rows as compressed', out.getvalue())
+        ratio = float(out.getvalue().split('(')[-1].split('x)')[0])
+        self.assertGreater(ratio, 5)
+        for log in O11yLog.objects.all():
+            self.assertIn(JSON_MARKER, self._raw(log, 'request_payload'))
+            self.assertDictEqual(log.request_payload, {'a': 'b' * 500})
+
+        with self.settings(O11Y_COMPRESS=False):
+            call_command('o11y_compress', '--sleep=0', stdout=StringIO())
+        self.assertNotIn(JSON_MARKER, self._raw(O11yLog.objects.first(), 'request_payload'))
+
+
+@override_settings(O11Y_DETAIL_TABLE=True)
+class DetailTableTest(TestCase):
+
+    def _view(self):
+        @auto_log(log_inputs=True, log_outputs=True)
+        def view(request):
+            request.add_log('hello')
+            return JsonResponse({'key': 'value'})
+        return view
+
+    def test_split(self):
+        self._view()(RequestFactory().get(f'{reverse("json")}?a=b'))
+
+        log = O11yLog.objects.get()
+        self.assertIsNone(log.request_payload)
+        self.assertIsNone(log.logs)
+        self.assertEqual(log.response_code, 200)
+        self.assertDictEqual(log.detail.request_payload, {'a': 'b'})
+        self.assertDictEqual(log.detail.response_payload, {'key': 'value'})
+        self.assertEqual(log.detail.logs[0]['message'], 'hello')
+
+    def test_nothing_to_store(self):
+        @auto_log()
+        def view(request):
+            return HttpResponse('<h1>GET</h1>')
+
+        view(RequestFactory().get(reverse('html')))
+        self.assertEqual(O11yLog.objects.count(), 1)
+        self.assertFalse(O11yLogDetail.objects.exists())
+
+    def test_exception(self):
+        @auto_log()
+        def view(request):
+            raise ValueError('detail')
+
+        view(RequestFactory().get(reverse('html')))
+        log = O11yLog.objects.get()
+        self.assertIsNone(log.exception)
+        self.assertEqual(log.detail.exception, 'ValueError: detail')
+        self.assertEqual(log.exception_group.count, 1)
+
+    def test_buffered_writer(self):
+        writer = BufferedWriter()
+        writer.put(O11yLog(url='/', method='GET', logs=[{'elapsed': 0, 'message': 'a'}]))
+        writer.put(O11yLog(url='/', method='GET'))
+        writer.flush()
+        self.assertEqual(O11yLog.objects.count(), 2)
+        self.assertEqual(O11yLogDetail.objects.get().logs[0]['message'], 'a')
+
+    def test_prune(self):
+        self._view()(RequestFactory().get(reverse('json')))
+        O11yLog.objects.update(created_at=timezone.now() - timedelta(days=100))
+        call_command('o11y_prune', '--sleep=0', stdout=StringIO())
+        self.assertFalse(O11yLog.objects.exists())
+        self.assertFalse(O11yLogDetail.objects.exists())
+
+    def test_admin_change_view(self):
+        self._view()(RequestFactory().get(f'{reverse("json")}?a=b'))
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        client = Client()
+        client.force_login(user)
+
+        log = O11yLog.objects.get()
+        response = client.get(reverse('admin:db_o11y_o11ylog_change', args=[log.id]))
+        self.assertContains(response, 'hello')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('admin:db_o11y_o11ylog_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('o11ylogdetail' in query['sql'] for query in queries))
+
+
+class BenchmarkTest(TestCase):
+
+    def test_scenarios(self):
+        generated = list(scenarios(
+            ['synthetic', 'json'], [0, 10], [0, 100], [(False, False), (True, True)], [1, 2],
+        ))
+        # 2 log counts x 2 sizes x 2 io modes x 2 concurrency levels, then 2 x 2 for json
+        self.assertEqual(len(generated), 20)
+        self.assertEqual(len({scenario.key() for scenario in generated}), 20)
+        with self.assertRaises(ValueError):
+            list(scenarios(['nope'], [0], [0], [(False, False)], [1]))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(nearest_rank(values, 0.5), 50)
+        self.assertEqual(nearest_rank(values, 0.99), 99)
+        self.assertIsNone(nearest_rank([], 0.5))
+
+    def test_baseline_view(self):
+        baseline, decorated = Scenario(log_count=3, payload_bytes=10).views()
+        response = baseline(Scenario().request())
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(O11yLog.objects.exists())
+
+        decorated(Scenario().request())
+        self.assertEqual(len(O11yLog.objects.get().logs), 3)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'benchmark.json')
+            out = StringIO()
+            call_command(
+                'o11y_benchmark', '--requests=5', '--warmup=1', '--allocation-requests=2',
+                '--views=synthetic,html', '--logs=1', '--payload-bytes=0,10', '--io=none,both',
+                '--concurrency=1', f'--output={path}', stdout=out,
+            )
+            with open(path) as f:
+                report = json.load(f)
+
+            self.assertEqual(len(report['results']), 6)
+            result = report['results'][0]
+            self.assertEqual(result['view'], 'synthetic')
+            for key in ('p50', 'p99', 'peak_bytes', 'retained_bytes'):
+                self.assertIn(key, result['overhead'])
+            self.assertGreater(result['auto_log']['requests_per_second'], 0)
+            # the logs written while benchmarking are removed
+            self.assertFalse(O11yLog.objects.exists())
+
+            out = StringIO()
+            call_command(
+                'o11y_benchmark', '--requests=5', '--warmup=1', '--allocation-requests=0',
+                '--views=html', '--io=none', '--concurrency=1', f'--compare={path}', stdout=out,
+            )
+            self.assertIn('html logs=0 payload=0 io=none threads=1 p99:', out.getvalue())
+
+    def test_command_invalid(self):
+        with self.assertRaises(CommandError):
+            call_command('o11y_benchmark', '--io=sometimes', stdout=StringIO())
+
+
+class ReplayTest(TestCase):
+
+    def _create(self, url='/json/', method='GET', payload=None, **kwargs):
+        kwargs.setdefault('response_code', 200)
+        kwargs.setdefault('request_start', timezone.now())
+        return O11yLog.objects.create(
+            url=url, route=url, method=method, request_payload=payload, duration=0.1, **kwargs
+        )
+
+    def test_build_request(self):
+        request = build_request(self._create(payload={'q': 'a b'}), 'http://test/')
+        self.assertEqual(request.full_url, 'http://test/json/?q=a+b')
+        self.assertIsNone(request.data)
+
+        request = build_request(self._create(method='POST', payload={'name': 'x'}), 'http://test')
+        self.assertEqual(request.data, b'name=x')
+        self.assertEqual(request.get_header('Content-type'), 'application/x-www-form-urlencoded')
+
+        request = build_request(
+            self._create(method='PUT', payload={'id': 1}), 'http://test', {'Authorization': 'x'}
+        )
+        self.assertEqual(request.get_method(), 'PUT')
+        self.assertEqual(json.loads(request.data), {'id': 1})
+        self.assertEqual(request.get_header('Authorization'), 'x')
+
+        for payload in ('[binary content: image/png, 100 bytes]', 'abc... [truncated, 9 bytes]'):
+            with self.assertRaises(Skip):
+                build_request(self._create(method='PUT', payload=payload), 'http://test')
+
+    def _logged(self, request):
+        @auto_log(log_inputs=True)
+        def view(request):
+            return HttpResponse('<h1>OK</h1>')
+        view(request)
+        return O11yLog.objects.latest('id')
+
+    @override_settings(O11Y_PAYLOAD_MAX_BYTES=20)
+    def test_truncated_form_skipped(self):
+        for request in (
+            RequestFactory().get(reverse('html'), {'q': 'x' * 50}),
+            RequestFactory().post(reverse('html'), {'q': 'x' * 50}),
+        ):
+            with self.assertRaises(Skip):
+                build_request(self._logged(request), 'http://test')
+
+    @override_settings(O11Y_PAYLOAD_PARSE_MAX_BYTES=10)
+    def test_unparsed_json_body(self):
+        body = json.dumps({'items': list(range(20))})
+        log = self._logged(
+            RequestFactory().put(reverse('html'), body, content_type='application/json')
+        )
+        # too big to parse, so stored as the text sent
+        self.assertEqual(log.request_payload, body)
+
+        request = build_request(log, 'http://test')
+        self.assertEqual(request.data, body.encode())
+        self.assertEqual(request.get_header('Content-type'), 'application/json')
+
+        request = build_request(self._create(method='PUT', payload='{not json'), 'http://test')
+        self.assertEqual(request.get_header('Content-type'), 'text/plain; charset=utf-8')
+
+    def test_select_logs(self):
+        for _ in range(5):
+            self._create()
+        self._create(url='/other/')
+        self._create(method='POST')
+
+        logs = list(select_logs(route='/json/', methods=['GET'], chunk_size=2))
+        self.assertEqual(len(logs), 5)
+        self.assertListEqual([log.id for log in logs], sorted(log.id for log in logs))
+        self.assertEqual(len(list(select_logs(limit=3, chunk_size=2))), 3)
+        self.assertEqual(
+            [log.id for log in select_logs(sample=0.5, seed=1)],
+            [log.id for log in select_logs(sample=0.5, seed=1)],
+        )
+
+    @override_settings(O11Y_DETAIL_TABLE=True)
+    def test_payload_in_detail_table(self):
+        write_logs([O11yLog(url='/json/', method='PUT', request_payload={'id': 1})])
+        (log,) = select_logs()
+        with self.assertNumQueries(0):
+            request = build_request(log, 'http://test')
+        self.assertEqual(json.loads(request.data), {'id': 1})
+
+    def test_replay(self):
+        self._create()
+        self._create(response_code=500)
+        self._create(method='PUT', payload='abc... [truncated, 9 bytes]')
+        sent = []
+
+        def fake_send(request, timeout):
+            sent.append(request.full_url)
+            return 0.2, 200, None
+
+        results, skipped, elapsed = replay(
+            select_logs(), 'http://test', concurrency=2, rate=1000, send_request=fake_send,
+        )
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(skipped, 1)
+
+        summary = summarise(results, elapsed)
+        self.assertEqual(summary['requests'], 2)
+        self.assertEqual(summary['replayed']['p50'], 0.2)
+        self.assertEqual(summary['recorded']['p99'], 0.1)
+        self.assertDictEqual(dict(summary['status_changes']), {(500, 200): 1})
+
+    def test_speed(self):
+        start = timezone.now()
+        for seconds in range(3):
+            self._create(request_start=start + timedelta(seconds=seconds))
+
+        t0 = time.perf_counter()
+        replay(select_logs(), 'http://test', speed=20, send_request=lambda r, t: (0, 200, None))
+        # two gaps of a second, 20 times faster
+        self.assertGreaterEqual(time.perf_counter() - t0, 0.1)
+
+
+class ReplayCommandTest(LiveServerTestCase):
+
+    def test_command(self):
+        O11yLog.objects.create(
+            url='/json/', route='/json/', method='GET', request_payload={'q': '1'},
+            response_code=500, duration=0.5,
+        )
+        O11yLog.objects.create(url='/html/', route='/html/', method='GET', response_code=200)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        output = os.path.join(tmp.name, 'replay.json')
+        out = StringIO()
+        call_command(
+            'o11y_replay', self.live_server_url, '--route', '/json/', '--output', output,
+            stdout=out,
+        )
+        self.assertIn('Replayed 1 requests', out.getvalue())
+        self.assertIn('Status 500 -> 200: 1', out.getvalue())
+        with open(output) as f:
+            self.assertEqual(json.load(f)['status_changes'][0]['replayed'], 200)
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command('o11y_replay', self.live_server_url, '--sample', '2')
+        with self.assertRaises(CommandError):
+            call_command('o11y_replay', self.live_server_url, '--header', 'nonsense')
+
+
+class BaselineTest(TestCase):
+
+    def setUp(self):
+        get_baselines().clear()
+        self.addCleanup(get_baselines().clear)
+
+    def test_ewma(self):
+        baseline = Baseline()
+        baseline.update(1.0, 0.5)
+        self.assertEqual((baseline.mean, baseline.variance), (1.0, 0.0))
+        baseline.update(3.0, 0.5)
+        self.assertEqual(baseline.mean, 2.0)
+        self.assertEqual(baseline.variance, 1.0)
+        for _ in range(200):
+            baseline.update(0.5, 0.5)
+        self.assertAlmostEqual(baseline.mean, 0.5)
+        self.assertAlmostEqual(baseline.stddev, 0)
+
+    def test_is_anomalous(self):
+        durations = [0.2, 0.25, 0.3] * 20
+        # still warming up
+        self.assertListEqual(
+            [is_anomalous('/orders/', 'GET', d) for d in durations[:49]], [False] * 49
+        )
+        for duration in durations[49:]:
+            is_anomalous('/orders/', 'GET', duration)
+
+        self.assertFalse(is_anomalous('/orders/', 'GET', 0.4))
+        self.assertTrue(is_anomalous('/orders/', 'GET', 2))
+        # baselines are per route and method
+        self.assertFalse(is_anomalous('/orders/', 'POST', 2))
+        self.assertFalse(is_anomalous(None, 'GET', 2))
+
+    def test_min_duration(self):
+        for _ in range(50):
+            is_anomalous('/fast/', 'GET', 0.001)
+        self.assertFalse(is_anomalous('/fast/', 'GET', 0.05))
+        self.assertTrue(is_anomalous('/fast/', 'GET', 0.5))
+
+    @override_settings(
+        O11Y_BASELINES=True, O11Y_BASELINE_MIN_REQUESTS=5, O11Y_ANOMALY_MIN_DURATION=0,
+        O11Y_SAMPLE_RATE=0,
+    )
+    def test_auto_log(self):
+        for _ in range(5):
+            is_anomalous('/json/', 'GET', 1e-9)
+        # not sampled, but kept for being much slower than the baseline
+        Client().get(reverse('json'))
+        self.assertTrue(O11yLog.objects.get().anomalous)
+
+        with override_settings(O11Y_TAIL_KEEP_ANOMALOUS=False):
+            Client().get(reverse('json'))
+        self.assertEqual(O11yLog.objects.count(), 1)
+
+    def test_disabled(self):
+        for _ in range(60):
+            is_anomalous('/json/', 'GET', 1e-9)
+        Client().get(reverse('json'))
+        self.assertFalse(O11yLog.objects.get().anomalous)
+
+
+@override_settings(O11Y_LOG_MEMORY=True, O11Y_MEMORY_SAMPLE_RATE=1.0)
+class MemoryInstrumentationTest(TestCase):
+
+    def _view(self, size, **kwargs):
+        @auto_log(**kwargs)
+        def view(request):
+            data = bytearray(size)
+            return HttpResponse(f'<h1>{len(data)}</h1>')
+        return view
+
+    def test_recorded(self):
+        self._view(1024 * 1024)(RequestFactory().get(reverse('html')))
+
+        log = O11yLog.objects.get()
+        self.assertGreaterEqual(log.memory_peak, 1024 * 1024)
+        self.assertLess(log.memory_peak, 2 * 1024 * 1024)
+        self.assertIsNone(log.memory_top)
+
+    @override_settings(O11Y_MEMORY_TOP_THRESHOLD=1024)
+    def test_top_sites(self):
+        @auto_log()
+        def view(request):
+            view.data = bytearray(64 * 1024)
+            return HttpResponse('<h1>GET</h1>')
+
+        view(RequestFactory().get(reverse('html')))
+        top = O11yLog.objects.get().memory_top
+        self.assertTrue(top)
+        self.assertIn('tests.py', top[0]['site'])
+        self.assertGreaterEqual(top[0]['size'], 64 * 1024)
+
+    @override_settings(O11Y_MEMORY_SAMPLE_RATE=0)
+    def test_sampled(self):
+        self._view(1024)(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().memory_peak)
+
+    def test_disabled_per_view(self):
+        self._view(1024, log_memory=False)(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().memory_peak)
+
+    def test_one_request_traced_at_a_time(self):
+        with memory._tracing:
+            self._view(1024)(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().memory_peak)
+
+    @skipUnless(os.path.exists('/proc/self/statm'), 'RSS is read from /proc')
+    def test_rss(self):
+        self._view(1024)(RequestFactory().get(reverse('html')))
+        self.assertIsNotNone(O11yLog.objects.get().memory_rss_delta)
+
+
+def _profiled_work(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _observe_in_child(path):
+    metrics = MetricsFile(path)
+    metrics.observe(('/child/', 'GET', '200'), 0.02)
+    metrics.close()
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_observe(self):
+        metrics = MetricsFile(initial_size=64)
+        for i in range(100):
+            metrics.observe((f'/route/{i % 20}/', 'GET', '200'), 0.02)
+        metrics.observe(('/route/0/', 'GET', '200'), 30)
+
+        values = metrics.values()
+        self.assertEqual(len(values), 20)
+        count, total, *histogram = values[('/route/0/', 'GET', '200')]
+        self.assertEqual(count, 6)
+        self.assertAlmostEqual(total, 30.1)
+        self.assertEqual(histogram[LATENCY_BUCKETS.index(0.025)], 5)
+        self.assertEqual(histogram[-1], 1)
+
+    def test_collect_across_processes(self):
+        first = MetricsFile(os.path.join(self.directory, 'o11y_metrics_1.db'))
+        second = MetricsFile(os.path.join(self.directory, 'o11y_metrics_2.db'))
+        first.observe(('/checkout/', 'GET', '200'), 0.1)
+        second.observe(('/checkout/', 'GET', '200'), 0.3)
+        second.observe(('/checkout/', 'GET', '500'), 0.3)
+
+        totals = collect(self.directory)
+        self.assertEqual(totals[('/checkout/', 'GET', '200')][0], 2)
+        self.assertAlmostEqual(totals[('/checkout/', 'GET', '200')][1], 0.4)
+        self.assertEqual(totals[('/checkout/', 'GET', '500')][0], 1)
+
+        # a process reusing a pid carries on from the counts in its file
+        first.close()
+        reopened = MetricsFile(os.path.join(self.directory, 'o11y_metrics_1.db'))
+        reopened.observe(('/checkout/', 'GET', '200'), 0.1)
+        self.assertEqual(reopened.values()[('/checkout/', 'GET', '200')][0], 2)
+
+    def test_mark_process_dead(self):
+        for pid in (1, 2):
+            metrics = MetricsFile(os.path.join(self.directory, f'o11y_metrics_{pid}.db'))
+            metrics.observe(('/checkout/', 'GET', '200'), 0.1)
+            metrics.observe((f'/only-{pid}/', 'GET', '200'), 0.1)
+            metrics.close()
+        before = collect(self.directory)
+
+        self.assertTrue(mark_process_dead(1, self.directory))
+        self.assertTrue(mark_process_dead(2, self.directory))
+        self.assertFalse(mark_process_dead(3, self.directory))
+        self.assertListEqual(
+            sorted(name for name in os.listdir(self.directory) if name.endswith('.db')),
+            ['o11y_metrics_dead.db'],
+        )
+        self.assertDictEqual(collect(self.directory), before)
+        self.assertEqual(before[('/checkout/', 'GET', '200')][0], 2)
+
+    @skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_forked_worker(self):
+        process = multiprocessing.get_context('fork').Process(
+            target=_observe_in_child, args=(os.path.join(self.directory, 'o11y_metrics_9.db'),)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(collect(self.directory)[('/child/', 'GET', '200')][0], 1)
+
+    def test_render(self):
+        labels = 'route="/say \\"hi\\"/",method="GET",status="200"'
+        text = render({('/say "hi"/', 'GET', '200'): [2, 0.5, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0]})
+        self.assertIn(f'o11y_requests_total{{{labels}}} 2', text)
+        self.assertIn(f'o11y_request_duration_seconds_bucket{{{labels},le="0.005"}} 1', text)
+        self.assertIn(f'o11y_request_duration_seconds_bucket{{{labels},le="0.5"}} 1', text)
+        self.assertIn(f'o11y_request_duration_seconds_bucket{{{labels},le="1"}} 2', text)
+        self.assertIn(f'o11y_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'o11y_request_duration_seconds_sum{{{labels}}} 0.5', text)
+
+    def test_view(self):
+        with override_settings(O11Y_METRICS=True, O11Y_METRICS_DIR=self.directory):
+            self.client.get(reverse('json'))
+            self.client.get(reverse('json'))
+            # not sampled, but still counted
+            with override_settings(O11Y_SAMPLE_RATE=0):
+                self.client.get(reverse('json'))
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertContains(
+            response, 'o11y_requests_total{route="/json/",method="GET",status="200"} 3'
+        )
+
+        with override_settings(O11Y_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    def test_disabled(self):
+        with override_settings(O11Y_METRICS_DIR=self.directory):
+            self.client.get(reverse('json'))
+        self.assertDictEqual(collect(self.directory), {})
+
+
+@override_settings(O11Y_PROFILE=True, O11Y_PROFILE_INTERVAL=0.001, O11Y_PROFILE_THRESHOLD=0.05)
+class ProfilerTest(TestCase):
+
+    def _view(self, seconds):
+        @auto_log()
+        def view(request):
+            _profiled_work(seconds)
+            return HttpResponse('<h1>GET</h1>')
+        return view
+
+    def test_slow_request_kept(self):
+        self._view(0.1)(RequestFactory().get(reverse('html')))
+
+        profile = O11yLog.objects.get().profile
+        self.assertGreater(profile['samples'], 0)
+        self.assertEqual(profile['interval'], 0.001)
+        stacks = profile['stacks']
+        self.assertTrue(all(stack.startswith('tests.py:view') for stack in stacks))
+        self.assertTrue(any('tests.py:_profiled_work' in stack for stack in stacks))
+
+    def test_fast_request_dropped(self):
+        self._view(0)(RequestFactory().get(reverse('html')))
+        self.assertIsNone(O11yLog.objects.get().profile)
+
+    @override_settings(O11Y_PROFILE_THRESHOLD=0)
+    async def test_concurrent_async_requests(self):
+        # both run on the event loop's thread, and the second starts while the first is waiting
+        @auto_log()
+        async def busy(request):
+            await asyncio.sleep(0.01)
+            _profiled_work(0.2)
+            return HttpResponse('<h1>GET</h1>')
+
+        @auto_log()
+        async def idle(request):
+            await asyncio.sleep(0.3)
+            return HttpResponse('<h1>GET</h1>')
+
+        await asyncio.gather(
+            busy(AsyncRequestFactory().get(reverse('html'))),
+            idle(AsyncRequestFactory().get(reverse('json'))),
+        )
+        profile = (await O11yLog.objects.aget(url=reverse('html'))).profile
+        self.assertTrue(any('tests.py:_profiled_work' in stack for stack in profile['stacks']))
+
+    @override_settings(MIDDLEWARE=WITH_MIDDLEWARE)
+    async def test_sync_view_under_asgi(self):
+        # the middleware runs on the event loop, and the view in sync_to_async's worker thread
+        await AsyncClient().get(reverse('html-fun'))
+
+        profile = (await O11yLog.objects.aget()).profile
+        self.assertIsNotNone(profile)
+        self.assertTrue(any('views.py:HtmlFunView' in stack for stack in profile['stacks']))
+
+    def test_sample_below_root(self):
+        def outer():
+            return inner()
+
+        def inner():
+            sampler = StackSampler()
+            profile = Profile(root=root)
+            sampler.register(profile)
+            sampler.sample()
+            sampler.unregister(profile)
+            return profile
+
+        root = sys._getframe()
+        profile = outer()
+        self.assertEqual(profile.samples, 1)
+        # the sampled thread is this one, so the sampler's own frame is the leaf
+        self.assertListEqual(
+            list(profile.stacks), ['tests.py:outer;tests.py:inner;profiler.py:sample']
+        )
+
+        # stacks not under the root - e.g. another task on an event loop - aren't counted
+        other = Profile(root=object())
+        other.add(sys._getframe())
+        self.assertEqual(other.samples, 1)
+        self.assertFalse(other.stacks)
+
+    def test_flame_graph(self):
+        tree = flame_tree({'a;b': 3, 'a;c': 1, 'd': 1})
+        self.assertEqual(tree['count'], 5)
+        self.assertEqual(tree['children']['a']['count'], 4)
+        self.assertEqual(tree['children']['a']['children']['b']['count'], 3)
+
+        html = render_flame_graph({'interval': 0.005, 'samples': 5, 'stacks': {'a;b': 3, 'd': 2}})
+        self.assertIn('5 samples every 5 ms', html)
+        self.assertIn('width: 60.00%', html)
+        self.assertIn('left: 60.00%', html)
+        self.assertEqual(render_flame_graph(None), '-')
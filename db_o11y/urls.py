@@ -1,17 +1,22 @@
 from django.urls import path
 
 from .views import (
-    JsonViews, HtmlViews, ErrorViews, MiscViews, HtmlFunView, Handled404View, Unhandled404View
+    JsonViews, HtmlViews, ErrorViews, MiscViews, AsyncViews, HtmlFunView, PlainFunView,
+    ErrorFunView, Handled404View, Unhandled404View,
 )
 
 
 urlpatterns = [
     path('html/', HtmlViews.as_view(), name='html'),
     path('json/', JsonViews.as_view(), name='json'),
+    path('json/<int:pk>/', JsonViews.as_view(), name='json-detail'),
     path('error/', ErrorViews.as_view(), name='error'),
     path('misc/', MiscViews.as_view(), name='misc'),
+    path('async/', AsyncViews.as_view(), name='async'),
     path('html-fun/', HtmlFunView, name='html-fun'),
     path('error-fun/', HtmlFunView, name='error-fun'),
+    path('plain/', PlainFunView, name='plain'),
+    path('plain-error/', ErrorFunView, name='plain-error'),
     path('h404/', Handled404View, name='h404'),
     path('u404/', Unhandled404View, name='u404'),
 ]
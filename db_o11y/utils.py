@@ -1,19 +1,39 @@
+from contextlib import ExitStack
+from datetime import timedelta
 from functools import wraps
-import json
+import sys
+import time
 import traceback
 
-from django.http import HttpResponse, JsonResponse, Http404
-from django.core.handlers.wsgi import WSGIRequest
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.http import HttpRequest, HttpResponse, JsonResponse, Http404
 from django.utils import timezone
 
+from .baselines import is_anomalous
+from .buffer import RequestBuffer, ignore_log, ignore_span
+from .conf import get_setting
+from .errors import fingerprint_exception
 from .models import O11yLog
+from .payloads import capture_stream, request_payload, response_payload
+from .memory import memory_sampled, record_memory
+from .metrics import record_request
+from .profiler import follow_sync_thread, record_profile
+from .queries import record_queries
+from .rollup import status_code
+from .sampling import head_sampled, tail_keep
+from .spool import get_spool
+from .storage import write_logs
+from .writer import get_writer
 
 
 HTML_500 = HttpResponse('<h1>Unexpected error</h1>', status=500)
 JSON_500 = JsonResponse({"message": "Unexpected error"}, status=500)
 
 
-def auto_log(log_inputs=False, log_outputs=False, catch_exceptions=True, http500=None):
+def auto_log(
+    log_inputs=False, log_outputs=False, catch_exceptions=True, http500=None, sample_rate=None,
+    slow_threshold=None, log_queries=None, log_memory=None, profile=None,
+):
     '''Decorator that allows capturing logs during a request
     
     Recognise that users can share sensitive data in requests e.g. passwords. 
@@ -23,79 +43,332 @@ def auto_log(log_inputs=False, log_outputs=False, catch_exceptions=True, http500
     exception is captured, and the user gets a generic Http500 response.
 
     The decorator configures a method on the request object called 'add_log'. This appends to
-    a list on the decorator namespace, and within the Django view code, individual logs can be 
-    appended. Then, when the view is finished and the response has been generated, these logs 
-    are committed to the DB.
+    a buffer for the request, and within the Django view code, individual logs can be
+    appended. request.span('name') similarly times a block of code, as a context manager or
+    decorator, and spans can be nested. Code without access to the request can use
+    db_o11y.log / db_o11y.span, or standard logging via handlers.O11yLogHandler. Then, when the
+    view is finished and the response has been generated, these logs are committed to the DB -
+    either directly, via the background writer if O11Y_BUFFERED_WRITES is enabled, or via a
+    spool file if O11Y_SPOOL_DIR is set.
+
+    Both sync and async (`async def`) views can be decorated. For async views the log is
+    saved in a worker thread (as the async ORM does) so the event loop is not blocked.
+
+    If the request is already being logged further up the stack (e.g. by O11yMiddleware), no
+    second log is created: the view's exceptions are recorded on the existing log and
+    catch_exceptions / http500 still apply, but the other arguments are ignored.
+
+    sample_rate is the fraction of requests to log (default from the O11Y_SAMPLE_RATE(S)
+    settings), decided before the view runs. For requests which are not sampled, add_log does
+    nothing and no payloads are extracted - but they are still logged, without payloads or logs,
+    if they raise, return a 5xx or take longer than slow_threshold seconds.
+
+    log_queries (default O11Y_LOG_QUERIES) records the number and total time of the queries the
+    view runs, along with the slowest ones and any repeated many times over (likely N+1s).
+
+    log_memory (default O11Y_LOG_MEMORY) records the peak memory allocated and the change in RSS
+    while the view runs, for the O11Y_MEMORY_SAMPLE_RATE fraction of logged requests, along with
+    the top allocation sites for requests over O11Y_MEMORY_TOP_THRESHOLD bytes.
+
+    profile (default O11Y_PROFILE) samples the view's stack every O11Y_PROFILE_INTERVAL seconds
+    from a background thread, and keeps the samples of requests slower than
+    O11Y_PROFILE_THRESHOLD seconds, to be shown as a flame graph in the admin.
+
+    With O11Y_METRICS enabled, every request - sampled or not - is also counted in the
+    Prometheus metrics of db_o11y.metrics, without touching the database.
+
+    With O11Y_BASELINES enabled, each request's duration is compared with a moving baseline of
+    its route's latency kept by the worker, and logs of requests well over it are marked
+    anomalous - and kept even when not sampled.
     '''
     def outer(func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_inner(*args, **kwargs):
+                request = _extract_request(*args)
+                if _is_logging(request):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        response = _handle_nested_exception(request, e, catch_exceptions, http500)
+                        if response is None:
+                            raise
+                        return response
+
+                log, buffer = _start_log(request, log_inputs, sample_rate)
+
+                exc = None
+                try:
+                    with _instrument(log, log_queries, log_memory, profile):
+                        # e.g. a sync view under O11yMiddleware runs in a worker thread
+                        await follow_sync_thread()
+                        response = await func(*args, **kwargs)
+                except Exception as e:
+                    exc = e
+                    response = _handle_exception(request, log, e, catch_exceptions, http500)
+
+                log = _finish_log(request, log, buffer, response, log_outputs, slow_threshold)
+                if log is not None:
+                    await _asave_log(log)
+
+                if exc and not catch_exceptions:
+                    raise exc
+                return response
+            return async_inner
+
         @wraps(func)
         def inner(*args, **kwargs):
             request = _extract_request(*args)
-            logs = []
-            dt0 = timezone.now()
-
-            # this variable can be customised if necessary
-            setattr(request, 'add_log', lambda message: logs.append({
-                'elapsed': (timezone.now() - dt0).total_seconds(),
-                'message': message,
-            }))
-            log = O11yLog(
-                url=_extract_base_url(request), 
-                method=request.method,
-                session_id=_extract_session_id(request),
-                request_payload=_extract_request_payload(request) if log_inputs else None,
-                request_start=timezone.now(),
-            )
+            if _is_logging(request):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    response = _handle_nested_exception(request, e, catch_exceptions, http500)
+                    if response is None:
+                        raise
+                    return response
+
+            log, buffer = _start_log(request, log_inputs, sample_rate)
 
             # need to track whether code has raised exception or not and alter behaviour accordingly
             exc = None
             try:
-                response = func(*args, **kwargs)
+                with _instrument(log, log_queries, log_memory, profile):
+                    response = func(*args, **kwargs)
             except Exception as e:
-                log.exception = traceback.format_exc()
                 exc = e
-            finally:
-                if exc and catch_exceptions:
-                    # 404 can be raised if object doesn't exist, so there is a case where a wrapped
-                    # view can raise 404
-                    if isinstance(exc, Http404):
-                        response = _get_404(request)
-                    else:
-                        response = _get_500(request, http500)
-                    exc = None
-
-                # block cannot be run if there is an exception and it should be raised
-                if not exc:
-                    log.response_code = response.status_code
-                    log.response_payload = (
-                        _extract_response_payload(response) if log_outputs else None
-                    )
-
-                log.logs = logs
-                log.request_end = timezone.now()
-                log.duration = (log.request_end - log.request_start).total_seconds()
-                log.save()
+                response = _handle_exception(request, log, e, catch_exceptions, http500)
 
-                if exc and not catch_exceptions:
-                    raise exc
+            log = _finish_log(request, log, buffer, response, log_outputs, slow_threshold)
+            if log is not None:
+                _save_log(log)
 
+            if exc and not catch_exceptions:
+                raise exc
             return response
         return inner
     return outer
 
 
+class _SampledOut:
+    '''Stands in for the log of a request which was not head-sampled
+
+    Only holds what the tail sampling rules need, so that an O11yLog is only built if one of
+    them decides to keep the request.
+    '''
+    __slots__ = ('start', 'exception', '_exception_fingerprint')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.exception = None
+        self._exception_fingerprint = None
+
+
+def _start_log(request, log_inputs, sample_rate=None):
+    '''Attach add_log to the request and build the (unsaved) log for it
+
+    Returns the log along with the RequestBuffer that add_log and span record to. If the request
+    is not sampled, the log is a _SampledOut and there is no buffer.
+    '''
+    # matched against the same path as O11yMiddleware's include / exclude patterns
+    if not head_sampled(request.path_info, sample_rate):
+        request.add_log = ignore_log
+        request.span = ignore_span
+        log = request._o11y_log = _SampledOut()
+        return log, None
+
+    buffer = RequestBuffer.from_settings()
+    buffer.activate()
+    # these variables can be customised if necessary
+    request.add_log = buffer.add_log
+    request.span = buffer.span
+    log = O11yLog(
+        url=_extract_base_url(request), 
+        method=request.method,
+        session_id=_extract_session_id(request),
+        request_payload=_extract_request_payload(request) if log_inputs else None,
+        request_start=timezone.now(),
+    )
+    request._o11y_log = log
+    return log, buffer
+
+
+def _instrument(log, log_queries, log_memory=None, profile=None):
+    '''Context manager for the optional instrumentation which runs around the view
+
+    Requests which were not sampled are never instrumented.
+    '''
+    stack = ExitStack()
+    if isinstance(log, _SampledOut):
+        return stack
+
+    if log_queries is None:
+        log_queries = get_setting('O11Y_LOG_QUERIES')
+    if log_queries:
+        stack.enter_context(record_queries(log))
+
+    if log_memory is None:
+        log_memory = get_setting('O11Y_LOG_MEMORY')
+    if log_memory and memory_sampled():
+        stack.enter_context(record_memory(log))
+
+    if profile is None:
+        profile = get_setting('O11Y_PROFILE')
+    if profile:
+        # the frame of auto_log's wrapper, which the view is called from
+        stack.enter_context(record_profile(log, sys._getframe(1)))
+    return stack
+
+
+def _is_logging(request):
+    return getattr(request, '_o11y_log', None) is not None
+
+
+def _handle_exception(request, log, exc, catch_exceptions, http500):
+    '''Record the exception on the log
+
+    Returns the response to send instead if exceptions are being caught, otherwise None.
+    '''
+    _record_exception(log, exc)
+    if not catch_exceptions:
+        return None
+
+    # 404 can be raised if object doesn't exist, so there is a case where a wrapped
+    # view can raise 404
+    if isinstance(exc, Http404):
+        return _get_404(request)
+    return _get_500(request, http500)
+
+
+def _handle_nested_exception(request, exc, catch_exceptions, http500):
+    return _handle_exception(request, request._o11y_log, exc, catch_exceptions, http500)
+
+
+def _record_exception(log, exc):
+    '''Store the traceback on the log, along with its fingerprint for db_o11y.errors, which is
+    taken from the exception itself while it is to hand
+    '''
+    log.exception = _format_exception(exc)
+    log._exception_fingerprint = fingerprint_exception(exc)
+
+
+def _format_exception(exc):
+    return ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+
+
+def _finish_log(request, log, buffer, response, log_outputs, slow_threshold=None):
+    '''Complete the log once the view has run
+
+    Returns the log to save, or None if the request was not sampled and is not being kept, or
+    if the log will be saved once the streaming response has been sent.
+    '''
+    request._o11y_log = None
+    if buffer is not None:
+        buffer.deactivate()
+    # response is None if there is an exception and it should be raised
+    response_code = response.status_code if response is not None else None
+
+    if isinstance(log, _SampledOut):
+        duration = time.perf_counter() - log.start
+        route = _extract_route(request)
+        _record_metrics(request, route, response_code, duration)
+        anomalous = _is_anomalous(request, route, duration)
+        if not tail_keep(response_code, log.exception, duration, slow_threshold, anomalous):
+            return None
+        request_end = timezone.now()
+        kept = O11yLog(
+            url=_extract_base_url(request),
+            route=route,
+            method=request.method,
+            session_id=_extract_session_id(request),
+            request_start=request_end - timedelta(seconds=duration),
+            request_end=request_end,
+            duration=duration,
+            anomalous=anomalous,
+            response_code=response_code,
+            exception=log.exception,
+        )
+        kept._exception_fingerprint = log._exception_fingerprint
+        return kept
+
+    if response is not None:
+        log.response_code = response_code
+        if log_outputs and not response.streaming:
+            log.response_payload = _extract_response_payload(response)
+
+    # only known once the URL has been resolved, which is after _start_log for O11yMiddleware
+    log.route = _extract_route(request)
+    log.logs = buffer.logs()
+    log.spans = buffer.spans() or None
+    log.request_end = timezone.now()
+    log.duration = (log.request_end - log.request_start).total_seconds()
+    _record_metrics(request, log.route, response_code, log.duration)
+    log.anomalous = _is_anomalous(request, log.route, log.duration)
+
+    if log_outputs and response is not None and response.streaming:
+        _save_when_streamed(log, response)
+        return None
+    return log
+
+
+def _record_metrics(request, route, response_code, duration):
+    if get_setting('O11Y_METRICS'):
+        record_request(route, request.method, status_code(response_code), duration)
+
+
+def _is_anomalous(request, route, duration):
+    return get_setting('O11Y_BASELINES') and is_anomalous(route, request.method, duration)
+
+
+def _save_log(log):
+    '''Write the log now, or hand it to the spool file / background writer if enabled'''
+    if get_setting('O11Y_SPOOL_DIR'):
+        get_spool().write(log)
+    elif get_setting('O11Y_BUFFERED_WRITES'):
+        get_writer().put(log)
+    else:
+        write_logs([log])
+
+
+async def _asave_log(log):
+    '''Async version of _save_log. Spooling and queueing for the writer never wait on the DB'''
+    if get_setting('O11Y_SPOOL_DIR'):
+        get_spool().write(log)
+    elif get_setting('O11Y_BUFFERED_WRITES'):
+        get_writer().put(log)
+    else:
+        await sync_to_async(write_logs)([log])
+
+
+def _save_when_streamed(log, response):
+    '''The body of a streaming response is only known once it has been sent, so the log is saved
+    then instead. Its duration still runs to when the view returned.
+    '''
+    def complete(payload):
+        log.response_payload = payload
+        _save_log(log)
+
+    async def acomplete(payload):
+        log.response_payload = payload
+        await _asave_log(log)
+
+    capture_stream(response, complete, acomplete)
+
+
 def _extract_base_url(request):
-    return request.path.split('?')[0]
+    return request.path
+
+
+def _extract_route(request):
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None or resolver_match.route is None:
+        return None
+    return f'/{resolver_match.route}'
 
 
 def _extract_request_payload(request):
     '''Simple function to get payload from request into easily readable / seriailizable format'''
-    if request.method == 'GET':
-        return {key: request.GET[key] for key in request.GET} or None
-    elif request.method == 'POST':
-        return {key: request.POST[key] for key in request.POST} or None
-    else:
-        return json.loads(request.body.decode('utf-8')) or None
+    return request_payload(request)
 
 
 def _extract_session_id(request):
@@ -105,19 +378,18 @@ def _extract_session_id(request):
 
 
 def _extract_response_payload(response):
-    if isinstance(response, JsonResponse):
-        return json.loads(response.content) or None
-    if isinstance(response.content, bytes):
-        return response.content.decode('utf-8') or None
-    return str(response.content) or None
+    return response_payload(response)
 
 
 def _extract_request(*args):
-    '''This allows decorator to be run as function (args[0]) or class-based view (args[1])'''
+    '''This allows decorator to be run as function (args[0]) or class-based view (args[1])
+
+    Any HttpRequest is accepted, so this works under both WSGI (WSGIRequest) and ASGI (ASGIRequest).
+    '''
     for arg in args:
-        if isinstance(arg, WSGIRequest):
+        if isinstance(arg, HttpRequest):
             return arg
-    raise TypeError('None of the inputs were subclasses of WSGIRequest')
+    raise TypeError('None of the inputs were subclasses of HttpRequest')
 
 
 def _get_500(request, http500):
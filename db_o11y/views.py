@@ -1,9 +1,11 @@
+import asyncio
 from datetime import datetime
 from time import sleep
 
 from django.http import HttpResponse, JsonResponse, Http404
 from django.views import View
 
+from .buffer import log
 from .utils import auto_log
 
 
@@ -74,7 +76,8 @@ class MiscViews(View):
         dt1 = datetime.utcnow()
         request.add_log(f'Request started: {dt1.isoformat()}')
 
-        sleep(1)
+        with request.span('sleep', seconds=1):
+            sleep(1)
 
         dt2 = datetime.utcnow()
         request.add_log(f'Request ended: = {dt2.isoformat()}')
@@ -85,6 +88,20 @@ class MiscViews(View):
         }, status=200)
 
 
+class AsyncViews(View):
+
+    @auto_log()
+    async def get(self, request, *args, **kwargs):
+        request.add_log(f'NOW = {datetime.utcnow().isoformat()}')
+        await asyncio.sleep(0.01)
+        return JsonResponse({'message': 'GET'}, status=200)
+
+    @auto_log()
+    async def post(self, request, *args, **kwargs):
+        request.add_log(f'NOW = {datetime.utcnow().isoformat()}')
+        raise Exception('Raising on async POST')
+
+
 @auto_log()
 def HtmlFunView(request):
     request.add_log(f'Start at: {datetime.utcnow().isoformat()}')
@@ -93,9 +110,16 @@ def HtmlFunView(request):
     return HttpResponse('<h1>GET via function</h1>', status=200)
 
 
-# Note: no decorator. The decorator is added in the tests.
+# Note: no decorator. Used to test O11yMiddleware, so it logs with db_o11y.log, which does
+# nothing when the middleware isn't installed, rather than request.add_log
+def PlainFunView(request):
+    log(f'Start at: {datetime.utcnow().isoformat()}')
+    return HttpResponse('<h1>GET via plain function</h1>', status=200)
+
+
+# Note: no decorator. The decorator is added in the tests, or O11yMiddleware logs it.
 def ErrorFunView(request):
-    request.add_log(f'Start at: {datetime.utcnow().isoformat()}')
+    log(f'Start at: {datetime.utcnow().isoformat()}')
     raise ValueError('Bad value')
 
 
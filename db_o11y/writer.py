@@ -0,0 +1,187 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+from .conf import get_setting
+from .storage import write_logs
+
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP = 'drop'
+POLICY_BLOCK = 'block'
+
+
+class BufferedWriter:
+    '''Per-process queue of unsaved O11yLog objects, drained by a background thread
+
+    Requests only pay for a queue.put - the INSERTs happen in batches via bulk_create on the
+    writer thread, once either batch_size logs are waiting or flush_interval seconds have passed
+    since the first log of the batch arrived.
+
+    The queue is bounded. When it is full, the 'drop' policy discards the new log immediately
+    and the 'block' policy waits up to block_timeout seconds for space before discarding it.
+    Either way the request is never failed because of the writer, and the discarded log is
+    counted in `dropped`.
+    '''
+
+    def __init__(
+        self, max_size=10000, batch_size=500, flush_interval=1.0, policy=POLICY_DROP,
+        block_timeout=0.1,
+    ):
+        if policy not in (POLICY_DROP, POLICY_BLOCK):
+            raise ValueError(f'Unknown buffer policy: {policy}')
+
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+
+        self._counter_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_size=get_setting('O11Y_BUFFER_MAX_SIZE'),
+            batch_size=get_setting('O11Y_BUFFER_BATCH_SIZE'),
+            flush_interval=get_setting('O11Y_BUFFER_FLUSH_INTERVAL'),
+            policy=get_setting('O11Y_BUFFER_FULL_POLICY'),
+            block_timeout=get_setting('O11Y_BUFFER_BLOCK_TIMEOUT'),
+        )
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='o11y-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        '''Stop the writer thread, writing anything still in the queue first'''
+        self._stopping.set()
+        if self.running:
+            self._thread.join(timeout)
+        self._thread = None
+        # anything left behind (e.g. the thread was never started) is written by the caller
+        self.flush()
+
+    def put(self, log):
+        '''Queue a log for writing. Returns False if the log was dropped'''
+        try:
+            if self.policy == POLICY_BLOCK:
+                self.queue.put(log, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(log)
+        except queue.Full:
+            self._increment('dropped', 1)
+            return False
+        return True
+
+    def flush(self):
+        '''Synchronously write everything currently in the queue from the calling thread'''
+        while True:
+            batch = self._collect(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            batch = self._collect(block=True)
+            if batch:
+                self._write(batch)
+
+    def _collect(self, block):
+        '''Take up to batch_size logs from the queue
+
+        When blocking, waits up to flush_interval for the first log, and then until either the
+        batch is full or flush_interval has passed since the first log arrived.
+        '''
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+            else:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if block and not self._stopping.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            write_logs(batch)
+        except Exception:
+            # the writer must never take down the process, so failed batches are counted
+            # and discarded rather than retried
+            logger.exception('Failed to write %s O11yLog records', len(batch))
+            self._increment('failed', len(batch))
+        else:
+            self._increment('flushed', len(batch))
+        finally:
+            if threading.current_thread() is self._thread:
+                close_old_connections()
+
+    def _increment(self, counter, value):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    '''Return this process's writer, starting it on first use
+
+    The pid is tracked because threads do not survive a fork - e.g. gunicorn with --preload -
+    so each worker process gets a writer (and thread) of its own.
+    '''
+    global _writer, _writer_pid
+    if _writer is not None and _writer_pid == os.getpid():
+        return _writer
+
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = BufferedWriter.from_settings()
+            _writer_pid = os.getpid()
+            _writer.start()
+            atexit.register(_writer.stop)
+    return _writer
@@ -66,9 +66,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # To keep the logs in a database of their own, add it here and set O11Y_DATABASE = 'o11y'
+    # 'o11y': {
+    #     'ENGINE': 'django.db.backends.sqlite3',
+    #     'NAME': BASE_DIR / 'o11y.sqlite3',
+    # },
 }
 
+DATABASE_ROUTERS = ['db_o11y.routers.O11yRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -1,8 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from db_o11y.metrics import metrics_view
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('o11y/api/', include('db_o11y.api_urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('db_o11y.urls')),
 ]